@@ -1,4 +1,5 @@
 from microservice.core.decorator import microservice
-from microservice.core.deploy import create_deployment, destroy_deployment
+from microservice.core.deploy import create_deployment, destroy_deployment, scale_deployment
+from microservice.core.fan_out import gather
 from microservice.core.microservice_logging import configure_logging
 from microservice.core.service_host import initialise_interface, terminate_interface
@@ -24,9 +24,11 @@ def start_service():
 
     logger.info("This instance is providing the following service: {service_name}",
                 extra={'service_name': args.service})
-    from microservice.core import service_host
+    from microservice.core import service_host, settings
     service_host.initialise_microservice(args.service, args.host, args.port, **other_kwargs)
-    input("Enter to exit")
+    if settings.flask_app_thread is not None:
+        # The server is running in the background - blocking servers have already been shut down by this point.
+        input("Enter to exit")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+"""
+Simulate a burst of load on `sleep_1` from `microservice.examples.sleepers`, with a fixed single replica and with the
+autoscaler, and compare how each copes.
+
+Each replica is simulated by an executor in this process (as used by a replica in ACTOR mode), with the executor's
+metrics standing in for those the autoscaler polls from each replica. So this exercises the autoscaler's decisions,
+and the latency they lead to, without needing a process (or CPU) per replica. Requests are sent to the replica with
+the fewest outstanding requests.
+
+Run with:
+    python -m microservice.benchmarks.autoscaler_benchmark
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from microservice.core import settings
+from microservice.core.autoscaler import Autoscaler
+from microservice.core.executor import BoundedExecutor, ExecutorFull, percentile
+from microservice.core.service_waypost import init_service_waypost
+from microservice.examples import sleepers
+
+SERVICE = 'microservice.examples.sleepers.sleep_1'
+# (seconds, requests per second) of each phase of the load. Each replica handles up to 5 requests per second.
+PHASES = [(5, 2), (25, 12), (20, 2)]
+SAMPLE_INTERVAL = 5
+
+
+class SimulatedCluster:
+    """
+    Replicas of `SERVICE`, each an executor in this process.
+    """
+
+    def __init__(self, replicas: int):
+        self.services = {SERVICE: []}
+        self.executors = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.scale(SERVICE, replicas)
+
+    def uris_for_service(self, service_name):
+        return list(self.services[service_name])
+
+    def scale(self, service_name, replicas: int):
+        with self.lock:
+            uris = self.services[service_name]
+            while len(uris) < replicas:
+                uri = "sim://{}/".format(self.next_id)
+                self.next_id += 1
+                self.executors[uri] = BoundedExecutor(settings.executor_workers, settings.executor_queue_size)
+                uris.append(uri)
+            while len(uris) > replicas:
+                # Requests already queued at the replica are still carried out.
+                self.executors.pop(uris.pop()).shutdown(wait=False)
+
+    def fetch_metrics(self, uri: str) -> dict:
+        return self.executors[uri].metrics()
+
+    def submit(self, fn):
+        with self.lock:
+            executor = min((self.executors[uri] for uri in self.services[SERVICE]),
+                           key=lambda replica: replica.queue_depth + replica.active_workers)
+        return executor.submit(fn)
+
+
+def simulate(autoscale: bool):
+    cluster = SimulatedCluster(replicas=1)
+    autoscaler = Autoscaler(cluster, fetch_metrics=cluster.fetch_metrics) if autoscale else None
+    latencies = []
+    rejected = 0
+    timeline = []
+    replica_seconds = 0
+
+    def make_request(sent_at):
+        sleepers.sleep_1()
+        latencies.append(time.monotonic() - sent_at)
+
+    start = time.monotonic()
+    next_sample = next_poll = start
+    for duration, rate in PHASES:
+        phase_end = time.monotonic() + duration
+        while time.monotonic() < phase_end:
+            now = time.monotonic()
+            if autoscaler is not None and now >= next_poll:
+                autoscaler.step()
+                next_poll += settings.autoscale_interval
+            if now >= next_sample:
+                replicas = len(cluster.uris_for_service(SERVICE))
+                queue_depth = sum(cluster.fetch_metrics(uri)['queue_depth']
+                                  for uri in cluster.uris_for_service(SERVICE))
+                recent = latencies[-rate * SAMPLE_INTERVAL:]
+                timeline.append((now - start, rate, replicas, queue_depth, percentile(recent, 95) if recent else 0))
+                next_sample += SAMPLE_INTERVAL
+            replica_seconds += len(cluster.uris_for_service(SERVICE)) / rate
+            try:
+                cluster.submit(lambda sent_at=now: make_request(sent_at))
+            except ExecutorFull:
+                rejected += 1
+            time.sleep(max(0.0, now + 1 / rate - time.monotonic()))
+    total = time.monotonic() - start
+    if autoscaler is not None:
+        autoscaler.wait()
+    cluster.scale(SERVICE, 0)
+    while len(latencies) + rejected < sum(duration * rate for duration, rate in PHASES) * 0.99:
+        time.sleep(0.5)
+    return timeline, latencies, rejected, replica_seconds / total
+
+
+if __name__ == "__main__":
+    # Requests refused by full replicas are counted, rather than logged.
+    logging.getLogger('microservice.core.executor').setLevel(logging.ERROR)
+    init_service_waypost()
+    settings.deployment_mode = settings.DeploymentMode.ZERO
+    settings.autoscale_interval = 1
+    settings.autoscale_latency_high_watermark = 2
+    # Every request takes at least a second.
+    settings.autoscale_latency_low_watermark = 1.5
+    # Scaling up again is held off until the latency since the last change has been measured.
+    settings.executor_latency_window = 3
+    settings.autoscale_up_cooldown = 3
+    settings.autoscale_down_cooldown = 10
+
+    print("{} CPUs".format(os.cpu_count()))
+    for autoscale in [False, True]:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # `sleep_1` prints every time it's called.
+            timeline, latencies, rejected, mean_replicas = simulate(autoscale)
+        print()
+        print("autoscaled" if autoscale else "fixed single replica")
+        print("{:>6} {:>6} {:>9} {:>12} {:>13}".format("time", "req/s", "replicas", "queue depth", "p95 latency"))
+        for sample in timeline:
+            print("{:>6.0f} {:>6} {:>9} {:>12} {:>12.2f}s".format(*sample))
+        print("completed: {}, rejected: {}, p95 latency: {:.2f}s, mean replicas: {:.2f}".format(
+            len(latencies), rejected, percentile(latencies, 95), mean_replicas))
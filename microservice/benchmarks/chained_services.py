@@ -0,0 +1,51 @@
+"""
+Microservices used by the benchmarks. These can't be defined in the benchmarks themselves, as they are run as
+`__main__`.
+"""
+import time
+
+from microservice.core.decorator import microservice
+from microservice.core.fan_out import gather
+
+
+def local_work(iterations: int) -> int:
+    return sum(i * i for i in range(iterations)) % 1000
+
+
+@microservice
+def step(total):
+    return total + 1
+
+
+@microservice
+def replayed_chain(calls: int, work: int):
+    total = 0
+    for _ in range(calls):
+        total += local_work(work)
+        total = step(total)
+    return total
+
+
+@microservice(continuation=True)
+def continued_chain(calls: int, work: int):
+    total = 0
+    for _ in range(calls):
+        total += local_work(work)
+        total = yield step.defer(total)
+    return total
+
+
+@microservice
+def wait(seconds: float):
+    time.sleep(seconds)
+    return seconds
+
+
+@microservice
+def wait_in_turn(*delays):
+    return [wait(delay) for delay in delays]
+
+
+@microservice
+def wait_gathered(*delays):
+    return gather(*[wait.defer(delay) for delay in delays])
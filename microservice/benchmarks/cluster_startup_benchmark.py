@@ -0,0 +1,67 @@
+"""
+Measure how long a subprocess cluster takes to start, against the number of services in it.
+
+Each service is a replica of `hello_world`, spawned as a separate process. The cluster is ready once every service
+responds to `/ping`. For comparison, the previous fixed one second sleep is shown with the number of services that
+were actually ready after it.
+
+Run with:
+    python -m microservice.benchmarks.cluster_startup_benchmark
+"""
+import os
+import time
+
+from microservice.core import settings
+from microservice.core.subprocess_cluster import SubprocessMicroserviceCluster, uri_from_subprocess_service
+from microservice.core.utils import MicroserviceDefinition
+
+SERVICE = 'microservice.examples.hello_world.hello_world'
+PORT = 11000
+SERVICE_COUNTS = [1, 2, 4, 8, 16]
+
+
+def create_cluster(count: int, port: int) -> SubprocessMicroserviceCluster:
+    cluster = SubprocessMicroserviceCluster([MicroserviceDefinition(SERVICE)], replicas={SERVICE: count})
+    cluster.next_port = port
+    return cluster
+
+
+def ready_after_fixed_sleep(count: int, port: int) -> int:
+    cluster = create_cluster(count, port)
+    cluster.services[SERVICE] = [cluster.spawn_replica(SERVICE) for _ in range(count)]
+    try:
+        time.sleep(1)
+        ready = 0
+        for service in cluster.services[SERVICE]:
+            try:
+                uri = uri_from_subprocess_service(service) + 'ping'
+                ready += cluster.readiness_session.get(uri, timeout=0.1).text == "pong"
+            except Exception:
+                pass
+        return ready
+    finally:
+        cluster.close_all_microservices()
+
+
+def time_to_ready(count: int, port: int) -> float:
+    cluster = create_cluster(count, port)
+    start = time.monotonic()
+    try:
+        cluster.spawn_all_microservices()
+        return time.monotonic() - start
+    finally:
+        cluster.close_all_microservices()
+
+
+if __name__ == "__main__":
+    settings.readiness_timeout = 120
+
+    print("{} CPUs".format(os.cpu_count()))
+    print("{:>8} {:>26} {:>16}".format("services", "ready after fixed 1s sleep", "time to ready"))
+    port = PORT
+    for count in SERVICE_COUNTS:
+        ready = ready_after_fixed_sleep(count, port)
+        port += count
+        seconds = time_to_ready(count, port)
+        port += count
+        print("{:>8} {:>26} {:>15.2f}s".format(count, "{}/{}".format(ready, count), seconds))
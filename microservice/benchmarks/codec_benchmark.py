@@ -0,0 +1,54 @@
+"""
+Compare the wire codecs in `microservice.core.codec` for encode time, decode time and encoded size.
+
+The messages benchmarked are representative of deep actor call chains: they have a via header for every hop and a
+result for every nested call that has been made so far.
+
+Run with:
+    python -m microservice.benchmarks.codec_benchmark
+"""
+import timeit
+
+from microservice.core import codec, communication, settings
+
+
+def build_message(via_depth: int, result_count: int) -> communication.Message:
+    msg = communication.Message(
+        args=(1, 'two', 3.0),
+        kwargs={'size': 10000, 'name': 'intensive_calculation'},
+        request_id=123456,
+    )
+    for i in range(via_depth):
+        msg.via.append(communication.ViaHeader(
+            'microservice.examples.intensive_calculators.intensive_calculation_{}'.format(i),
+            (i, 'arg', [i, i + 1]),
+            {'depth': i, 'flag': True},
+        ))
+    for i in range(result_count):
+        msg.add_result(
+            'microservice.examples.intensive_calculators.intensive_calculation_2',
+            (i,),
+            {'size': i * 10},
+            {'sum': i * 1000, 'values': list(range(10))},
+        )
+    return msg
+
+
+def benchmark(wire_codec: settings.WireCodec, msg: communication.Message, number: int) -> tuple:
+    selected = codec.codecs[wire_codec]
+    encoded = selected.dumps(msg)
+    encode_time = timeit.timeit(lambda: selected.dumps(msg), number=number) / number
+    decode_time = timeit.timeit(lambda: selected.loads(encoded), number=number) / number
+    return encode_time, decode_time, len(encoded)
+
+
+if __name__ == "__main__":
+    number = 2000
+    print("{:>6} {:>8} {:>8} {:>12} {:>12} {:>10}".format(
+        "depth", "results", "codec", "encode (us)", "decode (us)", "bytes"))
+    for via_depth, result_count in [(1, 1), (5, 10), (20, 50), (50, 200)]:
+        msg = build_message(via_depth, result_count)
+        for wire_codec in settings.WireCodec:
+            encode_time, decode_time, size = benchmark(wire_codec, msg, number)
+            print("{:>6} {:>8} {:>8} {:>12.1f} {:>12.1f} {:>10}".format(
+                via_depth, result_count, wire_codec.value, encode_time * 1e6, decode_time * 1e6, size))
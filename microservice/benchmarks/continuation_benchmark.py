@@ -0,0 +1,80 @@
+"""
+Compare the CPU time taken to carry out a microservice making N nested calls in turn in ACTOR mode, when it is
+replayed from the top as each result arrives, and when it is a continuation microservice (which is resumed instead).
+
+Some local work is done before each nested call. The service hops are carried out in this process: each message is
+encoded and decoded as it would be when sent between services, and each nested call is answered straight away.
+
+Run with:
+    python -m microservice.benchmarks.continuation_benchmark
+"""
+import time
+
+from microservice.core import codec, communication, settings, utils
+from microservice.core.service_waypost import init_service_waypost
+from microservice.benchmarks import chained_services
+
+WORK = 5000
+
+# Nested calls sent by the service being benchmarked.
+outbox = []
+
+
+def capture(service_name, obj):
+    outbox.append((service_name, obj))
+
+
+def reply_to(service_name: str, sent: communication.Message) -> communication.Message:
+    """
+    :return: The message `service_name` sends back in response to `sent`.
+    """
+    sent = codec.loads(codec.dumps(sent))
+    result = utils.func_from_service_name(service_name).__wrapped__(*sent.args, **sent.kwargs)
+    reply = communication.Message(
+        args=sent.via[-1].args,
+        kwargs=sent.via[-1].kwargs,
+        via=sent.via[:-1],
+        results=sent.results,
+        request_id=sent.request_id,
+    )
+    reply.add_result(service_name, sent.args, sent.kwargs, result)
+    return codec.loads(codec.dumps(reply))
+
+
+def call_as_actor(service, *args) -> tuple:
+    """
+    :return: (result, number of times the service was called with a message)
+    """
+    settings.ServiceWaypost.local_service = service.definition.name
+    message = communication.Message(args=args, via=[('http://interface/', (), {})])
+    hops = 0
+    while True:
+        hops += 1
+        settings.set_current_message(message)
+        try:
+            return service(__message=message), hops
+        except communication.ServiceCallPerformed:
+            message = reply_to(*outbox.pop())
+        finally:
+            settings.set_current_message(None)
+
+
+def benchmark(service, calls: int) -> tuple:
+    start = time.process_time()
+    result, hops = call_as_actor(service, calls, WORK)
+    return result, hops, time.process_time() - start
+
+
+if __name__ == "__main__":
+    settings.communication_mode = settings.CommunicationMode.ACTOR
+    settings.deployment_mode = settings.DeploymentMode.KUBERNETES
+    init_service_waypost()
+    communication.send_object_to_service = capture
+
+    print("{:>6} {:>14} {:>18} {:>8}".format("calls", "replayed (ms)", "continuation (ms)", "speedup"))
+    for calls in [1, 2, 5, 10, 20, 30, 40, 50]:
+        replayed, replayed_hops, replayed_time = benchmark(chained_services.replayed_chain, calls)
+        continued, continued_hops, continued_time = benchmark(chained_services.continued_chain, calls)
+        assert replayed == continued and replayed_hops == continued_hops == calls + 1
+        print("{:>6} {:>14.1f} {:>18.1f} {:>7.1f}x".format(
+            calls, replayed_time * 1e3, continued_time * 1e3, replayed_time / continued_time))
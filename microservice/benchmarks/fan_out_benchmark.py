@@ -0,0 +1,70 @@
+"""
+Compare the time taken by a microservice making several independent nested calls in ACTOR mode, when they are made
+in turn and when they are made at once with `gather`.
+
+Each nested service takes a fixed time to respond. The service hops are carried out in this process, each on its own
+thread, and each message is encoded and decoded as it would be when sent between services.
+
+Run with:
+    python -m microservice.benchmarks.fan_out_benchmark
+"""
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from microservice.core import communication, settings
+from microservice.core.service_waypost import init_service_waypost
+from microservice.benchmarks import chained_services
+from microservice.benchmarks.continuation_benchmark import reply_to
+
+DELAY = 0.05
+
+hops = ThreadPoolExecutor(max_workers=32)
+
+
+def call_as_actor(service, *args):
+    """
+    Carry out `service` as it would be in ACTOR mode, with each nested service responding on another thread.
+    """
+    done = Future()
+
+    def deliver(message: communication.Message):
+        settings.set_current_message(message)
+        try:
+            done.set_result(service(__message=message))
+        except communication.ServiceCallPerformed:
+            pass
+        except Exception as err:
+            done.set_exception(err)
+        finally:
+            settings.set_current_message(None)
+
+    def respond(service_name: str, sent: communication.Message):
+        deliver(reply_to(service_name, sent))
+
+    communication.send_object_to_service = lambda service_name, obj: hops.submit(respond, service_name, obj)
+    settings.ServiceWaypost.local_service = service.definition.name
+    deliver(communication.Message(args=args, via=[('http://interface/', (), {})]))
+    return done.result()
+
+
+def benchmark(service, calls: int) -> float:
+    start = time.perf_counter()
+    # Slightly different delays, so that each call is different.
+    call_as_actor(service, *[DELAY + i / 1000 for i in range(calls)])
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    settings.communication_mode = settings.CommunicationMode.ACTOR
+    settings.deployment_mode = settings.DeploymentMode.KUBERNETES
+    init_service_waypost()
+
+    print("Each nested call takes {:.0f}ms or more".format(DELAY * 1e3))
+    print("{:>6} {:>12} {:>14}".format("calls", "in turn (ms)", "gathered (ms)"))
+    for calls in [1, 2, 4, 8, 16]:
+        print("{:>6} {:>12.1f} {:>14.1f}".format(
+            calls,
+            benchmark(chained_services.wait_in_turn, calls) * 1e3,
+            benchmark(chained_services.wait_gathered, calls) * 1e3))
+    hops.shutdown()
@@ -0,0 +1,76 @@
+"""
+Compare the throughput of `intensive_calculation_2` when it is load balanced across 1, 2 and 4 instances, using
+each load balancing policy.
+
+Each instance is spawned as a separate microservice process. Calls are made from several client threads of this
+process, each as a single-call batch (which is responded to directly, whatever the communication mode). Throughput
+only scales with the number of instances while there are spare CPUs to run them on.
+
+Run with:
+    python -m microservice.benchmarks.load_balancing_benchmark
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from microservice.core import communication, connection_pool, load_balancing, settings
+from microservice.core.service_waypost import init_service_waypost
+from microservice.benchmarks.server_benchmark import wait_until_ready
+
+SERVICE = 'microservice.examples.intensive_calculators.intensive_calculation_2'
+SIZE = 20000
+HOST = '127.0.0.1'
+PORT = 10950
+CLIENT_THREADS = 16
+DURATION = 5
+
+
+def spawn(port: int) -> subprocess.Popen:
+    cmd = [sys.executable, '-m', 'microservice',
+           '--service', SERVICE, '--host', HOST, '--port', str(port),
+           '--other_kwargs', json.dumps({'server_backend': 'GUNICORN', 'workers': 1, 'threads': CLIENT_THREADS})]
+    return subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def measure(duration: float) -> float:
+    def make_calls(_):
+        count = 0
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            communication.send_batch_to_service(SERVICE, None, [((SIZE,), {})])
+            count += 1
+        return count
+
+    with ThreadPoolExecutor(CLIENT_THREADS) as executor:
+        return sum(executor.map(make_calls, range(CLIENT_THREADS))) / duration
+
+
+if __name__ == "__main__":
+    init_service_waypost()
+    settings.deployment_mode = settings.DeploymentMode.SUBPROCESS
+    # The instances are given to the load balancer directly, rather than discovered from a deployment manager.
+    settings.endpoint_refresh_interval = float('inf')
+
+    print("{} CPUs".format(os.cpu_count()))
+    print("{:>9} {:>22} {:>10}".format("instances", "policy", "calls/s"))
+    for instances in [1, 2, 4]:
+        uris = ["http://{}:{}/".format(HOST, PORT + i) for i in range(instances)]
+        processes = [spawn(PORT + i) for i in range(instances)]
+        try:
+            for uri in uris:
+                wait_until_ready(uri)
+            for policy in settings.LoadBalancingPolicy:
+                settings.load_balancing_policy = policy
+                load_balancing.registry.clear()
+                load_balancing.registry.get(SERVICE, lambda service_name: uris)
+                print("{:>9} {:>22} {:>10.1f}".format(instances, policy.value, measure(DURATION)))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait(timeout=60)
+        connection_pool.pool.close_all()
@@ -0,0 +1,47 @@
+"""
+Measure how quickly request ids can be generated across many threads, and check that none of them collide.
+
+This compares:
+ - legacy: the id was `time.time()`, so calls made within the same clock tick got the same id.
+ - current: the id is a random per-process prefix plus a counter (`microservice.core.communication.generate_request_id`).
+
+Run with:
+    python -m microservice.benchmarks.request_id_benchmark
+"""
+import threading
+import time
+
+from microservice.core import communication
+
+
+def generate_concurrently(generate, threads: int, ids_per_thread: int) -> tuple:
+    """
+    :return tuple: The ids generated, and the number of seconds taken to generate them.
+    """
+    generated = []
+    start_barrier = threading.Barrier(threads + 1)
+
+    def generate_ids():
+        start_barrier.wait()
+        generated.append([generate() for _ in range(ids_per_thread)])
+
+    workers = [threading.Thread(target=generate_ids) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return [request_id for ids in generated for request_id in ids], time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    ids_per_thread = 20000
+    print("{:>8} {:>8} {:>10} {:>12} {:>12}".format("threads", "mode", "ids", "ids/s", "collisions"))
+    for threads in [1, 4, 16]:
+        for legacy in [True, False]:
+            generate = time.time if legacy else communication.generate_request_id
+            all_ids, duration = generate_concurrently(generate, threads, ids_per_thread)
+            print("{:>8} {:>8} {:>10} {:>12.0f} {:>12}".format(
+                threads, "legacy" if legacy else "current", len(all_ids), len(all_ids) / duration,
+                len(all_ids) - len(set(all_ids))))
@@ -0,0 +1,78 @@
+"""
+Measure the cost of building result keys when an ACTOR mode function with many sequential nested calls is replayed.
+
+A function making N nested calls is replayed N + 1 times (once initially, and once as each result arrives), so the
+number of result lookups made grows quadratically with N. This compares:
+ - legacy: the key was built to check whether the result was present, then built again to fetch it. The key for
+   the inbound message was built again to store the final result.
+ - current: the key is built once per call site per message (as `microservice.core.decorator` now does), and the
+   inbound message's own key is cached on the message.
+
+Run with:
+    python -m microservice.benchmarks.result_key_benchmark
+"""
+import pickle
+import time
+
+from microservice.core import communication
+
+LOCAL_SERVICE = 'microservice.benchmarks.outer'
+NESTED_SERVICE = 'microservice.examples.intensive_calculators.intensive_calculation_2'
+
+
+def legacy_create_result_key(service_name, args, kwargs):
+    return communication.ResultKey(service_name, pickle.dumps(args), pickle.dumps(kwargs))
+
+
+def replay_all(nested_calls: int, legacy: bool) -> int:
+    """
+    Carry out every replay of a function with `nested_calls` sequential nested calls.
+
+    :return int: Number of result keys built.
+    """
+    key_computations = 0
+    create_result_key = legacy_create_result_key if legacy else communication.create_result_key
+    inbound = communication.Message(args=(nested_calls,), kwargs={'depth': 1})
+    for replay in range(nested_calls + 1):
+        results = inbound.results
+        for i in range(nested_calls):
+            args, kwargs = (i, 'x' * 20), {'offset': 1, 'scale': 2}
+            result_key = create_result_key(NESTED_SERVICE, args, kwargs)
+            key_computations += 1
+            if legacy:
+                if result_key in results.keys():
+                    results[create_result_key(NESTED_SERVICE, args, kwargs)]
+                    key_computations += 1
+                    continue
+            elif result_key in results:
+                results[result_key]
+                continue
+            # The nested call is made here. Store its result, as the response from the nested service would.
+            results[result_key] = i
+            break
+        else:
+            # Every nested call has completed, so return the result.
+            if legacy:
+                create_result_key(LOCAL_SERVICE, inbound.args, inbound.kwargs)
+                key_computations += 1
+            else:
+                key_computations += LOCAL_SERVICE not in inbound._result_keys
+                inbound.result_key(LOCAL_SERVICE)
+    return key_computations
+
+
+def timed(nested_calls: int, legacy: bool, repeats: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        key_computations = replay_all(nested_calls, legacy)
+    return key_computations, (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    repeats = 500
+    print("{:>12} {:>8} {:>12} {:>14}".format("nested calls", "mode", "keys built", "time (us)"))
+    for nested_calls in [1, 5, 10, 20]:
+        for legacy in [True, False]:
+            key_computations, duration = timed(nested_calls, legacy, repeats)
+            print("{:>12} {:>8} {:>12} {:>14.1f}".format(
+                nested_calls, "legacy" if legacy else "current", key_computations, duration * 1e6))
@@ -0,0 +1,88 @@
+"""
+Compare the requests per second that a microservice can handle using each server backend.
+
+Each configuration is spawned as a separate microservice process, then loaded by several client processes calling the
+service over keep-alive connections. The services are hosted in SYN mode, so that each call is responded to with its
+result rather than only acknowledged.
+
+Run with:
+    python -m microservice.benchmarks.server_benchmark
+"""
+import json
+import multiprocessing
+import subprocess
+import sys
+import time
+
+from microservice.core import codec, communication, connection_pool
+
+SERVICE = 'microservice.examples.hello_world.hello_world'
+HOST = '127.0.0.1'
+PORT = 10900
+
+CONFIGURATIONS = [
+    ('werkzeug (current)', {'communication_mode': 'SYN'}),
+    ('gunicorn 1x8', {'communication_mode': 'SYN', 'server_backend': 'GUNICORN', 'workers': 1, 'threads': 8}),
+    ('gunicorn 4x8', {'communication_mode': 'SYN', 'server_backend': 'GUNICORN', 'workers': 4, 'threads': 8}),
+]
+
+
+def spawn(port: int, other_kwargs: dict) -> subprocess.Popen:
+    cmd = [sys.executable, '-m', 'microservice',
+           '--service', SERVICE, '--host', HOST, '--port', str(port),
+           '--other_kwargs', json.dumps(other_kwargs)]
+    return subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_ready(uri: str, timeout: float=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if connection_pool.get_session(uri).get(uri + 'ping').text == "pong":
+                return
+        except Exception:
+            time.sleep(0.1)
+    raise TimeoutError("Service at {} did not start".format(uri))
+
+
+def client(uri: str, duration: float, threads: int, counts):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def make_requests(_):
+        count = 0
+        deadline = time.monotonic() + duration
+        session = connection_pool.get_session(uri)
+        encoded = codec.dumps(communication.Message())
+        while time.monotonic() < deadline:
+            response = session.get(uri, data=encoded)
+            response.raise_for_status()
+            count += 1
+        return count
+
+    with ThreadPoolExecutor(threads) as executor:
+        counts.put(sum(executor.map(make_requests, range(threads))))
+
+
+def measure(uri: str, duration: float=5, client_processes: int=4, client_threads: int=8) -> float:
+    counts = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=client, args=(uri, duration, client_threads, counts))
+               for _ in range(client_processes)]
+    for proc in clients:
+        proc.start()
+    total = sum(counts.get() for _ in clients)
+    for proc in clients:
+        proc.join()
+    return total / duration
+
+
+if __name__ == "__main__":
+    for offset, (name, other_kwargs) in enumerate(CONFIGURATIONS):
+        port = PORT + offset
+        uri = "http://{}:{}/".format(HOST, port)
+        process = spawn(port, other_kwargs)
+        try:
+            wait_until_ready(uri)
+            print("{:<20} {:>10.0f} requests/s".format(name, measure(uri)))
+        finally:
+            connection_pool.get_session(uri).get(uri + 'terminate')
+            process.wait(timeout=60)
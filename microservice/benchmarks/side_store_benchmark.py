@@ -0,0 +1,67 @@
+"""
+Compare message size and processing time against call depth, with and without the side store.
+
+A chain of actor calls is simulated: each service calls the next with large args, and each returns a large result.
+Every message is encoded and decoded as it would be when sent between services. Values in the side store are fetched
+from this process's store, so in a real deployment each result fetched by a different service adds one request.
+
+Run with:
+    python -m microservice.benchmarks.side_store_benchmark
+"""
+import time
+
+from microservice.core import codec, communication, settings, side_store
+from microservice.core.service_waypost import init_service_waypost
+
+PAYLOAD_SIZE = 2000
+
+
+def send(msg: communication.Message, sizes: list) -> communication.Message:
+    encoded = codec.dumps(msg)
+    sizes.append(len(encoded))
+    return codec.loads(encoded)
+
+
+def run_chain(depth: int, payload: list) -> list:
+    """
+    :return list: Size of every message sent.
+    """
+    sizes = []
+    msg = communication.Message(args=(payload,))
+    # Calls down the chain.
+    for hop in range(depth):
+        msg.resolve_args()
+        msg = send(communication.construct_message_add_via(msg, payload, hop), sizes)
+    # Results back up the chain.
+    for hop in range(depth):
+        msg.resolve_args()
+        msg = send(communication.construct_message_with_result(msg, payload), sizes)
+        for result in msg.results.values():
+            side_store.resolve(result)
+    return sizes
+
+
+def benchmark(depth: int, number: int) -> tuple:
+    payload = list(range(PAYLOAD_SIZE))
+    start = time.perf_counter()
+    for _ in range(number):
+        sizes = run_chain(depth, payload)
+    elapsed = (time.perf_counter() - start) / number
+    return max(sizes), sum(sizes), elapsed
+
+
+if __name__ == "__main__":
+    init_service_waypost()
+    settings.ServiceWaypost.local_service = 'microservice.benchmarks.service'
+    settings.local_uri = settings.side_store_uri = "http://127.0.0.1:10000/"
+
+    print("{:>6} {:>11} {:>14} {:>14} {:>12}".format("depth", "side store", "largest (B)", "total (B)", "chain (ms)"))
+    for wire_codec in settings.WireCodec:
+        settings.wire_codec = wire_codec
+        print(wire_codec.value)
+        for depth in [1, 2, 4, 8, 16, 32]:
+            for enabled in [False, True]:
+                settings.side_store_enabled = enabled
+                largest, total, elapsed = benchmark(depth, number=20)
+                print("{:>6} {:>11} {:>14} {:>14} {:>12.2f}".format(
+                    depth, "on" if enabled else "off", largest, total, elapsed * 1e3))
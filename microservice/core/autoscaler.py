@@ -0,0 +1,189 @@
+"""
+Autoscaling of the replicas of each service of a deployment, driven by how congested the replicas are.
+
+Every `settings.autoscale_interval` seconds, the `/metrics` of every replica are polled for the depth of its executor
+queue and the p95 latency of its requests (see `executor.BoundedExecutor`). A service is scaled up when either is
+above its high watermark, and down when both are below their low watermarks - so the replicas of a service stay
+between just busy enough and not too congested. A service that isn't congested may still be busy, so it is never
+scaled down to fewer replicas than its busy workers would need at `settings.autoscale_utilisation_target`.
+Scaling is held off for a cooldown after each change, to give the new replicas time to take (or shed) load before the
+next decision.
+
+Services are scaled in the background, as waiting for new replicas to be ready or old ones to drain can take a while.
+Meanwhile the other services are still polled and scaled, and the service being scaled is left alone until it is done.
+
+Executors (and so these metrics) only exist in ACTOR mode.
+"""
+import logging
+import math
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Set
+
+from microservice.core import connection_pool, settings
+
+logger = logging.getLogger(__name__)
+
+# How congested the replicas of a service are. `queue_depth` is the mean over the replicas, `p95_latency` is the
+# worst of them (0 if no requests have finished recently), and `utilisation` is the fraction of their workers that
+# are busy.
+ServiceLoad = namedtuple("ServiceLoad", ['replicas', 'queue_depth', 'p95_latency', 'utilisation'])
+
+
+def fetch_executor_metrics(uri: str) -> dict:
+    """
+    :return: The executor metrics of the replica at `uri`.
+    """
+    request_uri = uri + 'metrics'
+    response = connection_pool.get_session(request_uri).get(request_uri, timeout=settings.autoscale_interval)
+    response.raise_for_status()
+    return response.json()['executor']
+
+
+class Autoscaler:
+    """
+    Scales the services of a deployment that supports `scale`, e.g. `SubprocessMicroserviceCluster`.
+    """
+
+    def __init__(self, cluster, service_names: List[str]=None, fetch_metrics=fetch_executor_metrics,
+                 replica_bounds: Dict[str, tuple]=None):
+        """
+        :param cluster: `MicroserviceCluster` to scale.
+        :param service_names: Services to scale. Defaults to every service of the deployment.
+        :param fetch_metrics: Function that returns the executor metrics of a replica, given its uri.
+        :param replica_bounds: (min, max) replicas of each service, keyed by service name. Either bound can be None,
+            and defaults to `settings.autoscale_min_replicas` or `settings.autoscale_max_replicas`.
+        """
+        self.cluster = cluster
+        self.replica_bounds = replica_bounds if replica_bounds is not None else {}
+        self.service_names = service_names
+        self.fetch_metrics = fetch_metrics
+        # When each service was last scaled.
+        self.scaled_at = {}  # type: Dict[str, float]
+        # The services being scaled.
+        self.scaling = set()  # type: Set[str]
+        self._scaling_lock = threading.Lock()
+        self._scale_executor = None  # type: ThreadPoolExecutor
+        self._stopped = threading.Event()
+        self._thread = None  # type: threading.Thread
+
+    def load(self, service_name) -> ServiceLoad:
+        uris = self.cluster.uris_for_service(service_name)
+        queue_depths = []
+        latencies = []
+        active_workers = 0
+        max_workers = 0
+        for uri in uris:
+            try:
+                metrics = self.fetch_metrics(uri)
+            except Exception as err:
+                logger.warning("Failed to fetch metrics from {uri}: {err}", extra={'uri': uri, 'err': err})
+                continue
+            if metrics is None:
+                # Not running in ACTOR mode.
+                continue
+            queue_depths.append(metrics['queue_depth'])
+            latencies.append(metrics['p95_latency'] or 0)
+            active_workers += metrics['active_workers']
+            max_workers += metrics['max_workers']
+        if not queue_depths:
+            return ServiceLoad(len(uris), None, None, None)
+        return ServiceLoad(len(uris), sum(queue_depths) / len(queue_depths), max(latencies),
+                           active_workers / max_workers)
+
+    def desired_replicas(self, service_name, load: ServiceLoad, now: float) -> int:
+        """
+        :return: The number of replicas `service_name` should have, given its `load` at time `now`.
+        """
+        if load.queue_depth is None:
+            return load.replicas
+        min_replicas, max_replicas = self.replica_bounds.get(service_name, (None, None))
+        min_replicas = min_replicas if min_replicas is not None else settings.autoscale_min_replicas
+        max_replicas = max_replicas if max_replicas is not None else settings.autoscale_max_replicas
+        since_scaled = now - self.scaled_at.get(service_name, -math.inf)
+        step = max(1, math.ceil(load.replicas * settings.autoscale_step_percent / 100))
+        if (load.queue_depth > settings.autoscale_queue_high_watermark or
+                load.p95_latency > settings.autoscale_latency_high_watermark):
+            if since_scaled >= settings.autoscale_up_cooldown:
+                return min(load.replicas + step, max(max_replicas, load.replicas))
+        elif (load.queue_depth < settings.autoscale_queue_low_watermark and
+              load.p95_latency < settings.autoscale_latency_low_watermark):
+            if since_scaled >= settings.autoscale_down_cooldown:
+                needed = math.ceil(load.replicas * load.utilisation / settings.autoscale_utilisation_target)
+                return min(max(load.replicas - step, needed, min_replicas), load.replicas)
+        return load.replicas
+
+    def step(self, now: float=None) -> Dict[str, int]:
+        """
+        Poll every service once, and start scaling those that need it. Services still being scaled are skipped.
+
+        :param now: Time to make the decisions at. Defaults to `time.monotonic()`.
+        :return: The new number of replicas of each service that is being scaled.
+        """
+        clock = time.monotonic if now is None else (lambda: now)
+        now = clock()
+        scaled = {}
+        for service_name in self.service_names or list(self.cluster.services.keys()):
+            with self._scaling_lock:
+                if service_name in self.scaling:
+                    continue
+            load = self.load(service_name)
+            replicas = self.desired_replicas(service_name, load, now)
+            if replicas == load.replicas:
+                continue
+            logger.info("Scaling {service_name} from {current} to {replicas} replicas, as queue depth is "
+                        "{queue_depth} and p95 latency is {p95_latency}",
+                        extra={'service_name': service_name, 'current': load.replicas, 'replicas': replicas,
+                               'queue_depth': load.queue_depth, 'p95_latency': load.p95_latency})
+            with self._scaling_lock:
+                if self._scale_executor is None:
+                    self._scale_executor = ThreadPoolExecutor(max_workers=settings.autoscale_scale_workers)
+                self.scaling.add(service_name)
+                self._scale_executor.submit(self.scale, service_name, replicas, clock)
+            scaled[service_name] = replicas
+        return scaled
+
+    def scale(self, service_name, replicas: int, clock: Callable[[], float]):
+        """
+        Scale `service_name` to `replicas`, starting its cooldown once done (when `clock` is called).
+        """
+        try:
+            self.cluster.scale(service_name, replicas)
+            # The cooldown starts once the new replicas are up.
+            self.scaled_at[service_name] = clock()
+        except Exception as err:
+            logger.exception("Failed to scale {service_name}: {err}", extra={'service_name': service_name, 'err': err})
+        finally:
+            with self._scaling_lock:
+                self.scaling.discard(service_name)
+
+    def wait(self):
+        """
+        Wait for the services being scaled to finish scaling.
+        """
+        with self._scaling_lock:
+            executor, self._scale_executor = self._scale_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def run(self):
+        while not self._stopped.wait(settings.autoscale_interval):
+            try:
+                self.step()
+            except Exception as err:
+                logger.exception("Autoscaling failed: {err}", extra={'err': err})
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name="autoscaler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.wait()
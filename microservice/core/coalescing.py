@@ -0,0 +1,67 @@
+"""
+Single-flight de-duplication of identical concurrent calls.
+
+Microservices declared with `@microservice(coalesce=True)` share one execution between all identical calls (i.e. calls
+with the same result key) that are in flight at the same time. The first caller carries out the call, and everyone
+else that makes the same call before it completes waits for, and is given, the same result (or exception).
+"""
+import logging
+import threading
+
+from concurrent.futures import Future
+from typing import Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Thread-safe group of in-flight calls, keyed by anything hashable.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}  # type: Dict[Hashable, Future]
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def do(self, key: Hashable, fn, not_shared: tuple=()):
+        """
+        Call `fn()`, unless an identical call is already in flight, in which case wait for that call and return its
+        result instead.
+
+        :param key: Identifies identical calls.
+        :param fn: Function to call. Use `functools.partial` to give it arguments.
+        :param tuple not_shared: Exception types that only apply to the caller that raised them. If the in-flight call
+            raises one of these, everyone waiting for it makes the call themselves instead.
+        :return: The result of the call. If the call raised an exception, that is raised instead.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not leader:
+            logger.debug("Waiting for identical call in flight: {key}", extra={'key': key})
+            try:
+                return future.result()
+            except not_shared:
+                return fn()
+
+        try:
+            result = fn()
+        except BaseException as err:
+            self._complete(key)
+            future.set_exception(err)
+            raise
+        self._complete(key)
+        future.set_result(result)
+        return result
+
+    def _complete(self, key: Hashable):
+        # Calls made from now on must be carried out again, rather than use this (possibly stale) result.
+        with self._lock:
+            del self._in_flight[key]
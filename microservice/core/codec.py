@@ -0,0 +1,222 @@
+"""
+Wire encodings for everything sent between microservices.
+
+The codec used to encode outgoing requests and responses is chosen by `settings.wire_codec`. Decoding detects the
+codec from the first byte of the payload, so services using different codecs can still talk to each other.
+
+Two codecs are provided:
+ - PICKLE: The whole object is pickled. Works for anything, but is bulky and ties the wire format to python class
+   paths.
+ - MSGPACK: A compact msgpack encoding of `Message` (and its `ViaHeader`s, `ResultKey`s and `StoredRef`s). Any
+   values that msgpack can't represent natively (exceptions, custom classes, etc.) fall back to being pickled inside
+   the msgpack frame.
+
+Streamed results are sent as a sequence of frames (see `dumps_frame` and `iter_frames`), each of which is a header
+giving the kind of frame and the length of its payload, followed by the payload encoded as above.
+"""
+import msgpack
+import pickle
+import struct
+
+from typing import Dict, Iterable, Iterator, Tuple
+
+from microservice.core import settings
+
+
+class Codec:
+    """
+    Interface for a wire codec.
+
+    `marker` is prefixed to every payload produced by `dumps` so that `loads` can identify which codec to use. A codec
+    with no marker is the fallback, used to decode any payload that doesn't start with a known marker.
+    """
+    marker = None  # type: bytes
+
+    def dumps(self, obj) -> bytes:
+        raise NotImplementedError()
+
+    def loads(self, data: bytes):
+        raise NotImplementedError()
+
+
+class PickleCodec(Codec):
+    def dumps(self, obj) -> bytes:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data: bytes):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(Codec):
+    # 0xc1 is never used by the msgpack format, so can't be confused with the start of a real msgpack payload.
+    marker = b'\xc1'
+
+    EXT_PICKLE = 1
+    EXT_TUPLE = 2
+    EXT_MESSAGE = 3
+    EXT_VIA_HEADER = 4
+    EXT_RESULT_KEY = 5
+    EXT_STORED_REF = 6
+
+    def __init__(self):
+        # Populated on first use to avoid a circular import - communication uses this module to send messages.
+        self._message_types = None
+
+    @property
+    def message_types(self) -> tuple:
+        if self._message_types is None:
+            from microservice.core.communication import Message, ResultKey, ViaHeader
+            from microservice.core.side_store import StoredRef
+            self._message_types = Message, ResultKey, ViaHeader, StoredRef
+        return self._message_types
+
+    def _pack(self, obj) -> bytes:
+        # `strict_types` makes sure that tuples (including namedtuples) and subclasses of the builtin types are
+        # passed to `_default` rather than silently being turned into lists/dicts.
+        return msgpack.packb(obj, default=self._default, use_bin_type=True, strict_types=True)
+
+    def _unpack(self, data: bytes):
+        return msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False, strict_map_key=False)
+
+    def _pack_message(self, msg) -> bytes:
+        """
+        Messages are packed with a fixed layout rather than field by field so that:
+         - via headers don't each need their own extension frame
+         - results are grouped by service name, so each service name is only sent once
+        """
+        results = {}
+        for key, result in msg.results.items():
+            results.setdefault(key.service_name, []).append([key.args, key.kwargs, result])
+        return self._pack([
+            msg.args,
+            msg.kwargs,
+            [[v.service_name, v.args, v.kwargs] for v in msg.via],
+            results,
+            msg.request_id,
+        ])
+
+    def _unpack_message(self, data: bytes):
+        Message, ResultKey, ViaHeader, StoredRef = self.message_types
+        args, kwargs, via, grouped_results, request_id = self._unpack(data)
+        results = {}
+        for service_name, service_results in grouped_results.items():
+            for key_args, key_kwargs, result in service_results:
+                results[ResultKey(service_name, key_args, key_kwargs)] = result
+        return Message(args=args, kwargs=kwargs, via=via, results=results, request_id=request_id)
+
+    def _default(self, obj):
+        Message, ResultKey, ViaHeader, StoredRef = self.message_types
+        obj_type = type(obj)
+        if obj_type is tuple:
+            return msgpack.ExtType(self.EXT_TUPLE, self._pack(list(obj)))
+        if obj_type is Message:
+            return msgpack.ExtType(self.EXT_MESSAGE, self._pack_message(obj))
+        if obj_type is ResultKey:
+            return msgpack.ExtType(self.EXT_RESULT_KEY, self._pack(list(obj)))
+        if obj_type is ViaHeader:
+            return msgpack.ExtType(self.EXT_VIA_HEADER, self._pack(list(obj)))
+        if obj_type is StoredRef:
+            return msgpack.ExtType(self.EXT_STORED_REF, self._pack(list(obj)))
+        return msgpack.ExtType(self.EXT_PICKLE, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _ext_hook(self, code, data):
+        Message, ResultKey, ViaHeader, StoredRef = self.message_types
+        if code == self.EXT_TUPLE:
+            return tuple(self._unpack(data))
+        if code == self.EXT_MESSAGE:
+            return self._unpack_message(data)
+        if code == self.EXT_RESULT_KEY:
+            return ResultKey(*self._unpack(data))
+        if code == self.EXT_VIA_HEADER:
+            return ViaHeader(*self._unpack(data))
+        if code == self.EXT_STORED_REF:
+            return StoredRef(*self._unpack(data))
+        if code == self.EXT_PICKLE:
+            return pickle.loads(data)
+        return msgpack.ExtType(code, data)
+
+    def dumps(self, obj) -> bytes:
+        return self.marker + self._pack(obj)
+
+    def loads(self, data: bytes):
+        return self._unpack(data[len(self.marker):])
+
+
+codecs = {
+    settings.WireCodec.PICKLE: PickleCodec(),
+    settings.WireCodec.MSGPACK: MsgpackCodec(),
+}  # type: Dict[settings.WireCodec, Codec]
+
+
+def register_codec(wire_codec, codec: Codec):
+    """
+    Make an additional codec available for selection using `settings.wire_codec`.
+
+    :param wire_codec: Key to select this codec by.
+    :param Codec codec: The codec. Must have a `marker` that isn't used by any other codec.
+    """
+    if codec.marker is None or any(c.marker == codec.marker for c in codecs.values()):
+        raise ValueError("Codec must have a unique marker.")
+    codecs[wire_codec] = codec
+
+
+def codec_for_payload(data: bytes) -> Codec:
+    fallback = None
+    for codec in codecs.values():
+        if codec.marker is None:
+            fallback = codec
+        elif data.startswith(codec.marker):
+            return codec
+    return fallback
+
+
+def dumps(obj) -> bytes:
+    """
+    Encode `obj` using the codec configured by `settings.wire_codec`.
+    """
+    return codecs[settings.wire_codec].dumps(obj)
+
+
+def loads(data: bytes):
+    """
+    Decode `data`, which may have been encoded by any registered codec.
+    """
+    return codec_for_payload(data).loads(data)
+
+
+# Kinds of frame in a stream.
+FRAME_ITEM = 0
+FRAME_ERROR = 1
+
+# Kind of frame (1 byte), then length of the payload (4 bytes, big endian).
+frame_header = struct.Struct('>BI')
+
+
+def dumps_frame(obj, kind: int=FRAME_ITEM) -> bytes:
+    """
+    Encode `obj` as a single frame of a stream.
+    """
+    payload = dumps(obj)
+    return frame_header.pack(kind, len(payload)) + payload
+
+
+def iter_frames(chunks: Iterable[bytes]) -> Iterator[Tuple[int, object]]:
+    """
+    Decode a stream of frames.
+
+    :param chunks: The stream, split into chunks of any size (e.g. as received over HTTP).
+    :return: Iterator of (kind, obj) for each frame, yielded as soon as the whole frame has been received.
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= frame_header.size:
+            kind, length = frame_header.unpack_from(buffer)
+            end = frame_header.size + length
+            if len(buffer) < end:
+                break
+            obj = loads(bytes(buffer[frame_header.size:end]))
+            del buffer[:end]
+            yield kind, obj
+    if buffer:
+        raise ValueError("Stream ended part way through a frame.")
@@ -1,12 +1,18 @@
+import asyncio
+import contextlib
+import itertools
 import logging
+import os
 import pickle
+import random
 import requests
+import threading
 import time
 
 from collections import namedtuple
-from typing import List
+from typing import Iterator, List
 
-from microservice.core import kube, settings
+from microservice.core import codec, connection_pool, kube, kube_endpoints, load_balancing, settings, side_store
 
 logger = logging.getLogger(__name__)
 
@@ -15,19 +21,101 @@ class ServiceCallPerformed(Exception):
     pass
 
 
+class NestedCallNotSupported(NotImplementedError):
+    """
+    A microservice made a nested call while responding directly to its caller (i.e. in a batch or stream) in ACTOR
+    mode. The result of a nested call is delivered by replaying the message, which can't be done then.
+    """
+    pass
+
+
+class ServiceRequestFailed(Exception):
+    """
+    A service responded to a request with an error, or was still busy once `settings.backpressure_retries` ran out.
+    """
+
+    def __init__(self, service_name: str, status_code: int, reason: str=None):
+        super(ServiceRequestFailed, self).__init__("Request to {} failed with status {}: {}".format(
+            service_name, status_code, reason))
+        self.service_name = service_name
+        self.status_code = status_code
+
+
 ResultKey = namedtuple("ResultKey", ['service_name', 'args', 'kwargs'])
 ViaHeader = namedtuple("ViaHeader", ['service_name', 'args', 'kwargs'])
 
 
-def create_result_key(service_name, args, kwargs):
+def create_result_key(service_name, args, kwargs) -> ResultKey:
+    """
+    Create the key that the result of calling `service_name` with `args` and `kwargs` is stored under.
+
+    Keyword arguments are put in a canonical (sorted) order first, so that the same call always has the same key
+    regardless of the order the keyword arguments were given in.
+
+    This requires serializing the arguments, so callers should compute the key once and re-use it rather than calling
+    this for every lookup.
+    """
+    if len(kwargs) > 1:
+        try:
+            kwargs = dict(sorted(kwargs.items()))
+        except TypeError:
+            # Keys that can't be ordered can't come from a python function call, so any consistent order will do.
+            pass
     return ResultKey(service_name, pickle.dumps(args), pickle.dumps(kwargs))
 
 
-def generate_request_id():
-    return time.time()
+class RequestIDGenerator:
+    """
+    Generates request ids that are unique across threads, processes and hosts.
+
+    Each id is a random per-process prefix followed by a counter, both in hex, e.g. "5f0e6a4b1c2d3e4f-1a".
+    Ids are strings so that they are hashed once, are sent natively by every codec, and read easily in logs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new sequence of ids with a new prefix. This happens in child processes after a fork (detected from
+        the process id changing), so that they don't generate the same ids as their parent.
+        """
+        prefix = "{:016x}-".format(random.SystemRandom().getrandbits(64))
+        # `next` on an `itertools.count` is atomic, so no lock is needed to share this between threads. The prefix
+        # and counter are swapped together, so that ids are never made from the prefix of one sequence and the
+        # counter of another.
+        self._sequence = (prefix, itertools.count(1))
+        self._pid = os.getpid()
+
+    @property
+    def prefix(self) -> str:
+        return self._sequence[0]
+
+    def __call__(self) -> str:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.reset()
+        prefix, counter = self._sequence
+        return prefix + format(next(counter), 'x')
+
+
+request_id_generator = RequestIDGenerator()
+
+
+def generate_request_id() -> str:
+    return request_id_generator()
 
 
 class Message:
+    """
+    Request (or response) sent between microservices.
+
+    If the side store is enabled, `args`, `kwargs`, the args/kwargs of each via header, and each result may be a
+    `side_store.StoredRef` rather than the value itself. See `resolve_args`.
+    """
+
     def __init__(self, args=None, kwargs=None, via=None, results=None, request_id=None):
         self.args = args if args is not None else tuple()
         self.kwargs = kwargs if kwargs is not None else dict()
@@ -39,6 +127,22 @@ class Message:
         else:
             self.via = []
 
+        # Cache of result keys for this message's own args/kwargs, keyed by service name. See `result_key`.
+        self._result_keys = {}
+        # Results fetched from the side store while handling this message, keyed by result key. See `resolved_result`.
+        self._resolved_results = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_result_keys']
+        del state['_resolved_results']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._result_keys = {}
+        self._resolved_results = {}
+
     @classmethod
     def from_dict(cls, msg_dict: dict):
         return cls(**msg_dict)
@@ -78,6 +182,41 @@ class Message:
         key = create_result_key(service_name, args, kwargs)
         return self.results[key]
 
+    def resolved_result(self, result_key: ResultKey):
+        """
+        :return: The result for `result_key`, fetched from the side store if it is there. Each result is only fetched
+            once per message, and `results` keeps the reference, so that only the reference is sent on.
+        :raises KeyError: If there is no result for `result_key`.
+        :raises side_store.SideStoreExpired: If the result was in the side store, and has expired.
+        """
+        result = self.results[result_key]
+        if type(result) is not side_store.StoredRef:
+            return result
+        resolved = self._resolved_results.get(result_key)
+        if resolved is None or resolved[0] != result:
+            resolved = (result, side_store.resolve(result))
+            self._resolved_results[result_key] = resolved
+        return resolved[1]
+
+    def resolve_args(self):
+        """
+        Replace `args` and `kwargs` with the values they refer to, if they are in the side store.
+        """
+        self.args = side_store.resolve(self.args)
+        self.kwargs = side_store.resolve(self.kwargs)
+        self._result_keys = {}
+
+    def result_key(self, service_name) -> ResultKey:
+        """
+        :return: The result key for a call to `service_name` with the args and kwargs of this message.
+            This is only calculated once per message.
+        """
+        key = self._result_keys.get(service_name)
+        if key is None:
+            key = create_result_key(service_name, self.args, self.kwargs)
+            self._result_keys[service_name] = key
+        return key
+
     def __eq__(self, other):
         if not isinstance(other, Message):
             return False
@@ -105,27 +244,51 @@ class Message:
         return parsed_results
 
 
-def uri_from_service_name(service_name: str) -> str:
+def uris_from_service_name(service_name: str) -> List[str]:
+    """
+    Discover the uri of every instance of `service_name`.
+    """
     if settings.deployment_mode == settings.DeploymentMode.KUBERNETES:
-        return kube.uri_for_service(service_name)
+        if settings.kube_discovery_mode == settings.KubeDiscoveryMode.ENDPOINTS:
+            return kube_endpoints.get_watcher().uris_for_service(service_name)
+        return [kube.uri_for_service(service_name)]
     elif settings.deployment_mode == settings.DeploymentMode.SUBPROCESS:
         if settings.ServiceWaypost.deployment is not None:
             # We are running as the deployment manager.
-            uri = settings.ServiceWaypost.deployment.uri_for_service(service_name)
-        elif service_name not in settings.ServiceWaypost.service_uris.keys():
-            # We are running as a subprocess service and we haven't cached the uri for `service_name`
-            request_uri = settings.ServiceWaypost.deployment_manager_uri + 'uri/' + service_name
-            uri = requests.get(request_uri).text
-            logger.info("Discovered subprocess service uri for {service_name} as: {service_uri}",
-                        extra={'service_name': service_name, 'service_uri': uri})
-            settings.ServiceWaypost.service_uris[service_name] = uri
-        else:
-            # We are running as a subprocess service and we have already cached the uri for `service_name`
-            uri = settings.ServiceWaypost.service_uris[service_name]
-        return uri
+            return settings.ServiceWaypost.deployment.uris_for_service(service_name)
+        # We are running as a subprocess service, so ask the deployment manager.
+        request_uri = settings.ServiceWaypost.deployment_manager_uri + 'uri/' + service_name
+        uris = connection_pool.get_session(request_uri).get(request_uri).json()
+        logger.debug("Discovered subprocess service uris for {service_name} as: {service_uris}",
+                     extra={'service_name': service_name, 'service_uris': uris})
+        return uris
     raise ValueError("Invalid deployment_mode.")
 
 
+def service_endpoints(service_name: str) -> load_balancing.ServiceEndpoints:
+    """
+    :return: The instances of `service_name`, discovering them if they haven't been recently.
+    """
+    return load_balancing.registry.get(service_name, uris_from_service_name)
+
+
+async def service_endpoints_async(service_name: str) -> load_balancing.ServiceEndpoints:
+    """
+    Equivalent of `service_endpoints` that discovers services in the default executor, as discovery blocks on
+    requests to the deployment manager or kubernetes.
+    """
+    if load_balancing.registry.needs_discovery(service_name):
+        return await asyncio.get_event_loop().run_in_executor(None, service_endpoints, service_name)
+    return service_endpoints(service_name)
+
+
+def uri_from_service_name(service_name: str) -> str:
+    """
+    :return: Uri of the instance of `service_name` to send the next request to.
+    """
+    return service_endpoints(service_name).choose().uri
+
+
 def get_local_uri() -> str:
     """
     :return: The local uri, if specified, otherwise the local service name.
@@ -136,18 +299,143 @@ def get_local_uri() -> str:
     return settings.ServiceWaypost.local_service
 
 
-def send_object_to_service(service_name: str, obj) -> tuple:
-    logger.debug("Sending object to service: {service_name}: {obj}", extra={'service_name': service_name, 'obj': obj})
-    pickled = pickle.dumps(obj)
+def uri_for_target(service_name: str) -> str:
+    """
+    :param str service_name: Either the name of a service, or a uri (as used in via headers for interfaces).
+    :return str: Uri to send requests for `service_name` to.
+    """
     if service_name.startswith('http'):
         logger.debug("Via header service name is already a URI")
         uri = service_name
     else:
         uri = uri_from_service_name(service_name)
     logger.debug("Service is found at: {service_uri}", extra={'service_uri': uri})
-    result = requests.get(uri, data=pickled)
-    if result:
-        result = pickle.loads(result.content)
+    return uri
+
+
+# Status codes a busy service responds with to ask the caller to retry later.
+BACKPRESSURE_STATUS_CODES = (429, 503)
+
+
+def retry_delay(retry_after) -> float:
+    """
+    :param retry_after: Value of the Retry-After header of a response (in seconds), or None if there wasn't one.
+    :return float: Number of seconds to wait before retrying, capped at `settings.backpressure_max_retry_delay`.
+    """
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        # Missing, or given as a date. Fall back to the delay our own services ask for.
+        delay = settings.executor_retry_after
+    return max(0, min(delay, settings.backpressure_max_retry_delay))
+
+
+def get_with_backpressure(service_name: str, uri: str, encoded: bytes, stream: bool=False) -> requests.Response:
+    """
+    Send `encoded` to `uri`, retrying for as long as the service asks us to back off.
+
+    :param bool stream: Whether to leave the response body to be streamed rather than reading it straight away.
+    """
+    session = connection_pool.get_session(uri, service_name)
+    request_kwargs = {'stream': True} if stream else {}
+    response = session.get(uri, data=encoded, **request_kwargs)
+    for _ in range(settings.backpressure_retries):
+        if response.status_code not in BACKPRESSURE_STATUS_CODES:
+            break
+        delay = retry_delay(response.headers.get('Retry-After'))
+        logger.info("Service {service_name} is busy, retrying in {delay}s",
+                    extra={'service_name': service_name, 'delay': delay})
+        # An unread streamed response holds on to its connection until it is closed.
+        response.close()
+        time.sleep(delay)
+        response = session.get(uri, data=encoded, **request_kwargs)
+    return response
+
+
+def send_object_to_service(service_name: str, obj, path: str='') -> tuple:
+    """
+    :param str service_name: Service (or uri) to send `obj` to. Requests to a service are load balanced across its
+        instances, and sent to another instance if one can't be connected to.
+    :param obj: Object to send, usually a `Message`.
+    :param str path: Endpoint of the service to send `obj` to, relative to the service uri.
+    :return: The decoded response.
+    :raises ServiceRequestFailed: If the service responded with an error, or stayed busy.
+    """
+    logger.debug("Sending object to service: {service_name}: {obj}", extra={'service_name': service_name, 'obj': obj})
+    encoded = codec.dumps(obj)
+    if service_name.startswith('http'):
+        logger.debug("Via header service name is already a URI")
+        result = get_with_backpressure(service_name, service_name + path, encoded)
+    else:
+        endpoints = service_endpoints(service_name)
+        tried = []
+        while True:
+            try:
+                with endpoints.request(exclude=tried) as endpoint:
+                    logger.debug("Service is found at: {service_uri}", extra={'service_uri': endpoint.uri})
+                    result = get_with_backpressure(service_name, endpoint.uri + path, encoded)
+                    endpoint.report_load(result.headers.get(settings.load_report_header))
+                break
+            except load_balancing.CONNECTION_ERRORS:
+                tried.append(endpoint)
+                if len(tried) >= len(endpoints):
+                    raise
+                logger.warning("Failed to connect to {service_uri}, trying another instance",
+                               extra={'service_uri': endpoint.uri})
+    if not result:
+        # Redirects have already been followed, so this is any status other than 2xx.
+        raise ServiceRequestFailed(service_name, result.status_code, result.reason)
+    result = codec.loads(result.content)
+    logger.debug("Got result: {result}", extra={'result': result})
+    return result
+
+
+async def send_object_to_service_async(service_name: str, obj):
+    """
+    Equivalent of `send_object_to_service` that doesn't block the event loop while waiting for the response.
+
+    :raises ServiceRequestFailed: If the service responded with an error, or stayed busy.
+    """
+    logger.debug("Sending object to service: {service_name}: {obj}", extra={'service_name': service_name, 'obj': obj})
+    encoded = codec.dumps(obj)
+    if service_name.startswith('http'):
+        return await get_with_backpressure_async(service_name, service_name, encoded)
+
+    endpoints = await service_endpoints_async(service_name)
+    tried = []
+    while True:
+        try:
+            with endpoints.request(exclude=tried) as endpoint:
+                return await get_with_backpressure_async(service_name, endpoint.uri, encoded, endpoint)
+        except load_balancing.CONNECTION_ERRORS:
+            tried.append(endpoint)
+            if len(tried) >= len(endpoints):
+                raise
+            logger.warning("Failed to connect to {service_uri}, trying another instance",
+                           extra={'service_uri': endpoint.uri})
+
+
+async def get_with_backpressure_async(service_name: str, uri: str, encoded: bytes,
+                                      endpoint: load_balancing.Endpoint=None):
+    """
+    :param endpoint: Instance `uri` belongs to, which is told the load reported in each response.
+    """
+    session = connection_pool.get_async_session()
+    for attempt in range(settings.backpressure_retries + 1):
+        async with session.get(uri, data=encoded) as response:
+            content = await response.read()
+            if endpoint is not None:
+                endpoint.report_load(response.headers.get(settings.load_report_header))
+            if response.status in BACKPRESSURE_STATUS_CODES and attempt < settings.backpressure_retries:
+                delay = retry_delay(response.headers.get('Retry-After'))
+                logger.info("Service {service_name} is busy, retrying in {delay}s",
+                            extra={'service_name': service_name, 'delay': delay})
+            elif not 200 <= response.status < 300:
+                raise ServiceRequestFailed(service_name, response.status, response.reason)
+            else:
+                result = codec.loads(content)
+                break
+        await asyncio.sleep(delay)
     logger.debug("Got result: {result}", extra={'result': result})
     return result
 
@@ -163,23 +451,21 @@ def construct_message_with_result(inbound_message: Message, result) -> Message:
         results=results,
         request_id=inbound_message.request_id,
     )
-    msg.add_result(settings.ServiceWaypost.local_service,
-                   inbound_message.args,
-                   inbound_message.kwargs,
-                   result)
+    result_key = inbound_message.result_key(settings.ServiceWaypost.local_service)
+    msg.results[result_key] = side_store.store_if_large(result)
     logger.debug("Constructed message with result: {microservice_message}", extra={'microservice_message': msg})
     return msg
 
 
 def construct_message_add_via(inbound_message: Message, *args, **kwargs) -> Message:
     if inbound_message:
-        via = inbound_message.via
-        via.append(ViaHeader(
+        # Copied, so that several calls can be sent on from the same inbound message (see `fan_out.gather`).
+        via = inbound_message.via + [ViaHeader(
             get_local_uri(),
-            inbound_message.args,
-            inbound_message.kwargs,
-        ))
-        results = inbound_message.results
+            side_store.store_if_large(inbound_message.args),
+            side_store.store_if_large(inbound_message.kwargs),
+        )]
+        results = inbound_message.results.copy()
         request_id = inbound_message.request_id
     else:
         logger.warning("Shouldn't ever be here, I think...")
@@ -202,3 +488,95 @@ def construct_and_send_call_to_service(target_service: str, inbound_message: Mes
     logger.debug("Sending message to service.")
     msg = construct_message_add_via(inbound_message, *args, **kwargs)
     return send_object_to_service(target_service, msg)
+
+
+def send_batch_to_service(target_service: str, inbound_message: Message, calls: list) -> list:
+    """
+    Carry out several calls to `target_service` using a single request.
+
+    :param str target_service: Service to call.
+    :param Message inbound_message: Message currently being handled, if any. The calls are made as part of its request.
+    :param list calls: (args, kwargs) of each call to make.
+    :return list: Result of each call, in order. The result of a call that raised an exception is that exception.
+    """
+    request_id = inbound_message.request_id if inbound_message is not None else generate_request_id()
+    messages = [Message(args=args, kwargs=kwargs, request_id=request_id) for args, kwargs in calls]
+    logger.debug("Sending batch of {count} calls to service: {service_name}",
+                 extra={'count': len(messages), 'service_name': target_service})
+    results = send_object_to_service(target_service, messages, path='batch')
+    if not isinstance(results, list):
+        raise RuntimeError("Batch request to {} failed: {}".format(target_service, results))
+    return results
+
+
+def stream_from_service(target_service: str, inbound_message: Message, *args, **kwargs) -> Iterator:
+    """
+    Call `target_service`, streaming its result.
+
+    The request is sent straight away, but the result is only received as the returned iterator is consumed.
+    Streams are load balanced like any other request, and count as outstanding on their endpoint until the iterator
+    is exhausted or closed.
+
+    :param str target_service: Service to call.
+    :param Message inbound_message: Message currently being handled, if any. The call is made as part of its request.
+    :return: Iterator over the items streamed by the service.
+    :raises ServiceRequestFailed: If the service responded with an error, or stayed busy.
+    """
+    request_id = inbound_message.request_id if inbound_message is not None else None
+    encoded = codec.dumps(Message(args=args, kwargs=kwargs, request_id=request_id))
+    logger.debug("Streaming from service: {service_name}", extra={'service_name': target_service})
+    if target_service.startswith('http'):
+        return iter_stream(open_stream(target_service, target_service, encoded))
+
+    endpoints = service_endpoints(target_service)
+    tried = []
+    while True:
+        try:
+            with contextlib.ExitStack() as stack:
+                endpoint = stack.enter_context(endpoints.request(exclude=tried))
+                logger.debug("Service is found at: {service_uri}", extra={'service_uri': endpoint.uri})
+                response = open_stream(target_service, endpoint.uri, encoded)
+                endpoint.report_load(response.headers.get(settings.load_report_header))
+                # Keep the request outstanding on the endpoint until the stream is finished with.
+                return iter_stream(response, stack.pop_all())
+        except load_balancing.CONNECTION_ERRORS:
+            tried.append(endpoint)
+            if len(tried) >= len(endpoints):
+                raise
+            logger.warning("Failed to connect to {service_uri}, trying another instance",
+                           extra={'service_uri': endpoint.uri})
+
+
+def open_stream(service_name: str, service_uri: str, encoded: bytes) -> requests.Response:
+    """
+    :return: The response to a stream request, with its body not yet read.
+    :raises ServiceRequestFailed: If the service responded with an error, or stayed busy.
+    """
+    response = get_with_backpressure(service_name, service_uri + 'stream', encoded, stream=True)
+    if not response:
+        response.close()
+        raise ServiceRequestFailed(service_name, response.status_code, response.reason)
+    return response
+
+
+def iter_stream(response, request: contextlib.ExitStack=None) -> Iterator:
+    """
+    :param response: Streamed response to read items from.
+    :param request: Context of the request to the endpoint the response came from, exited once the stream is done.
+    """
+    try:
+        for kind, obj in codec.iter_frames(response.iter_content(chunk_size=None)):
+            if kind == codec.FRAME_ERROR:
+                raise obj
+            yield obj
+    finally:
+        # Closing the response part way through the stream stops the service generating any more.
+        response.close()
+        if request is not None:
+            request.close()
+
+
+async def construct_and_send_call_to_service_async(target_service: str, inbound_message: Message, *args, **kwargs):
+    logger.debug("Sending message to service asynchronously.")
+    msg = construct_message_add_via(inbound_message, *args, **kwargs)
+    return await send_object_to_service_async(target_service, msg)
@@ -0,0 +1,208 @@
+"""
+Per-process pool of keep-alive HTTP sessions used for all inter-service communication.
+
+Each target origin (scheme, host and port) gets its own `requests.Session` so that consecutive messages to the same
+service re-use an already established TCP connection rather than opening (and tearing down) a new one per hop.
+Sessions that haven't been used for `settings.connection_pool_idle_timeout` seconds are closed to release their
+sockets, unless they still have requests in progress (e.g. a stream that is still being read). Sessions are never shared with forked child processes (e.g. gunicorn workers), as the underlying sockets
+can't be safely used by two processes.
+
+Requests made from asyncio code use a single `aiohttp.ClientSession` per event loop instead, see `get_async_session`.
+"""
+import aiohttp
+import asyncio
+import logging
+import os
+import requests
+import threading
+import time
+import weakref
+
+from requests.adapters import HTTPAdapter
+from typing import Dict
+from urllib.parse import urlsplit
+
+from microservice.core import settings
+
+logger = logging.getLogger(__name__)
+
+
+def origin_from_uri(uri: str) -> str:
+    """
+    :param str uri: Full uri, e.g. "http://127.0.0.1:10000/ping"
+    :return str: The origin of the uri, e.g. "http://127.0.0.1:10000"
+    """
+    parts = urlsplit(uri)
+    return "{}://{}".format(parts.scheme, parts.netloc)
+
+
+class PooledSession(requests.Session):
+    """
+    Session that counts the requests in progress on it, so that it isn't closed while they are.
+
+    Streamed responses are in progress until they are closed, so should always be closed once finished with.
+    """
+
+    def __init__(self):
+        super(PooledSession, self).__init__()
+        self.active_requests = 0
+        self._active_lock = threading.Lock()
+
+    def _release(self):
+        with self._active_lock:
+            self.active_requests -= 1
+
+    def request(self, method, url, *args, **kwargs):
+        with self._active_lock:
+            self.active_requests += 1
+        try:
+            response = super(PooledSession, self).request(method, url, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        if not kwargs.get('stream'):
+            self._release()
+            return response
+
+        close = response.close
+        released = threading.Event()
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released.is_set():
+                    released.set()
+                    self._release()
+
+        response.close = close_and_release
+        return response
+
+
+class ConnectionPool:
+    """
+    Thread-safe collection of keep-alive sessions, keyed by target origin.
+    """
+
+    def __init__(self):
+        self._sessions = {}  # type: Dict[str, requests.Session]
+        self._last_used = {}  # type: Dict[str, float]
+        self._lock = threading.Lock()
+        self._last_cleanup = time.monotonic()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def pool_size_for_service(service_name: str) -> int:
+        return settings.connection_pool_sizes.get(service_name, settings.connection_pool_size)
+
+    def _create_session(self, service_name: str) -> requests.Session:
+        pool_size = self.pool_size_for_service(service_name)
+        session = PooledSession()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        logger.debug("Created connection pool of size {pool_size} for {service_name}",
+                     extra={'pool_size': pool_size, 'service_name': service_name})
+        return session
+
+    def get_session(self, uri: str, service_name: str=None) -> PooledSession:
+        """
+        Get the session to use to talk to `uri`, creating it if this is the first request to that origin.
+
+        :param str uri: Uri that is about to be requested.
+        :param str service_name: Name of the service found at `uri`. Used to look up the configured pool size.
+        :return: Session with keep-alive connections to the origin of `uri`.
+        """
+        origin = origin_from_uri(uri)
+        now = time.monotonic()
+        with self._lock:
+            if self._pid != os.getpid():
+                # This is a forked child - forget (without closing) the parent's sessions.
+                self._pid = os.getpid()
+                self._sessions = {}
+                self._last_used = {}
+            session = self._sessions.get(origin)
+            if session is None:
+                session = self._create_session(service_name if service_name is not None else origin)
+                self._sessions[origin] = session
+            self._last_used[origin] = now
+
+        if now - self._last_cleanup > settings.connection_pool_idle_timeout:
+            self.close_idle_sessions()
+        return session
+
+    def close_idle_sessions(self, idle_timeout: float=None) -> int:
+        """
+        Close every session that hasn't been used within `idle_timeout` seconds, and has no requests in progress.
+
+        :param float idle_timeout: Defaults to `settings.connection_pool_idle_timeout`.
+        :return int: Number of sessions closed.
+        """
+        idle_timeout = idle_timeout if idle_timeout is not None else settings.connection_pool_idle_timeout
+        now = time.monotonic()
+        with self._lock:
+            self._last_cleanup = now
+            idle_origins = [origin for origin, last_used in self._last_used.items()
+                            if now - last_used > idle_timeout and not self._sessions[origin].active_requests]
+            idle_sessions = [self._sessions.pop(origin) for origin in idle_origins]
+            for origin in idle_origins:
+                del self._last_used[origin]
+
+        for session in idle_sessions:
+            session.close()
+        if idle_origins:
+            logger.debug("Closed idle connections to: {origins}", extra={'origins': idle_origins})
+        return len(idle_sessions)
+
+    def close_all(self):
+        """
+        Close every session, including those with requests in progress.
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+            self._last_used = {}
+        for session in sessions:
+            session.close()
+
+
+pool = ConnectionPool()
+
+
+def get_session(uri: str, service_name: str=None) -> PooledSession:
+    return pool.get_session(uri, service_name)
+
+
+# Weakly keyed so that sessions don't keep finished event loops alive.
+async_sessions = weakref.WeakKeyDictionary()  # type: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession]
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    """
+    Get the non-blocking session for the running event loop, creating it if necessary.
+
+    aiohttp sessions are bound to the event loop they are created in, so there is one per loop rather than one per
+    origin. Connections are still kept alive and re-used per origin by the session's connector.
+    """
+    loop = asyncio.get_event_loop()
+    session = async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=settings.async_connection_limit,
+            keepalive_timeout=settings.connection_pool_idle_timeout,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        async_sessions[loop] = session
+    return session
+
+
+async def close_async_session():
+    """
+    Close the non-blocking session for the running event loop. Call this before the event loop is closed.
+    """
+    session = async_sessions.pop(asyncio.get_event_loop(), None)
+    if session is not None:
+        await session.close()
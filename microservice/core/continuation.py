@@ -0,0 +1,190 @@
+"""
+Continuations, which carry on with a microservice from where it left off when the result of a nested call arrives,
+enabled with `@microservice(continuation=True)`.
+
+In ACTOR mode, a nested call stops the function (by raising `ServiceCallPerformed`), and the whole function is
+replayed from the top once the result arrives, using the results of the calls it has already made. So a function
+making N nested calls in turn is carried out N + 1 times, and any work done before the last call is repeated.
+
+Continuation microservices are instead generator functions, which yield each nested call (made with `.defer`) and are
+sent its result:
+
+    @microservice(continuation=True)
+    def my_func(x):
+        y = expensive_calculation(x)
+        a = yield my_service.defer(y)
+        b = yield my_service2.defer(a)
+        return a + b
+
+When a yielded call is sent to another service, the generator is suspended by this service, and resumed with the
+result when it arrives. If the result arrives at a different instance of the service, or the generator has been
+discarded (see `settings.continuation_ttl` and `settings.continuation_max_suspended`), the function is replayed as
+usual instead - so the results of every call are still carried in the messages. In other modes, each yielded call is
+made straight away.
+"""
+import inspect
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from microservice.core import communication, settings
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredCall:
+    """
+    Call to a microservice, to be made by yielding it from a continuation microservice.
+    """
+
+    def __init__(self, service, args: tuple, kwargs: dict):
+        """
+        :param service: The `@microservice` decorated function to call.
+        """
+        self.service = service
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.service(*self.args, **self.kwargs)
+
+    def __repr__(self):
+        return "{}({}, {}, {})".format(self.__class__.__name__, self.service.definition.name, self.args, self.kwargs)
+
+    def result_key(self) -> communication.ResultKey:
+        return communication.create_result_key(self.service.definition.name, self.args, self.kwargs)
+
+    def ready(self, message: communication.Message) -> bool:
+        """
+        :return bool: Whether `message` has what is needed to carry on after this call.
+        """
+        return self.result_key() in message.results
+
+
+class SuspendedCalls:
+    """
+    Generators of continuation microservices waiting for the result of a nested call, keyed by the message they are
+    handling (see `frame_key`).
+    """
+
+    def __init__(self):
+        self._suspended = OrderedDict()
+        self._lock = threading.Lock()
+        self.resumed = 0
+        self.discarded = 0
+
+    def __len__(self):
+        return len(self._suspended)
+
+    def suspend(self, key: tuple, generator, call: DeferredCall):
+        """
+        Keep `generator` until the result of `call` arrives.
+        """
+        now = time.monotonic()
+        discarded = []
+        with self._lock:
+            self._suspended[key] = (now + settings.continuation_ttl, generator, call)
+            self._suspended.move_to_end(key)
+            while self._suspended:
+                oldest_key, (expires_at, oldest, _) = next(iter(self._suspended.items()))
+                if expires_at >= now and len(self._suspended) <= settings.continuation_max_suspended:
+                    break
+                del self._suspended[oldest_key]
+                discarded.append(oldest)
+            self.discarded += len(discarded)
+        for generator in discarded:
+            generator.close()
+
+    def resume(self, key: tuple, message: communication.Message) -> tuple:
+        """
+        :return: (generator, call) suspended under `key`, if `call` is ready to carry on with `message`.
+            Otherwise (None, None), and the function must be replayed.
+        """
+        with self._lock:
+            generator, call = self._suspended.pop(key, (None, None, None))[1:]
+            if generator is not None and call.ready(message):
+                self.resumed += 1
+                return generator, call
+        if generator is not None:
+            generator.close()
+        return None, None
+
+    def clear(self):
+        with self._lock:
+            generators = [generator for _, generator, _ in self._suspended.values()]
+            self._suspended.clear()
+        for generator in generators:
+            generator.close()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'suspended': len(self._suspended),
+                'resumed': self.resumed,
+                'discarded': self.discarded,
+            }
+
+
+# Generators suspended by this process.
+suspended_calls = SuspendedCalls()
+
+
+def frame_key(service_name: str, message: communication.Message) -> tuple:
+    """
+    Identifies the call to `service_name` that `message` is part of. Responses to nested calls have the same key as
+    the call that made them.
+    """
+    return service_name, message.request_id, len(message.via), message.result_key(service_name)
+
+
+def run(service_name: str, func, args: tuple, kwargs: dict, message: communication.Message=None):
+    """
+    Carry out the continuation microservice `func`, resuming it if it was suspended while handling `message`.
+
+    :param str service_name: Name of the microservice.
+    :param func: The undecorated (generator) function.
+    :param tuple args: Args to call the function with.
+    :param dict kwargs: Kwargs to call the function with.
+    :param message: Message being handled by this service in ACTOR mode, if any.
+    :return: The value returned by the generator.
+    :raises ServiceCallPerformed: If a nested call has been sent, and the generator suspended until its result
+        arrives.
+    """
+    key = None
+    generator = call = None
+    if settings.communication_mode == settings.CommunicationMode.ACTOR and message is not None:
+        key = frame_key(service_name, message)
+        generator, call = suspended_calls.resume(key, message)
+
+    if generator is None:
+        generator = func(*args, **kwargs)
+        if not inspect.isgenerator(generator):
+            # Nothing is ever yielded, so there is nothing to continue.
+            return generator
+    else:
+        logger.debug("Resuming {service_name} with result of {call}",
+                     extra={'service_name': service_name, 'call': call})
+
+    send, value = generator.send, None
+    while True:
+        if call is not None:
+            try:
+                value, send = call(), generator.send
+            except communication.ServiceCallPerformed:
+                if key is not None:
+                    suspended_calls.suspend(key, generator, call)
+                raise
+            except Exception as err:
+                value, send = err, generator.throw
+
+        try:
+            call = send(value)
+        except StopIteration as stop:
+            return stop.value
+
+        if not isinstance(call, DeferredCall):
+            generator.close()
+            raise TypeError("Continuation microservices can only yield calls made with `.defer`, got: {!r}"
+                            .format(call))
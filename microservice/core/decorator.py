@@ -1,12 +1,24 @@
+import asyncio
+import functools
+import inspect
 import logging
 import sys
+import threading
 
-from microservice.core import settings, communication, utils
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Iterable, Iterator
+
+from microservice.core import settings, communication, continuation as continuations, fan_out, utils
+from microservice.core import executor as process_executor
+from microservice.core.coalescing import SingleFlight
+from microservice.core.result_cache import create_cache
 
 logger = logging.getLogger(__name__)
 
 
-def microservice(method=None, exposed=False):
+def microservice(method=None, exposed=False, executor=settings.ExecutorType.THREAD, workers=None, coalesce=False,
+                 cache=None, continuation=False, resources=None, min_replicas=None, max_replicas=None,
+                 target_cpu_utilization=None, executor_workers=None):
     """
     Decorator that declares a function as a microservice.
     This handles both calling out to a remote microservice, and being called as a microservice.
@@ -14,24 +26,99 @@ def microservice(method=None, exposed=False):
     Example usage:
       @microservice
       @microservice(exposed=True)
+      @microservice(executor="process", workers=4)
+      @microservice(coalesce=True)
+      @microservice(cache=True)
+      @microservice(cache={'max_size': 100, 'ttl': 60, 'shared': True})
+      @microservice(continuation=True)
+      @microservice(resources={'requests': {'cpu': '1'}}, min_replicas=2, max_replicas=10, executor_workers=1)
 
     :param function method: The function to turn into a microservice.
     :param bool exposed: Whether to expose this microservice outside of the microservice cluster.
+    :param executor: `settings.ExecutorType` (or its name, case-insensitive) to carry out the function with when
+        hosting it. Use PROCESS for CPU bound functions, so that they aren't limited by the GIL.
+    :param int workers: Number of processes in the pool when `executor` is PROCESS. Defaults to the number of CPUs.
+    :param bool coalesce: Whether identical calls (i.e. with the same args and kwargs) made at the same time share a
+        single execution, both when hosting this microservice and when calling it. Only use this for functions
+        without side effects. The result is shared too, so callers mustn't modify it. Calls to generator functions
+        are never shared, as each caller iterates over its own generator.
+    :param cache: Memoize the results of this microservice (which must be a pure function). Either True to use the
+        default cache settings, a dict of kwargs for `result_cache.ResultCache`, or a `result_cache.ResultCache`.
+        Cached results are returned to callers without making any request, so callers mustn't modify them.
+    :param bool continuation: Whether this microservice is a generator function that yields its nested calls (made
+        with `.defer`), so that in ACTOR mode it is resumed when each result arrives rather than replayed from the
+        top. See `microservice.core.continuation`.
+    :param dict resources: Kubernetes resource requirements of each instance of this microservice, e.g.
+        {'requests': {'cpu': '500m', 'memory': '256Mi'}, 'limits': {'memory': '1Gi'}}.
+        Defaults to `settings.kube_default_resources`.
+    :param int min_replicas: Fewest instances of this microservice to run when autoscaling.
+    :param int max_replicas: Most instances of this microservice to run when autoscaling.
+    :param int target_cpu_utilization: Mean CPU utilisation (percent) of its instances that the kubernetes autoscaler
+        aims for. Defaults to `settings.kube_default_target_cpu_utilization`.
+    :param int executor_workers: Number of requests each instance carries out at once in ACTOR mode. Use few for CPU
+        bound functions, and many for IO bound ones. Defaults to `settings.executor_workers`.
     """
+    if isinstance(executor, str):
+        executor = settings.ExecutorType(executor.upper())
+    if continuation and executor == settings.ExecutorType.PROCESS:
+        # Suspended generators can't be sent between processes.
+        raise ValueError("Continuation microservices can't be carried out by a process executor.")
+    if min_replicas is not None and max_replicas is not None and min_replicas > max_replicas:
+        raise ValueError("min_replicas ({}) is more than max_replicas ({}).".format(min_replicas, max_replicas))
+
     def decorator(func):
         if sys.modules[func.__module__].__name__ == '__main__':
             # __main__ isn't static, so we can't ever allow a microservice to be defined in __main__ as other
             # microservices won't be able to locate it reliably.
             raise NotImplementedError("Can't have @microservice(s) defined in __main__.")
 
+        # Each caller of a generator function iterates over its own generator, so its results can't be shared.
+        returns_generator = inspect.isgeneratorfunction(func) and not continuation
+        if returns_generator and executor == settings.ExecutorType.PROCESS:
+            # Generators can't be sent between processes.
+            raise ValueError("Generator microservices can't be carried out by a process executor.")
+
         service_name = utils.service_name_from_func(func)
         logger.debug("Function being decorated is: {full_service_name}", extra={'full_service_name': service_name})
 
         # When first importing any microservice decorated functions, record the name of the service so that we can
         # autodetect which services need to be created.
-        settings.all_microservices.append(
-            utils.MicroserviceDefinition(service_name, exposed)
-        )
+        definition = utils.MicroserviceDefinition(service_name, exposed, executor, workers, resources, min_replicas,
+                                                  max_replicas, target_cpu_utilization, executor_workers, continuation)
+        settings.all_microservices.append(definition)
+        result_cache = create_cache(service_name, cache) if cache else None
+        if result_cache is not None and result_cache.shared:
+            # Import the shared tier now, so that it is deployed along with this service.
+            from microservice.core import memcached_wrapper  # noqa: F401
+
+        def is_hosted_here():
+            # There's no waypost when called from a plain script in ZERO mode.
+            return settings.ServiceWaypost is not None and service_name == settings.ServiceWaypost.local_service
+
+        def carry_out_locally(*args, **kwargs):
+            if (executor == settings.ExecutorType.PROCESS and is_hosted_here() and
+                    not process_executor.in_worker_process):
+                return process_executor.run_in_process_pool(
+                    service_name, workers, settings.current_message(), args, kwargs)
+            if continuation:
+                # Only the service being hosted handles messages - anything else is being called locally.
+                message = settings.current_message() if is_hosted_here() else None
+                return continuations.run(service_name, func, args, kwargs, message)
+            return func(*args, **kwargs)
+
+        def get_result_key(args, kwargs, message):
+            if message is not None:
+                return message.result_key(service_name)
+            return communication.create_result_key(service_name, args, kwargs)
+
+        def coalesced(call, args, kwargs, message=None, result_key=None):
+            if not coalesce or returns_generator:
+                return call(*args, **kwargs)
+            if result_key is None:
+                result_key = get_result_key(args, kwargs, message)
+            # A ServiceCallPerformed only means that the caller's own message has been sent on, so isn't shared.
+            return in_flight_calls.do(result_key, functools.partial(call, *args, **kwargs),
+                                      not_shared=(communication.ServiceCallPerformed,))
 
         def runtime_discovery(*args, __message=None, **kwargs):
             # If this is called using args and kwargs, then this is being called to trigger a remote call
@@ -51,18 +138,34 @@ def microservice(method=None, exposed=False):
                 args = __message.args
                 kwargs = __message.kwargs
 
+            if result_cache is None:
+                return call_service(args, kwargs, __message)
+
+            # Check the cache before making any request.
+            result_key = get_result_key(args, kwargs, __message)
+            found, result = result_cache.get(result_key)
+            if found:
+                logger.info("Returning cached result for {service_name}", extra={'service_name': service_name})
+                return result
+            result = call_service(args, kwargs, __message, result_key)
+            result_cache.put(result_key, result)
+            return result
+
+        def call_service(args, kwargs, __message, result_key=None):
             if (settings.deployment_mode == settings.DeploymentMode.ZERO or
                     service_name == settings.ServiceWaypost.local_service):
                 logger.info("{service_name} is being served locally.", extra={'service_name': service_name})
-                return func(*args, **kwargs)
+                return coalesced(carry_out_locally, args, kwargs, __message, result_key)
 
             logger.info("{service_name} is being served remotely.", extra={'service_name': service_name})
             # If we've already made the call to calculate this function, return that
             if (settings.communication_mode == settings.CommunicationMode.ACTOR and
                     settings.current_message() is not None):
-                result_key = communication.create_result_key(service_name, args, kwargs)
-                if result_key in settings.current_message().results.keys():
-                    result = settings.current_message().get_result(service_name, args, kwargs)
+                results = settings.current_message().results
+                if result_key is None:
+                    result_key = communication.create_result_key(service_name, args, kwargs)
+                if result_key in results:
+                    result = settings.current_message().resolved_result(result_key)
                     logger.info("Call to that function already carried out - returning previous result: {result}",
                                 extra={'result': result})
                     return result
@@ -71,11 +174,14 @@ def microservice(method=None, exposed=False):
             if settings.communication_mode == settings.CommunicationMode.SYN:
                 logger.debug("CommunicationMode is synchronous: calculating result synchronously.")
                 ret_func = synchronous_function(service_name)
-                return ret_func(*args, **kwargs)
+                return coalesced(ret_func, args, kwargs, result_key=result_key)
             elif settings.communication_mode == settings.CommunicationMode.ACTOR:
                 # Otherwise, make a call to another actor to carry it out and stop processing.
                 logger.debug("CommunicationMode is asynchronous, sending request to another actor to fulfil request.")
                 if settings.current_message() is not None:
+                    if getattr(settings.thread_locals, 'responding_directly', False):
+                        raise communication.NestedCallNotSupported(
+                            "Can't make nested calls from a batch or stream in ACTOR mode.")
                     communication.construct_and_send_call_to_service(
                         service_name,
                         settings.current_message(),
@@ -87,9 +193,125 @@ def microservice(method=None, exposed=False):
                     # If there isn't an inbound microservice then we are making a call to a microservice from a
                     # non-microservice.
                     logger.info("Making call from interface, sending request, then waiting for async response back.")
-                    return handle_interface_call(service_name, *args, **kwargs)
+                    return coalesced(functools.partial(handle_interface_call, service_name), args, kwargs,
+                                     result_key=result_key)
+
+            raise ValueError("Invalid communication_mode")
+
+        def submit(*args, **kwargs) -> Future:
+            """
+            Make a call to this microservice without waiting for the result.
+
+            :return: Future that is completed with the result of the call.
+            """
+            if (settings.communication_mode == settings.CommunicationMode.ACTOR and
+                    settings.deployment_mode != settings.DeploymentMode.ZERO and
+                    service_name != settings.ServiceWaypost.local_service):
+                if settings.current_message() is not None:
+                    raise NotImplementedError("Calls can only be submitted from an interface in ACTOR mode.")
+                return submit_interface_call(service_name, *args, **kwargs)
+            return get_submit_executor().submit(runtime_discovery, *args, **kwargs)
+
+        def defer(*args, **kwargs) -> continuations.DeferredCall:
+            """
+            Make a call to this microservice by yielding it from a continuation microservice, which is sent the result.
+            """
+            return continuations.DeferredCall(runtime_discovery, args, kwargs)
+
+        async def async_call(*args, **kwargs):
+            """
+            Awaitable equivalent of calling this microservice.
+
+            This doesn't block the event loop (or use a thread per call) while waiting for the result, so an interface
+            can have many calls in flight at once.
+            """
+            if (settings.deployment_mode == settings.DeploymentMode.ZERO or
+                    service_name == settings.ServiceWaypost.local_service):
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(None, functools.partial(runtime_discovery, *args, **kwargs))
+            if settings.current_message() is not None:
+                raise NotImplementedError("async_call can only be used from an interface.")
 
+            if settings.communication_mode == settings.CommunicationMode.SYN:
+                return await handle_interface_call_async_synchronous(service_name, *args, **kwargs)
+            elif settings.communication_mode == settings.CommunicationMode.ACTOR:
+                return await handle_interface_call_async(service_name, *args, **kwargs)
             raise ValueError("Invalid communication_mode")
+
+        def map_calls(*iterables, kwargs_iterable: Iterable[dict]=None, chunk_size: int=None) -> list:
+            """
+            Call this microservice once for each set of args taken from `iterables` (like the builtin `map`), sending
+            the calls in chunks of `chunk_size` calls per request. The service carries out the calls of each chunk
+            in parallel.
+
+            In ACTOR mode, the service responds to each chunk directly, so the calls can't make nested calls (they
+            raise `communication.NestedCallNotSupported`). When called from within a microservice in ACTOR mode, the
+            calls are made with `fan_out.gather` instead, so that the worker isn't held up waiting for the responses.
+
+            :param iterables: Iterables of args. The Nth call is made with the Nth item of each iterable.
+            :param kwargs_iterable: Iterable of kwargs. The Nth call is made with the Nth of them.
+            :param int chunk_size: Number of calls sent in each request. Defaults to `settings.batch_chunk_size`.
+            :return list: Result of each call, in order. As with a call to a microservice in ACTOR mode, the result of
+                a call that raised an exception is that exception.
+            :raises communication.NestedCallNotSupported: If any of the calls made a nested call in ACTOR mode.
+            """
+            if kwargs_iterable is None:
+                calls = [(args, {}) for args in zip(*iterables)]
+            elif iterables:
+                calls = [(args, dict(kwargs)) for args, kwargs in zip(zip(*iterables), kwargs_iterable)]
+            else:
+                calls = [((), dict(kwargs)) for kwargs in kwargs_iterable]
+            if (settings.deployment_mode == settings.DeploymentMode.ZERO or
+                    service_name == settings.ServiceWaypost.local_service):
+                results = []
+                for args, kwargs in calls:
+                    try:
+                        results.append(runtime_discovery(*args, **kwargs))
+                    except Exception as err:
+                        results.append(err)
+                return results
+
+            message = settings.current_message()
+            if settings.communication_mode == settings.CommunicationMode.ACTOR and message is not None:
+                return fan_out.gather(*[defer(*args, **kwargs) for args, kwargs in calls])
+
+            chunk_size = chunk_size if chunk_size is not None else settings.batch_chunk_size
+            chunks = [calls[i:i + chunk_size] for i in range(0, len(calls), chunk_size)]
+            # Send the chunks at the same time, so that the service can carry them out in parallel.
+            results = fan_out.gather_in_threads(
+                [continuations.DeferredCall(communication.send_batch_to_service, (service_name, message, chunk), {})
+                 for chunk in chunks], message)
+            results = [result for chunk_results in results for result in chunk_results]
+            for result in results:
+                if isinstance(result, communication.NestedCallNotSupported):
+                    raise result
+            return results
+
+        def stream(*args, **kwargs) -> Iterator:
+            """
+            Call this microservice, and iterate over its result as it is generated.
+
+            For microservices that return a generator, this means that neither side needs to hold the whole result in
+            memory, and the caller can start work on the first item straight away. Any other result is streamed as a
+            single item.
+
+            :return: Iterator over the items generated by the microservice. An exception raised by the microservice
+                is raised by the iterator once the items before it have been received.
+            """
+            if (settings.deployment_mode == settings.DeploymentMode.ZERO or
+                    service_name == settings.ServiceWaypost.local_service):
+                result = runtime_discovery(*args, **kwargs)
+                return result if inspect.isgenerator(result) else iter([result])
+            return communication.stream_from_service(service_name, settings.current_message(), *args, **kwargs)
+
+        runtime_discovery.__wrapped__ = func
+        runtime_discovery.definition = definition
+        runtime_discovery.cache = result_cache
+        runtime_discovery.submit = submit
+        runtime_discovery.defer = defer
+        runtime_discovery.map = map_calls
+        runtime_discovery.stream = stream
+        runtime_discovery.async_call = async_call
         return runtime_discovery
 
     # Handle whether this decorator was called with arguments or not.
@@ -103,35 +325,137 @@ def microservice(method=None, exposed=False):
     return decorator
 
 
-def handle_interface_call(service_name, *args, **kwargs):
-    new_message = communication.Message()
+# Calls to microservices declared with `coalesce=True` that are currently in flight.
+in_flight_calls = SingleFlight()
+
+submit_executor = None  # type: ThreadPoolExecutor
+submit_executor_lock = threading.Lock()
+
+
+def get_submit_executor() -> ThreadPoolExecutor:
+    """
+    Executor used to carry out submitted calls in modes where a call blocks the calling thread until it completes.
+    """
+    global submit_executor
+    with submit_executor_lock:
+        if submit_executor is None:
+            submit_executor = ThreadPoolExecutor(max_workers=settings.submit_workers)
+        return submit_executor
+
 
+def register_interface_call(service_name, request_id, args, kwargs) -> Future:
+    """
+    Record that a response is expected for the interface call with the given request_id.
+
+    :return: Future that is completed with the result when the response is received. Cancelling the future stops
+        waiting for the response.
+    """
     result_key = communication.create_result_key(service_name, args, kwargs)
-    settings.set_interface_request(new_message.request_id, result_key)
+    future = settings.set_interface_request(request_id, result_key)
 
-    logger.debug("Sending interface call to {service_name}", extra={'service_name': service_name})
-    communication.construct_and_send_call_to_service(
-        service_name,
-        new_message,
-        *args,
-        **kwargs
-    )
+    def on_done(done_future):
+        settings.clear_interface_request(request_id, completed=not done_future.cancelled())
+    future.add_done_callback(on_done)
+    return future
+
+
+def submit_interface_call(service_name, *args, **kwargs) -> Future:
+    """
+    Send a call to `service_name` from an interface, without waiting for the response.
+
+    :return: Future that is completed with the result when the response is received. Cancelling the future stops
+        waiting for the response.
+    """
+    new_message = communication.Message()
+    future = register_interface_call(service_name, new_message.request_id, args, kwargs)
+
+    logger.debug("Sending interface call to {service_name}",
+                 extra={'service_name': service_name, 'request_id': new_message.request_id})
+    try:
+        communication.construct_and_send_call_to_service(
+            service_name,
+            new_message,
+            *args,
+            **kwargs
+        )
+    except Exception:
+        future.cancel()
+        raise
+    return future
+
+
+def wait_for_interface_result(future: Future, timeout: float=None):
+    """
+    Wait for the result of a call made using `submit_interface_call`.
 
-    logger.debug("Waiting for response for request_id: {request_id}", extra={'request_id': new_message.request_id})
+    :param future: Future returned by `submit_interface_call`.
+    :param timeout: Number of seconds to wait. Defaults to `settings.interface_call_timeout`.
+    :return: The result of the call. If the call resulted in an exception, that is raised instead.
+    """
+    timeout = timeout if timeout is not None else settings.interface_call_timeout
+    try:
+        result = future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise TimeoutError("Timed out after {} seconds waiting for microservice response.".format(timeout))
+    except CancelledError:
+        raise
+    except Exception as err:
+        logger.exception("Microservice hit exception: {exception}", extra={'exception': err})
+        raise
+    return result
 
-    def answer_is_ready():
-        return new_message.request_id in settings.interface_results.keys()
 
+def handle_interface_call(service_name, *args, **kwargs):
+    future = submit_interface_call(service_name, *args, **kwargs)
+    logger.debug("Waiting for response to interface call to {service_name}", extra={'service_name': service_name})
+    result = wait_for_interface_result(future)
+    logger.debug("Got response to interface call to {service_name}", extra={'service_name': service_name})
+    return result
+
+
+async def handle_interface_call_async(service_name, *args, **kwargs):
+    """
+    Equivalent of `handle_interface_call` for use in asyncio code.
+
+    The response is still delivered to the flask app of this interface, but instead of blocking a thread waiting for
+    it, the event loop is woken up when it arrives. For a per-call timeout, wrap the call in `asyncio.wait_for`.
+    """
+    timeout = settings.interface_call_timeout
+    new_message = communication.Message()
+    future = register_interface_call(service_name, new_message.request_id, args, kwargs)
+
+    # Cancelling (or timing out) the awaitable also cancels the underlying future, which tidies up the request.
+    wrapped_future = asyncio.wrap_future(future)
     try:
-        utils.wait_for(answer_is_ready)
-        logger.debug("Got response to request_id: {request_id}", extra={'request_id': new_message.request_id})
-        result = settings.interface_results[new_message.request_id]
+        logger.debug("Sending async interface call to {service_name}",
+                     extra={'service_name': service_name, 'request_id': new_message.request_id})
+        await communication.construct_and_send_call_to_service_async(
+            service_name,
+            new_message,
+            *args,
+            **kwargs
+        )
+        return await asyncio.wait_for(wrapped_future, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError("Timed out after {} seconds waiting for microservice response.".format(timeout))
     finally:
-        if new_message.request_id in settings.interface_results.keys():
-            del settings.interface_results[new_message.request_id]
+        if not future.done():
+            future.cancel()
 
+
+async def handle_interface_call_async_synchronous(service_name, *args, **kwargs):
+    """
+    In SYN mode, the result is in the response to the request, so just wait for that without blocking.
+    """
+    response = await communication.construct_and_send_call_to_service_async(
+        service_name,
+        communication.Message(),
+        *args,
+        **kwargs
+    )
+    result = response.results[service_name] if isinstance(response, communication.Message) else response
     if isinstance(result, Exception):
-        logger.exception("Microservice hit exception: {exception}", extra={'exception': result})
         raise result
     return result
 
@@ -152,6 +476,9 @@ def synchronous_function(service_name):
                 *args,
                 **kwargs
             )
+            if isinstance(result, communication.Message):
+                # The response holds the result under the name of the service that was called.
+                result = result.results[service_name]
             logger.info("Got synchronous result: {result}", extra={'result': result})
             return result
         return ms_function
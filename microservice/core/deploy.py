@@ -18,3 +18,14 @@ def destroy_deployment():
     if settings.deployment_mode == settings.DeploymentMode.ZERO:
         return
     settings.ServiceWaypost.deployment.teardown()
+
+
+def scale_deployment(service_name: str, replicas: int):
+    """
+    Change the number of instances of `service_name` in the current deployment.
+
+    :return: The uri of every instance of `service_name` once scaled.
+    """
+    if settings.deployment_mode == settings.DeploymentMode.ZERO:
+        return
+    return settings.ServiceWaypost.deployment.scale(service_name, replicas)
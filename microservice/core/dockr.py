@@ -1,8 +1,26 @@
+"""
+Building the docker images that services are deployed from in kubernetes.
+
+By default each service gets its own image (see `settings.DockerImageMode`), which only differs from the base image
+by the service it runs. The images are built concurrently (up to `settings.docker_build_workers` at a time), and an
+image whose content - its dockerfile and base image - hasn't changed since it was last built isn't built again.
+
+In SHARED mode a single image is built instead, and each container is told which service to run when it starts (see
+`KubeMicroservice.pod_spec`), so deployments take the same time however many services there are.
+"""
 import docker
+import hashlib
+import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import List
+from typing import Dict, List
 
+from microservice.core import settings
+
+logger = logging.getLogger(__name__)
+
+base_image = "martinhowarth/microservice:latest"
 
 base_dockerfile = """
 FROM python:3
@@ -17,20 +35,64 @@ ENTRYPOINT ["/usr/local/bin/microservice", "--host", "0.0.0.0", "--port", "5000"
 """
 
 pycroservice_dockerfile = """
-FROM martinhowarth/microservice:latest
+FROM {base_image}
 
 CMD ["{service_name}"]
 """
 
+# The service is given as the container's arguments instead.
+shared_dockerfile = """
+FROM {base_image}
+"""
+
+# Label recording the content hash an image was built from.
+CONTENT_HASH_LABEL = "microservice.content-hash"
+
 
-def build_image(dockerfile: str, tag: str, **kwargs) -> None:
+def image_id(tag: str, client: docker.DockerClient) -> str:
     """
-    Build a docker image from the given (string) dockerfile
-    :param dockerfile:
-    :param tag:
-    :return:
+    :return: Id of the local image `tag`, or None if there isn't one.
     """
-    client = docker.from_env()
+    try:
+        return client.images.get(tag).id
+    except docker.errors.ImageNotFound:
+        return None
+
+
+def content_hash(dockerfile: str, client: docker.DockerClient) -> str:
+    """
+    :return: Hash of everything an image built from `dockerfile` depends on: the dockerfile, and the base image.
+    """
+    digest = hashlib.sha256(dockerfile.encode('utf-8'))
+    digest.update(str(image_id(base_image, client)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def is_up_to_date(tag: str, expected_hash: str, client: docker.DockerClient) -> bool:
+    try:
+        image = client.images.get(tag)
+    except docker.errors.ImageNotFound:
+        return False
+    return image.labels.get(CONTENT_HASH_LABEL) == expected_hash
+
+
+def build_image(dockerfile: str, tag: str, client: docker.DockerClient=None, force: bool=False, **kwargs) -> bool:
+    """
+    Build a docker image from the given (string) dockerfile, unless it has already been built from the same content.
+
+    :param dockerfile: Contents of the dockerfile.
+    :param tag: Tag to give the image.
+    :param client: Docker client to build with. Defaults to one from the environment.
+    :param force: Whether to build the image even if it's up to date.
+    :return: Whether the image was built.
+    """
+    client = client if client is not None else docker.from_env()
+    expected_hash = content_hash(dockerfile, client)
+    if not force and is_up_to_date(tag, expected_hash, client):
+        logger.info("Image {tag} is up to date", extra={'tag': tag})
+        return False
+
+    logger.info("Building image {tag}", extra={'tag': tag})
     fobj = BytesIO(dockerfile.encode('utf-8'))
     build = client.api.build(
         path="./",
@@ -38,23 +100,38 @@ def build_image(dockerfile: str, tag: str, **kwargs) -> None:
         forcerm=True,
         rm=True,
         tag=tag,
+        labels={CONTENT_HASH_LABEL: expected_hash},
+        decode=True,
         **kwargs
     )
-    if build:
-        print("Docker build logs for {0} are:".format(tag))
-        logs = []
-        for bi in build:
-            print(bi)
-            logs.append(bi)
-        if 'Successfully' not in str(logs[-1]):
-            raise RuntimeError("Container {0} failed to build with error: {1}".format(tag, logs[-1]))
+    last = None
+    for line in build:
+        logger.debug("Docker build of {tag}: {line}", extra={'tag': tag, 'line': line})
+        if 'error' in line:
+            raise RuntimeError("Container {0} failed to build with error: {1}".format(tag, line['error']))
+        last = line
+    if last is not None and 'Successfully' not in str(last):
+        raise RuntimeError("Container {0} failed to build with error: {1}".format(tag, last))
+    return True
 
 
-def build_all_images(service_names: List[str]) -> None:
+def image_for_service(service_name: str) -> str:
     """
-    Build a docker image for each microservice.
+    :return: Tag of the image `service_name` runs from.
+    """
+    if settings.docker_image_mode == settings.DockerImageMode.SHARED:
+        return settings.docker_shared_image
+    return "{0}:latest".format(service_name)
+
+
+def build_all_images(service_names: List[str], client: docker.DockerClient=None, force: bool=False) -> Dict[str, str]:
+    """
+    Build the docker images for each microservice.
 
     :param service_names: List of service names.
+    :param client: Docker client to build with. Defaults to one from the environment.
+    :param force: Whether to build images even if they're up to date.
+    :return: Tag of the image each service runs from, keyed by service name.
     """
     # Build the base image first
     # build_image(
@@ -62,11 +139,34 @@ def build_all_images(service_names: List[str]) -> None:
     #     'pycroservice:latest',
     #     pull=True,  # Pull updates to the base image
     # )
+    client = client if client is not None else docker.from_env()
+    images = {service_name: image_for_service(service_name) for service_name in service_names}
+
+    if settings.docker_image_mode == settings.DockerImageMode.SHARED:
+        build_image(shared_dockerfile.format(base_image=base_image), settings.docker_shared_image,
+                    client=client, force=force)
+        return images
 
-    for service_name in service_names:
-        build_image(
+    def build(service_name):
+        return build_image(
             pycroservice_dockerfile.format(
+                base_image=base_image,
                 service_name=service_name
             ),
-            "{0}:latest".format(service_name),
+            images[service_name],
+            client=client,
+            force=force,
         )
+
+    with ThreadPoolExecutor(max_workers=settings.docker_build_workers) as executor:
+        futures = {service_name: executor.submit(build, service_name) for service_name in service_names}
+    failures = {}
+    for service_name, future in futures.items():
+        if future.exception() is not None:
+            failures[service_name] = future.exception()
+    if failures:
+        raise RuntimeError("Failed to build images for {0}: {1}".format(
+            ', '.join(failures), '; '.join(str(err) for err in failures.values())))
+    logger.info("Built {built} of {count} images",
+                extra={'built': sum(future.result() for future in futures.values()), 'count': len(futures)})
+    return images
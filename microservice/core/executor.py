@@ -0,0 +1,263 @@
+"""
+Executor used to carry out requests in the background when running in ACTOR mode.
+
+Requests are acked as soon as they are queued, so without a limit on the queue a burst of requests queues work (and
+memory) without bound. `BoundedExecutor` refuses new work with `ExecutorFull` once `max_queue_size` requests are
+waiting for a worker, so that the service can tell the caller to back off and retry later.
+
+Services declared with `@microservice(executor="process")` are CPU bound, so running them in threads doesn't help
+(because of the GIL). Instead, the function itself is carried out in a process pool (see `run_in_process_pool`), while
+the HTTP handling and messaging stays in the host process.
+"""
+import logging
+import math
+import multiprocessing
+import sys
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from microservice.core import settings, utils
+
+logger = logging.getLogger(__name__)
+
+
+# Names of the gauges each service exposes for scraping (see `service_host.prometheus_metrics`), which kubernetes
+# autoscales services on (see `KubeMicroservice.hpa_definition`).
+IN_FLIGHT_METRIC = "microservice_requests_in_flight"
+QUEUED_METRIC = "microservice_requests_queued"
+
+
+class ExecutorFull(Exception):
+    pass
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    :return: The smallest of `values` that at least `percent` percent of them are no greater than.
+    """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(len(ordered) * percent / 100) - 1, 0)]
+
+
+class BoundedExecutor:
+    """
+    Thread pool with a bounded queue, which keeps track of how busy it is.
+    """
+
+    def __init__(self, max_workers: int, max_queue_size: int):
+        """
+        :param int max_workers: Number of requests carried out at once.
+        :param int max_queue_size: Number of requests allowed to wait for a free worker. 0 means no limit.
+        """
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._rejected = 0
+        # (finished at, seconds from being submitted to finishing) of recently finished requests.
+        self._latencies = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting for a free worker."""
+        return self._queued
+
+    @property
+    def active_workers(self) -> int:
+        """Number of requests currently being carried out."""
+        return self._active
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """
+        Schedule `fn(*args, **kwargs)` to be carried out by the next free worker.
+
+        :raises ExecutorFull: If the queue is full.
+        """
+        with self._lock:
+            if self.max_queue_size and self._queued >= self.max_queue_size:
+                self._rejected += 1
+                logger.warning("Executor queue is full, rejecting request. Queue depth: {queue_depth}",
+                               extra={'queue_depth': self._queued})
+                raise ExecutorFull()
+            self._queued += 1
+        return self._executor.submit(self._run, fn, args, kwargs, time.monotonic())
+
+    def submit_all(self, fn, arg_lists: list) -> list:
+        """
+        Schedule `fn(*args)` for each of `arg_lists`, so that they are carried out by as many workers as are free.
+        Either all of them are queued, or none of them are.
+
+        :return list: Future of each call, in order.
+        :raises ExecutorFull: If there isn't room in the queue for all of them. So that a batch larger than the queue
+            can still be carried out, it is only refused while other requests are waiting.
+        """
+        with self._lock:
+            if self.max_queue_size and self._queued and self._queued + len(arg_lists) > self.max_queue_size:
+                self._rejected += 1
+                logger.warning("Executor queue is full, rejecting batch of {count} requests. Queue depth: "
+                               "{queue_depth}", extra={'count': len(arg_lists), 'queue_depth': self._queued})
+                raise ExecutorFull()
+            self._queued += len(arg_lists)
+        submitted_at = time.monotonic()
+        return [self._executor.submit(self._run, fn, args, {}, submitted_at) for args in arg_lists]
+
+    def _run(self, fn, args, kwargs, submitted_at):
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            finished_at = time.monotonic()
+            with self._lock:
+                self._active -= 1
+                self._latencies.append((finished_at, finished_at - submitted_at))
+                self._remove_old_latencies(finished_at)
+
+    def _remove_old_latencies(self, now: float):
+        while self._latencies and (self._latencies[0][0] < now - settings.executor_latency_window or
+                                   len(self._latencies) > settings.executor_latency_samples):
+            self._latencies.popleft()
+
+    def p95_latency(self) -> float:
+        """
+        :return: 95th percentile of the number of seconds from being submitted to finishing, of the requests that
+            finished in the last `settings.executor_latency_window` seconds. None if there weren't any.
+        """
+        with self._lock:
+            self._remove_old_latencies(time.monotonic())
+            latencies = [latency for _, latency in self._latencies]
+        return percentile(latencies, 95) if latencies else None
+
+    def shutdown(self, wait: bool=True):
+        self._executor.shutdown(wait=wait)
+
+    def metrics(self) -> dict:
+        p95_latency = self.p95_latency()
+        with self._lock:
+            return {
+                'queue_depth': self._queued,
+                'active_workers': self._active,
+                'max_workers': self.max_workers,
+                'max_queue_size': self.max_queue_size,
+                'rejected': self._rejected,
+                'p95_latency': p95_latency,
+            }
+
+
+process_pool = None  # type: ProcessPoolExecutor
+process_pool_lock = threading.Lock()
+
+# Whether this process is a worker of a process pool rather than the process hosting the service.
+in_worker_process = False
+
+
+def process_pool_context() -> dict:
+    """
+    :return: Keyword arguments choosing how the worker processes of the process pool are started.
+    """
+    # Worker processes aren't forked from this (multi-threaded) process where that can be avoided, as a lock held by
+    # another thread at the time (e.g. by logging) would never be released in the worker. Choosing the start method
+    # needs python 3.7, and forkserver isn't available on Windows (which starts processes with spawn anyway).
+    if sys.version_info >= (3, 7) and 'forkserver' in multiprocessing.get_all_start_methods():
+        return {'mp_context': multiprocessing.get_context('forkserver')}
+    return {}
+
+
+def get_process_pool(workers: int=None) -> ProcessPoolExecutor:
+    """
+    Get the process pool of this service host, creating it if this is the first call.
+
+    :param int workers: Number of worker processes. Defaults to the number of CPUs.
+    """
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(max_workers=workers, **process_pool_context())
+            logger.info("Created process pool with {workers} workers", extra={'workers': process_pool._max_workers})
+        return process_pool
+
+
+def shutdown_process_pool(wait: bool=True):
+    global process_pool
+    with process_pool_lock:
+        if process_pool is not None:
+            process_pool.shutdown(wait=wait)
+            process_pool = None
+
+
+def worker_state() -> dict:
+    """
+    :return: The settings a worker process needs to match the process hosting the service.
+    """
+    return {
+        'communication_mode': settings.communication_mode,
+        'deployment_mode': settings.deployment_mode,
+        'wire_codec': settings.wire_codec,
+        'local_uri': settings.local_uri,
+        'local_service': settings.ServiceWaypost.local_service,
+        'deployment_manager_uri': settings.ServiceWaypost.deployment_manager_uri,
+    }
+
+
+def initialise_worker_process(state: dict):
+    """
+    Set up the settings of a new worker process to match the process hosting the service, so that it can make calls
+    to other services.
+
+    This is done by the first call carried out in each worker, rather than by an initializer of the pool, as pools
+    only take one from python 3.7.
+    """
+    from microservice.core.service_waypost import init_service_waypost
+
+    global in_worker_process
+    in_worker_process = True
+    settings.communication_mode = state['communication_mode']
+    settings.deployment_mode = state['deployment_mode']
+    settings.wire_codec = state['wire_codec']
+    settings.local_uri = state['local_uri']
+    init_service_waypost()
+    settings.ServiceWaypost.local_service = state['local_service']
+    settings.ServiceWaypost.deployment_manager_uri = state['deployment_manager_uri']
+
+
+def call_in_worker_process(state: dict, service_name: str, message, args: tuple, kwargs: dict):
+    """
+    Carry out the undecorated function of `service_name` in a worker process.
+
+    :param state: Settings of the process hosting the service. See `worker_state`.
+    """
+    if not in_worker_process:
+        initialise_worker_process(state)
+    func = utils.func_from_service_name(service_name).__wrapped__
+    if settings.communication_mode == settings.CommunicationMode.ACTOR:
+        # Nested calls need the current message to send on (SYN mode has no flask request in the worker).
+        settings.set_current_message(message)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        if settings.communication_mode == settings.CommunicationMode.ACTOR:
+            settings.set_current_message(None)
+
+
+def run_in_process_pool(service_name: str, workers: int, message, args: tuple, kwargs: dict):
+    """
+    Carry out `service_name` in the process pool, and wait for the result.
+
+    Any exception raised by the function (including `ServiceCallPerformed`) is re-raised in this process.
+
+    :param str service_name: Service to carry out. Its module is imported in the worker process.
+    :param int workers: Size of the process pool, if it needs creating.
+    :param message: Message currently being handled, if any.
+    :param tuple args: Args to call the function with.
+    :param dict kwargs: Kwargs to call the function with.
+    """
+    logger.debug("Carrying out {service_name} in process pool", extra={'service_name': service_name})
+    future = get_process_pool(workers).submit(call_in_worker_process, worker_state(), service_name, message, args,
+                                              kwargs)
+    return future.result()
@@ -0,0 +1,249 @@
+"""
+Fan out of independent calls to microservices with `gather`.
+
+In ACTOR mode, each nested call stops the function until its result arrives, so calls are made one at a time, even if
+they don't depend on each other:
+
+    a = my_service(x)
+    b = my_service2(y)
+
+`gather` instead sends every call whose result isn't known yet at once:
+
+    a, b = gather(my_service.defer(x), my_service2.defer(y))
+
+Each result arrives in a separate message, so this service keeps the results that have arrived so far (see
+`PendingJoins`), and the function is only carried on with once all of them have. Continuation microservices yield
+`gather.defer(...)` instead.
+
+If a result arrives at a different instance of the service, or after `settings.gather_ttl`, the calls whose results
+are missing from that message are simply sent again.
+
+In other modes each call blocks until its result arrives, so the calls are carried out in parallel threads (see
+`GatheredCall`).
+"""
+import logging
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+
+from microservice.core import communication, settings
+from microservice.core.continuation import DeferredCall, frame_key
+
+logger = logging.getLogger(__name__)
+
+
+class Join:
+    """
+    Gathered calls sent by a single call to a service.
+    """
+
+    def __init__(self):
+        self.expires_at = None  # type: float
+        # Result keys of the calls that have been made.
+        self.pending = set()
+        # Results that have arrived so far, keyed by result key.
+        self.results = {}
+
+
+class PendingJoins:
+    """
+    Gathered calls waiting for all of their results to arrive, keyed by the message that made them and their result
+    keys.
+    """
+
+    def __init__(self):
+        self._joins = {}  # type: Dict[tuple, Join]
+        self._lock = threading.Lock()
+        self._last_cleanup = time.monotonic()
+
+    def __len__(self):
+        return len(self._joins)
+
+    def expect(self, key: tuple, result_keys: List[communication.ResultKey]):
+        """
+        Record that the calls with `result_keys` are about to be made. This must be done before they are sent, in
+        case a result arrives straight away.
+        """
+        now = time.monotonic()
+        with self._lock:
+            join = self._joins.setdefault(key, Join())
+            join.expires_at = now + settings.gather_ttl
+            join.pending.update(result_keys)
+        if now - self._last_cleanup > settings.gather_ttl:
+            self.remove_expired()
+
+    def join(self, key: tuple, message: communication.Message, result_keys: List[communication.ResultKey]) -> set:
+        """
+        Add the results that have arrived in other messages to `message`, and record those that have arrived in
+        `message`. Once every result has arrived, the join is complete and is forgotten - so only one message is
+        carried on with.
+
+        :return set: Result keys of the calls that have been made but whose results haven't arrived yet.
+        """
+        with self._lock:
+            join = self._joins.get(key)
+            if join is None:
+                return set()
+            for result_key, result in join.results.items():
+                message.results.setdefault(result_key, result)
+            join.results.update((result_key, message.results[result_key])
+                                for result_key in result_keys if result_key in message.results)
+            if all(result_key in message.results for result_key in result_keys):
+                del self._joins[key]
+                return set()
+            return {result_key for result_key in join.pending if result_key not in message.results}
+
+    def forget(self, key: tuple):
+        with self._lock:
+            self._joins.pop(key, None)
+
+    def remove_expired(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            self._last_cleanup = now
+            expired = [key for key, join in self._joins.items() if join.expires_at < now]
+            for key in expired:
+                del self._joins[key]
+        return len(expired)
+
+
+# Gathered calls made by this process.
+pending_joins = PendingJoins()
+
+
+class GatheredCall:
+    """
+    A call made by `gather` outside of ACTOR mode, carried out by whichever thread gets to it first: one of the
+    gather threads, or the thread gathering it.
+
+    The gathering thread carries out every call that no gather thread has started before waiting for the rest, so it
+    only ever waits for calls that are already being carried out. So gathers nested in gathered calls can't deadlock
+    however few threads there are.
+    """
+
+    def __init__(self, call: DeferredCall, message: communication.Message):
+        """
+        :param message: Message being handled by the gathering thread, which the call is made as part of.
+        """
+        self.call = call
+        self.message = message
+        self.future = Future()
+        self._started = threading.Lock()
+
+    def run(self):
+        """
+        Carry out the call, unless another thread already has.
+        """
+        if not self._started.acquire(blocking=False):
+            return
+        previous_message = settings.current_message()
+        settings.set_current_message(self.message)
+        try:
+            self.future.set_result(self.call())
+        except BaseException as err:
+            self.future.set_exception(err)
+        finally:
+            settings.set_current_message(previous_message)
+
+
+gather_executor = None  # type: ThreadPoolExecutor
+gather_executor_lock = threading.Lock()
+
+
+def get_gather_executor() -> ThreadPoolExecutor:
+    global gather_executor
+    with gather_executor_lock:
+        if gather_executor is None:
+            gather_executor = ThreadPoolExecutor(max_workers=settings.gather_workers)
+        return gather_executor
+
+
+def gather_in_threads(calls: List[DeferredCall], message: communication.Message) -> list:
+    gathered = [GatheredCall(call, message) for call in calls]
+    for gathered_call in gathered[1:]:
+        get_gather_executor().submit(gathered_call.run)
+    for gathered_call in gathered:
+        gathered_call.run()
+    return [gathered_call.future.result() for gathered_call in gathered]
+
+
+def gather(*calls: DeferredCall) -> list:
+    """
+    Make several independent calls to microservices at once.
+
+    In ACTOR mode, every call whose result isn't known yet is sent straight away, and the function is carried on with
+    once all of their results have arrived. So the calls take as long as the slowest of them, rather than all of them
+    in turn. In other modes, the calls are made in parallel threads, with this thread making any that no other thread
+    has started yet.
+
+    :param calls: Calls to make, each made with `.defer`.
+    :return list: Result of each call, in order.
+    """
+    message = settings.current_message()
+    if (settings.communication_mode != settings.CommunicationMode.ACTOR or
+            settings.deployment_mode == settings.DeploymentMode.ZERO):
+        return gather_in_threads(list(calls), message)
+    if message is None:
+        # Called from an interface, which is sent the results without blocking a thread for each.
+        futures = [call.service.submit(*call.args, **call.kwargs) for call in calls]
+        return [future.result() for future in futures]
+
+    result_keys = [call.result_key() for call in calls]
+    key = (frame_key(settings.ServiceWaypost.local_service, message), tuple(result_keys))
+
+    awaited = pending_joins.join(key, message, result_keys)
+    to_make = []
+    for call, result_key in zip(calls, result_keys):
+        if result_key not in message.results and result_key not in awaited:
+            to_make.append((call, result_key))
+            # Identical calls are only made once.
+            awaited.add(result_key)
+    if to_make:
+        logger.debug("Gathering {count} calls", extra={'count': len(to_make)})
+        pending_joins.expect(key, [result_key for _, result_key in to_make])
+        for call, result_key in to_make:
+            try:
+                # Calls carried out locally (or cached) give their result straight away.
+                message.results[result_key] = call()
+            except communication.ServiceCallPerformed:
+                pass
+            except Exception:
+                pending_joins.forget(key)
+                raise
+        pending_joins.join(key, message, result_keys)
+
+    if not all(result_key in message.results for result_key in result_keys):
+        logger.debug("Waiting for the results of gathered calls")
+        raise communication.ServiceCallPerformed("gather")
+    return [message.resolved_result(result_key) for result_key in result_keys]
+
+
+class DeferredGather(DeferredCall):
+    """
+    Calls to gather, to be made by yielding them from a continuation microservice.
+    """
+
+    def __init__(self, calls: tuple):
+        self.calls = calls
+
+    def __call__(self):
+        return gather(*self.calls)
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, ', '.join(repr(call) for call in self.calls))
+
+    def ready(self, message: communication.Message) -> bool:
+        # `gather` itself waits for any results that are still to arrive, without making the calls again.
+        return True
+
+
+def defer(*calls: DeferredCall) -> DeferredGather:
+    """
+    Gather `calls` by yielding them from a continuation microservice, which is sent the list of results.
+    """
+    return DeferredGather(calls)
+
+
+gather.defer = defer
@@ -1,7 +1,8 @@
-from kubernetes import client, config
-from kubernetes.client.rest import ApiException
+import json
 
-from microservice.core import settings
+from kubernetes import client, config
+from microservice.core import settings, utils
+from microservice.core.executor import IN_FLIGHT_METRIC, QUEUED_METRIC
 
 
 kube_api_configuration = None
@@ -34,142 +35,99 @@ def sanitise_name(name: str) -> str:
     return name
 
 
+class KubeApis:
+    """
+    Clients for each of the kubernetes APIs used, all sharing one connection pool.
+    """
+
+    def __init__(self, api_client: client.ApiClient=None):
+        """
+        :param api_client: Client to talk to the kubernetes API with. Defaults to one from the kube config.
+        """
+        if api_client is None:
+            load_kube_config()
+            api_client = client.ApiClient(configuration=kube_api_configuration)
+        self.api_client = api_client
+        self.core = client.CoreV1Api(api_client)
+        self.apps = client.AppsV1Api(api_client)
+        self.networking = client.NetworkingV1Api(api_client)
+        self.autoscaling = client.AutoscalingV2Api(api_client)
+
+
 class KubeMicroservice:
-    def __init__(self, name: str, exposed: bool=False):
+    def __init__(self, name: str, exposed: bool=False, image: str=None, resources: dict=None,
+                 min_replicas: int=None, max_replicas: int=None, target_cpu_utilization: int=None,
+                 service_kwargs: dict=None):
+        """
+        :param name: Name of the service.
+        :param exposed: Whether the service is exposed outside of the cluster.
+        :param image: Docker image the service runs from. Defaults to the image named after the service.
+        :param resources: Resource requirements of each pod, as a dict of 'requests' and 'limits'.
+            Defaults to `settings.kube_default_resources`.
+        :param min_replicas: Defaults to `settings.kube_default_min_replicas`.
+        :param max_replicas: Defaults to `settings.kube_default_max_replicas`.
+        :param target_cpu_utilization: Percentage CPU utilisation the autoscaler aims for.
+            Defaults to `settings.kube_default_target_cpu_utilization`.
+        :param service_kwargs: Additional keyword arguments for `service_host.initialise_microservice`. These must be
+            JSON serializable.
+        """
         # This must match the container name
         self.raw_name = name
 
         # K8s requires sanitised names for DNS purposes
         self.kube_name = sanitise_name(name)
         self.exposed = exposed
+        self.image = image if image is not None else name
+        self.resources = resources if resources is not None else settings.kube_default_resources
+        self.min_replicas = min_replicas if min_replicas is not None else settings.kube_default_min_replicas
+        self.max_replicas = max_replicas if max_replicas is not None else settings.kube_default_max_replicas
+        self.target_cpu_utilization = (target_cpu_utilization if target_cpu_utilization is not None
+                                       else settings.kube_default_target_cpu_utilization)
+        self.service_kwargs = service_kwargs if service_kwargs is not None else {}
+
+    @classmethod
+    def from_definition(cls, definition: utils.MicroserviceDefinition, image: str=None) -> 'KubeMicroservice':
+        return cls(
+            definition.name,
+            definition.exposed,
+            image=image,
+            resources=definition.resources,
+            min_replicas=definition.min_replicas,
+            max_replicas=definition.max_replicas,
+            target_cpu_utilization=definition.target_cpu_utilization,
+            service_kwargs=utils.service_host_kwargs(definition),
+        )
 
-        self.api: client.CoreV1Api = None
-        self.api_beta1: client.AppsV1beta1Api = None
-        self.api_extensions_beta1: client.ExtensionsV1beta1Api = None
-        self.api_autoscaling: client.AutoscalingV1Api = None
-
-        self._service: client.V1Service = None
-        self._deployment: client.AppsV1beta1Deployment = None
-        self._ingress: client.V1beta1Ingress = None
-        self._hpa: client.V1HorizontalPodAutoscaler = None
-
-    def deploy(self):
-
-        load_kube_config()
-
-        self.api = client.CoreV1Api(client.ApiClient(config=kube_api_configuration))
-        self.api_beta1 = client.AppsV1beta1Api(client.ApiClient(config=kube_api_configuration))
-        self.api_extensions_beta1 = client.ExtensionsV1beta1Api(client.ApiClient(config=kube_api_configuration))
-        self.api_autoscaling = client.AutoscalingV1Api(client.ApiClient(config=kube_api_configuration))
-
-        self.create_service()
-        self.create_deployment()
-        self.create_hpa()
-        if self.exposed:
-            self.create_ingress()
-
-    def create_service(self):
-        try:
-            self._service = self.api.create_namespaced_service(
-                namespace=settings.kube_namespace,
-                body=self.service_definition,
-                pretty=True,
-            )
-        except client.rest.ApiException as exp:
-            if 'AlreadyExists' not in exp.body:
-                raise
-            print("Service {0} already exists - patching.".format(self.kube_name))
-            try:
-                self.api.patch_namespaced_service(
-                    name=self.kube_name,
-                    namespace=settings.kube_namespace,
-                    body=self.service_definition,
-                    pretty=True,
-                )
-            except client.rest.ApiException as exp2:
-                if 'FieldValueDuplicate' in exp2.body:
-                    print("Possible cause:"
-                          "Patching mechanism doesn't cope with changing ports (it tries to add a second one) - "
-                          "manually delete the service resource and try again.")
-                raise
-
-    def create_deployment(self):
-        try:
-            self._deployment = self.api_beta1.create_namespaced_deployment(
-                namespace=settings.kube_namespace,
-                body=self.deployment_definition,
-                pretty=True,
-            )
-        except client.rest.ApiException as exp:
-            if 'AlreadyExists' not in exp.body:
-                raise
-            print("MicroserviceCluster {0} already exists - patching.".format(self.kube_name))
-            try:
-                self.api_beta1.patch_namespaced_deployment(
-                    name=self.kube_name,
-                    namespace=settings.kube_namespace,
-                    body=self.deployment_definition,
-                    pretty=True,
-                )
-            except client.rest.ApiException as exp2:
-                if 'FieldValueDuplicate' in exp2.body:
-                    print("Possible cause:"
-                          "Patching mechanism doesn't cope with changing ports (it tries to add a second one) - "
-                          "manually delete the deployment and pod resources and try again.")
-                raise
-
-    def create_ingress(self):
-        try:
-            self._ingress = self.api_extensions_beta1.create_namespaced_ingress(
-                namespace=settings.kube_namespace,
-                body=self.ingress_definition,
-                pretty=True,
-            )
-        except client.rest.ApiException as exp:
-            if 'AlreadyExists' not in exp.body:
-                raise
-            print("Ingress {0} already exists - patching.".format(self.kube_name))
-            self._ingress = self.api_extensions_beta1.patch_namespaced_ingress(
-                name=self.kube_name,
-                namespace=settings.kube_namespace,
-                body=self.ingress_definition,
-                pretty=True,
-            )
-
-    def create_hpa(self):
-        try:
-            self._hpa = self.api_autoscaling.create_namespaced_horizontal_pod_autoscaler(
-                namespace=settings.kube_namespace,
-                body=self.hpa_definition,
-                pretty=True,
-            )
-        except client.rest.ApiException as exp:
-            if 'AlreadyExists' not in exp.body:
-                raise
-            print("HPA {0} already exists - patching.".format(self.kube_name))
-            self._hpa = self.api_autoscaling.patch_namespaced_horizontal_pod_autoscaler(
-                name=self.kube_name,
-                namespace=settings.kube_namespace,
-                body=self.hpa_definition,
-                pretty=True,
-            )
+    def deploy(self, apis: KubeApis=None):
+        """
+        Create or update the kubernetes resources of this service. See `kube_reconciler.Reconciler` to deploy many
+        services at once.
+        """
+        from microservice.core.kube_reconciler import Reconciler
+        Reconciler(apis).reconcile([self])
 
     @property
     def deployment_definition(self):
-        return client.AppsV1beta1Deployment(
+        return client.V1Deployment(
             metadata=client.V1ObjectMeta(
                 name=self.kube_name,
                 namespace=settings.kube_namespace,
                 labels={'pycroservice': settings.kube_namespace},
             ),
-            spec=client.AppsV1beta1DeploymentSpec(
-                replicas=1,
+            spec=client.V1DeploymentSpec(
+                replicas=self.min_replicas,
                 selector=client.V1LabelSelector(
                     match_labels={'microservice': self.kube_name},
                 ),
                 template=client.V1PodTemplateSpec(
                     metadata=client.V1ObjectMeta(
                         labels={'microservice': self.kube_name},
+                        # Where Prometheus scrapes the request gauges autoscaled on from.
+                        annotations={
+                            'prometheus.io/scrape': 'true',
+                            'prometheus.io/port': '5000',
+                            'prometheus.io/path': settings.prometheus_metrics_path,
+                        },
                     ),
                     spec=self.pod_spec,
                 ),
@@ -195,19 +153,27 @@ class KubeMicroservice:
                 )
             )
 
+    @property
+    def container_args(self):
+        # Select the service to run, so that services can share an image.
+        args = [self.raw_name]
+        if self.service_kwargs:
+            args.extend(["--other_kwargs", json.dumps(self.service_kwargs, sort_keys=True)])
+        return args
+
     @property
     def pod_spec(self):
         return client.V1PodSpec(
             containers=[
                 client.V1Container(
                     name=self.kube_name,
-                    image=self.raw_name,
+                    image=self.image,
+                    args=self.container_args,
                     ports=[client.V1ContainerPort(container_port=5000)],
                     image_pull_policy='Never',
                     resources=client.V1ResourceRequirements(
-                        requests={
-                            'cpu': '100m',
-                        },
+                        requests=self.resources.get('requests'),
+                        limits=self.resources.get('limits'),
                     ),
                 ),
             ]
@@ -215,33 +181,68 @@ class KubeMicroservice:
 
     @property
     def ingress_definition(self):
-        return client.V1beta1Ingress(
+        return client.V1Ingress(
             metadata=client.V1ObjectMeta(
-                name=self.kube_name
+                name=self.kube_name,
+                namespace=settings.kube_namespace,
             ),
-            spec=client.V1beta1IngressSpec(
-                backend=client.V1beta1IngressBackend(
-                    service_name=self.kube_name,
-                    service_port=5000,
+            spec=client.V1IngressSpec(
+                default_backend=client.V1IngressBackend(
+                    service=client.V1IngressServiceBackend(
+                        name=self.kube_name,
+                        port=client.V1ServiceBackendPort(number=80),
+                    ),
                 )
             ),
         )
 
+    @property
+    def hpa_metrics(self):
+        """
+        Metrics the autoscaler scales on: CPU, and in ACTOR mode the requests in flight and queued in each pod. The
+        autoscaler goes with whichever needs the most replicas, so that IO bound services that queue up requests
+        while their CPU is idle are still scaled.
+        """
+        metrics = [
+            client.V2MetricSpec(
+                type="Resource",
+                resource=client.V2ResourceMetricSource(
+                    name="cpu",
+                    target=client.V2MetricTarget(type="Utilization", average_utilization=self.target_cpu_utilization),
+                ),
+            ),
+        ]
+        if settings.communication_mode == settings.CommunicationMode.ACTOR:
+            workers = self.service_kwargs.get('executor_workers') or settings.executor_workers
+            for metric, target in [
+                (IN_FLIGHT_METRIC, workers * settings.kube_target_in_flight_utilisation),
+                (QUEUED_METRIC, settings.kube_target_queued_requests),
+            ]:
+                metrics.append(client.V2MetricSpec(
+                    type="Pods",
+                    pods=client.V2PodsMetricSource(
+                        metric=client.V2MetricIdentifier(name=metric),
+                        target=client.V2MetricTarget(type="AverageValue", average_value="{:g}".format(target)),
+                    ),
+                ))
+        return metrics
+
     @property
     def hpa_definition(self):
-        return client.V1HorizontalPodAutoscaler(
+        return client.V2HorizontalPodAutoscaler(
             metadata=client.V1ObjectMeta(
                 name=self.kube_name,
                 namespace=settings.kube_namespace,
             ),
-            spec=client.V1HorizontalPodAutoscalerSpec(
-                min_replicas=1,
-                max_replicas=100,
-                scale_target_ref=client.V1CrossVersionObjectReference(
-                    kind="MicroserviceCluster",
+            spec=client.V2HorizontalPodAutoscalerSpec(
+                min_replicas=self.min_replicas,
+                max_replicas=self.max_replicas,
+                scale_target_ref=client.V2CrossVersionObjectReference(
+                    api_version="apps/v1",
+                    kind="Deployment",
                     name=self.kube_name,
                 ),
-                target_cpu_utilization_percentage=50,
+                metrics=self.hpa_metrics,
             ),
         )
 
@@ -251,19 +252,24 @@ def load_kube_config():
     if kube_api_configuration is not None:
         return
 
-    config.load_kube_config()
-    kube_api_configuration = client.Configuration()
+    try:
+        # Running in a pod, e.g. to watch the Endpoints of other services.
+        config.load_incluster_config()
+    except config.ConfigException:
+        config.load_kube_config()
+    kube_api_configuration = client.Configuration.get_default_copy()
+    # Enough connections for every concurrent request made by the reconciler.
+    kube_api_configuration.connection_pool_maxsize = max(kube_api_configuration.connection_pool_maxsize or 0,
+                                                         settings.kube_reconcile_workers)
 
 
-def pycroservice_init():
+def pycroservice_init(apis: KubeApis=None):
     """
     Initialise the generic k8s requirements for a new pycroservice deployment.
     Specifically:
      - Ensure that the namespace exists
     """
-    load_kube_config()
-
-    api = client.CoreV1Api(client.ApiClient(config=kube_api_configuration))
+    api = (apis if apis is not None else KubeApis()).core
     if settings.kube_namespace not in [ns.metadata.name for ns in api.list_namespace().items]:
         print("Kube namespace {0} doesn't exist - creating...".format(settings.kube_namespace))
         api.create_namespace(
@@ -0,0 +1,200 @@
+"""
+Discovering the pods of each service in kubernetes from its Endpoints, so that requests are sent straight to them.
+
+By default (see `settings.KubeDiscoveryMode`) requests are sent to the kubernetes Service of each service, so every
+request takes a DNS lookup and a hop through kube-proxy, and is balanced across pods by kube-proxy rather than by
+`load_balancing`. In ENDPOINTS mode, an `EndpointsWatcher` lists the Endpoints of every service in the namespace
+once, and then watches them for changes, keeping the uri of every ready pod of each service. Discovery is then
+answered from that cache, and changes are pushed to the `load_balancing.registry` as soon as they are seen - so that
+pods being added or removed is picked up without waiting for the next refresh.
+
+If a watch can't be resumed (because its resource version is too old), the Endpoints are listed again. Until the
+Endpoints have been listed (e.g. if the service account isn't allowed to list them), requests are sent to the
+kubernetes Service of each service, as in SERVICE mode.
+"""
+import logging
+import threading
+
+from kubernetes import client, watch
+from typing import Dict, List, Set
+
+from microservice.core import load_balancing, settings
+from microservice.core.kube import KubeApis, sanitise_name, uri_for_service
+
+logger = logging.getLogger(__name__)
+
+
+def uris_from_endpoints(endpoints: client.V1Endpoints) -> List[str]:
+    """
+    :return: The uri of every ready pod of the given Endpoints.
+    """
+    uris = []
+    for subset in endpoints.subsets or []:
+        if not subset.ports:
+            continue
+        # Services only have one port - see `KubeMicroservice.service_definition`.
+        port = subset.ports[0].port
+        for address in subset.addresses or []:
+            uris.append('http://{ip}:{port}/'.format(ip=address.ip, port=port))
+    return sorted(uris)
+
+
+class EndpointsWatcher:
+    """
+    Keeps the uris of the ready pods of every service in the namespace, from a watch of their Endpoints.
+    """
+
+    def __init__(self, apis: KubeApis=None, registry: load_balancing.EndpointRegistry=None):
+        """
+        :param apis: Clients to talk to the kubernetes API with. Defaults to those from the kube config.
+        :param registry: Registry told about changes to the pods of each service. Defaults to `load_balancing.registry`.
+        """
+        self.apis = apis if apis is not None else KubeApis()
+        self.registry = registry if registry is not None else load_balancing.registry
+        self.uris = {}  # type: Dict[str, List[str]]  # Keyed by kube name.
+        # The names of the services discovered, keyed by kube name.
+        self.service_names = {}  # type: Dict[str, Set[str]]
+        self.resource_version = None  # type: str
+        # Set once the Endpoints have been listed.
+        self.synced = threading.Event()
+        # Whether discovery has already given up waiting for the Endpoints to be listed.
+        self.fell_back = False
+        self._forbidden_logged = False
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._watch = None  # type: watch.Watch
+        self._thread = None  # type: threading.Thread
+
+    def set_uris(self, kube_name: str, uris: List[str]):
+        """
+        :param uris: Uris of the ready pods of the service, or None if its Endpoints were deleted.
+        """
+        with self._lock:
+            if self.uris.get(kube_name) == uris:
+                return
+            if uris is None:
+                del self.uris[kube_name]
+            else:
+                self.uris[kube_name] = uris
+            service_names = list(self.service_names.get(kube_name, ()))
+        for service_name in service_names:
+            self.registry.update(service_name, uris or [])
+
+    def relist(self):
+        endpoints_list = self.apis.core.list_namespaced_endpoints(namespace=settings.kube_namespace)
+        latest = {endpoints.metadata.name: uris_from_endpoints(endpoints) for endpoints in endpoints_list.items}
+        for kube_name in set(self.uris) - set(latest):
+            self.set_uris(kube_name, None)
+        for kube_name, uris in latest.items():
+            self.set_uris(kube_name, uris)
+        self.resource_version = endpoints_list.metadata.resource_version
+        self.synced.set()
+        logger.info("Listed the endpoints of {count} services", extra={'count': len(latest)})
+
+    def apply_event(self, event: dict):
+        endpoints = event['object']
+        if event['type'] == 'DELETED':
+            self.set_uris(endpoints.metadata.name, None)
+        elif event['type'] in ('ADDED', 'MODIFIED'):
+            self.set_uris(endpoints.metadata.name, uris_from_endpoints(endpoints))
+
+    def watch(self):
+        """
+        Apply the changes to the Endpoints since they were last seen, for `settings.kube_endpoints_watch_timeout`
+        seconds or until stopped.
+        """
+        with self._lock:
+            # Stopped since the last watch ended, so `stop` won't see this one.
+            if self._stop_event.is_set():
+                return
+            self._watch = watch.Watch()
+        for event in self._watch.stream(self.apis.core.list_namespaced_endpoints,
+                                        namespace=settings.kube_namespace,
+                                        resource_version=self.resource_version,
+                                        timeout_seconds=settings.kube_endpoints_watch_timeout):
+            self.apply_event(event)
+        if self._watch.resource_version is not None:
+            self.resource_version = self._watch.resource_version
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                    if self._stop_event.is_set():
+                        return
+                self.watch()
+            except client.rest.ApiException as exp:
+                if exp.status == 410:
+                    logger.info("Watch of endpoints expired, listing them again")
+                elif exp.status in (401, 403):
+                    # This won't fix itself until the role binding is changed, so don't log it on every retry.
+                    if not self._forbidden_logged:
+                        self._forbidden_logged = True
+                        logger.warning("Not allowed to list and watch endpoints in namespace {namespace}, so "
+                                       "requests are sent to kubernetes services instead. Grant the service "
+                                       "account list and watch on endpoints to fix this: {err}",
+                                       extra={'namespace': settings.kube_namespace, 'err': exp})
+                    self._stop_event.wait(settings.kube_endpoints_retry_interval)
+                else:
+                    logger.warning("Failed to watch endpoints: {err}", extra={'err': exp})
+                    self._stop_event.wait(settings.kube_endpoints_retry_interval)
+                self.resource_version = None
+            except Exception as err:
+                if self._stop_event.is_set():
+                    return
+                logger.warning("Failed to watch endpoints: {err}", extra={'err': err})
+                self.resource_version = None
+                self._stop_event.wait(settings.kube_endpoints_retry_interval)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stop_event.set()
+        if self._thread is None:
+            return
+        # A watch can only be stopped once its response has arrived, so keep stopping it until it is.
+        while self._thread.is_alive():
+            if self._watch is not None:
+                self._watch.stop()
+            self._thread.join(0.1)
+
+    def uris_for_service(self, service_name: str) -> List[str]:
+        """
+        :return: The uri of every ready pod of `service_name`. Falls back to the uri of its kubernetes Service if the
+            Endpoints haven't been listed within `settings.kube_endpoints_sync_timeout` seconds. Once it has fallen
+            back, discovery doesn't wait again, and the pods are pushed to the registry when they are listed.
+        """
+        self.start()
+        kube_name = sanitise_name(service_name)
+        with self._lock:
+            self.service_names.setdefault(kube_name, set()).add(service_name)
+        if not self.synced.wait(0 if self.fell_back else settings.kube_endpoints_sync_timeout):
+            if not self.fell_back:
+                self.fell_back = True
+                logger.warning("Endpoints haven't been listed, sending requests to kubernetes services until they are")
+            logger.debug("Sending requests for {service_name} to its service", extra={'service_name': service_name})
+            return [uri_for_service(service_name)]
+        with self._lock:
+            return list(self.uris.get(kube_name, []))
+
+
+watcher = None  # type: EndpointsWatcher
+watcher_lock = threading.Lock()
+
+
+def get_watcher() -> EndpointsWatcher:
+    """
+    Get the watcher of this process, creating (and starting) it if this is the first call.
+    """
+    global watcher
+    with watcher_lock:
+        if watcher is None:
+            watcher = EndpointsWatcher()
+            watcher.start()
+        return watcher
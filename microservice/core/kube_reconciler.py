@@ -0,0 +1,141 @@
+"""
+Reconciling the kubernetes resources of a deployment with the services being deployed.
+
+Rather than creating (and then patching, if it already exists) every resource of every service in turn, the existing
+resources are listed once per kind, and only those that are missing or have changed are created or patched -
+concurrently (up to `settings.kube_reconcile_workers` at a time), over one set of API clients. So a rollout takes as
+long as its changes, rather than its services.
+
+Whether a resource has changed is decided by the hash of its definition, which is recorded in an annotation of the
+resource whenever it is created or patched. Resources of services that are no longer deployed are left alone.
+"""
+import hashlib
+import json
+import logging
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client
+from typing import Dict, List
+
+from microservice.core import settings
+from microservice.core.kube import KubeApis, KubeMicroservice
+
+logger = logging.getLogger(__name__)
+
+# Annotation recording the hash of the definition a resource was last created or patched from.
+DEFINITION_HASH_ANNOTATION = "microservice/definition-hash"
+
+# A kind of resource, and how to get its definition from a `KubeMicroservice` and its API calls from `KubeApis`.
+Kind = namedtuple("Kind", ['name', 'definition', 'list', 'create', 'patch'])
+
+KINDS = [
+    Kind('service',
+         lambda service: service.service_definition,
+         lambda apis: apis.core.list_namespaced_service,
+         lambda apis: apis.core.create_namespaced_service,
+         lambda apis: apis.core.patch_namespaced_service),
+    Kind('deployment',
+         lambda service: service.deployment_definition,
+         lambda apis: apis.apps.list_namespaced_deployment,
+         lambda apis: apis.apps.create_namespaced_deployment,
+         lambda apis: apis.apps.patch_namespaced_deployment),
+    Kind('hpa',
+         lambda service: service.hpa_definition,
+         lambda apis: apis.autoscaling.list_namespaced_horizontal_pod_autoscaler,
+         lambda apis: apis.autoscaling.create_namespaced_horizontal_pod_autoscaler,
+         lambda apis: apis.autoscaling.patch_namespaced_horizontal_pod_autoscaler),
+    Kind('ingress',
+         lambda service: service.ingress_definition if service.exposed else None,
+         lambda apis: apis.networking.list_namespaced_ingress,
+         lambda apis: apis.networking.create_namespaced_ingress,
+         lambda apis: apis.networking.patch_namespaced_ingress),
+]
+
+# A resource to create or patch.
+Change = namedtuple("Change", ['kind', 'name', 'action', 'body'])
+
+
+class Reconciler:
+    def __init__(self, apis: KubeApis=None):
+        """
+        :param apis: Clients to talk to the kubernetes API with. Defaults to those from the kube config.
+        """
+        self.apis = apis if apis is not None else KubeApis()
+
+    def definition_hash(self, body) -> str:
+        serialized = self.apis.api_client.sanitize_for_serialization(body)
+        return hashlib.sha256(json.dumps(serialized, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def existing(self) -> Dict[str, Dict[str, str]]:
+        """
+        List the existing resources of every kind at once.
+
+        :return: The definition hash of each existing resource (None if it has none), keyed by kind and then name.
+        """
+        def list_kind(kind: Kind) -> Dict[str, str]:
+            resources = kind.list(self.apis)(namespace=settings.kube_namespace).items
+            return {resource.metadata.name: (resource.metadata.annotations or {}).get(DEFINITION_HASH_ANNOTATION)
+                    for resource in resources}
+
+        with ThreadPoolExecutor(max_workers=len(KINDS)) as executor:
+            return dict(zip([kind.name for kind in KINDS], executor.map(list_kind, KINDS)))
+
+    def plan(self, services: List[KubeMicroservice]) -> List[Change]:
+        """
+        :return: The resources of `services` that are missing or have changed.
+        """
+        existing = self.existing()
+        changes = []
+        for service in services:
+            for kind in KINDS:
+                body = kind.definition(service)
+                if body is None:
+                    continue
+                definition_hash = self.definition_hash(body)
+                name = body.metadata.name
+                if name not in existing[kind.name]:
+                    action = 'create'
+                elif existing[kind.name][name] != definition_hash:
+                    action = 'patch'
+                else:
+                    continue
+                body.metadata.annotations = dict(body.metadata.annotations or {},
+                                                 **{DEFINITION_HASH_ANNOTATION: definition_hash})
+                changes.append(Change(kind.name, name, action, body))
+        return changes
+
+    def apply(self, change: Change):
+        kind = next(kind for kind in KINDS if kind.name == change.kind)
+        logger.info("Applying {action} of {kind} {resource_name}",
+                    extra={'action': change.action, 'kind': change.kind, 'resource_name': change.name})
+        if change.action == 'create':
+            try:
+                kind.create(self.apis)(namespace=settings.kube_namespace, body=change.body)
+                return
+            except client.rest.ApiException as exp:
+                # Created since the resources were listed.
+                if exp.status != 409:
+                    raise
+        kind.patch(self.apis)(name=change.name, namespace=settings.kube_namespace, body=change.body)
+
+    def reconcile(self, services: List[KubeMicroservice]) -> List[Change]:
+        """
+        Create or patch the resources of `services` that are missing or have changed.
+
+        :return: The changes that were made.
+        :raises RuntimeError: If any of the changes failed. The others are still made.
+        """
+        changes = self.plan(services)
+        logger.info("Reconciling {count} services needs {changes} changes",
+                    extra={'count': len(services), 'changes': len(changes)})
+        if not changes:
+            return changes
+
+        with ThreadPoolExecutor(max_workers=settings.kube_reconcile_workers) as executor:
+            futures = [(change, executor.submit(self.apply, change)) for change in changes]
+        failures = [(change, future.exception()) for change, future in futures if future.exception() is not None]
+        if failures:
+            raise RuntimeError("Failed to apply {0} changes: {1}".format(len(failures), '; '.join(
+                "{0} {1}: {2}".format(change.kind, change.name, err) for change, err in failures)))
+        return changes
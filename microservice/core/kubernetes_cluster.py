@@ -1,4 +1,5 @@
 from microservice.core import kube, settings, dockr
+from microservice.core.kube_reconciler import Reconciler
 from microservice.core.microservice_cluster import MicroserviceCluster
 
 
@@ -10,14 +11,14 @@ class KubernetesMicroserviceCluster(MicroserviceCluster):
 
     def spawn_all_microservices(self):
         # Create all the required docker images
-        dockr.build_all_images([service.name for service in self.service_definitions])
+        images = dockr.build_all_images([service.name for service in self.service_definitions])
 
         k8s_services = [
-            kube.KubeMicroservice(service.name, service.exposed)
+            kube.KubeMicroservice.from_definition(service, image=images[service.name])
             for service in self.service_definitions
         ]
 
         # Build up the k8s deployment
-        kube.pycroservice_init()
-        for service in k8s_services:
-            service.deploy()
+        apis = kube.KubeApis()
+        kube.pycroservice_init(apis)
+        Reconciler(apis).reconcile(k8s_services)
@@ -0,0 +1,291 @@
+"""
+Client-side load balancing of requests across the instances of a service.
+
+Discovery (see `communication.uris_from_service_name`) gives the uri of every instance of a service, and each request
+is sent to the instance chosen by the load balancing policy of that service - `settings.load_balancing_policy`, or
+the per-service override in `settings.load_balancing_policies`. The instances are discovered again every
+`settings.endpoint_refresh_interval` seconds, so that instances being added or removed is picked up.
+
+The health of each instance is tracked from the requests sent to it: once `settings.endpoint_max_failures` requests
+in a row have failed to connect, it is skipped for `settings.endpoint_unhealthy_period` seconds (unless every
+instance is unhealthy).
+
+The load of each instance is the number of requests sent to it that haven't had a response yet, plus the work it last
+reported having queued or in progress (in the `settings.load_report_header` of its responses). In ACTOR mode requests
+are responded to as soon as they are queued, so without the reports every instance would look idle to the
+`LeastOutstanding` and `PowerOfTwoChoices` policies. Reports older than `settings.load_report_ttl` seconds are
+ignored, so that an instance that was busy isn't avoided forever.
+
+Policies are pluggable: subclass `Policy`, and use the subclass in place of a `settings.LoadBalancingPolicy`.
+"""
+import aiohttp
+import itertools
+import logging
+import random
+import requests
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+from microservice.core import settings
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean a request couldn't be sent to an instance at all.
+CONNECTION_ERRORS = (requests.ConnectionError, aiohttp.ClientConnectionError, ConnectionError)
+
+
+class Endpoint:
+    """
+    A single instance of a service.
+    """
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        # Number of requests sent to this instance that haven't had a response yet.
+        self.outstanding = 0
+        # Number of requests the instance last reported having queued or in progress, and when.
+        self.reported_load = 0
+        self.reported_at = None  # type: float
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.uri)
+
+    def is_healthy(self, now: float) -> bool:
+        return self.unhealthy_until <= now
+
+    @property
+    def load(self) -> int:
+        """
+        Number of requests sent to this instance that haven't had a response yet, or that it is still carrying out.
+        """
+        reported_at = self.reported_at
+        if reported_at is None or time.monotonic() - reported_at > settings.load_report_ttl:
+            return self.outstanding
+        return self.outstanding + self.reported_load
+
+    def report_load(self, reported_load):
+        """
+        :param reported_load: Value of the `settings.load_report_header` of a response from this instance, or None if
+            it didn't have one.
+        """
+        if reported_load is None:
+            return
+        try:
+            self.reported_load = int(reported_load)
+        except ValueError:
+            return
+        self.reported_at = time.monotonic()
+
+    def metrics(self) -> dict:
+        return {
+            'outstanding': self.outstanding,
+            'load': self.load,
+            'requests': self.requests,
+            'failures': self.failures,
+            'healthy': self.is_healthy(time.monotonic()),
+        }
+
+
+class Policy:
+    """
+    Chooses which instance of a service to send each request to. Each service has its own instance of its policy.
+    """
+
+    def choose(self, endpoints: List[Endpoint]) -> Endpoint:
+        """
+        :param endpoints: Instances to choose from. There is always at least one.
+        """
+        raise NotImplementedError()
+
+
+class RoundRobin(Policy):
+    def __init__(self):
+        # `next` on an `itertools.count` is atomic, so no lock is needed to share this between threads.
+        self._counter = itertools.count()
+
+    def choose(self, endpoints: List[Endpoint]) -> Endpoint:
+        return endpoints[next(self._counter) % len(endpoints)]
+
+
+class LeastOutstanding(Policy):
+    def choose(self, endpoints: List[Endpoint]) -> Endpoint:
+        loads = [(endpoint, endpoint.load) for endpoint in endpoints]
+        least = min(load for _, load in loads)
+        return random.choice([endpoint for endpoint, load in loads if load == least])
+
+
+class PowerOfTwoChoices(Policy):
+    """
+    Picks two instances at random, and chooses the one with the lower load. This is nearly as good as
+    `LeastOutstanding`, without every client sending its requests to the same (least loaded) instance.
+    """
+
+    def choose(self, endpoints: List[Endpoint]) -> Endpoint:
+        if len(endpoints) == 1:
+            return endpoints[0]
+        first, second = random.sample(endpoints, 2)
+        return first if first.load <= second.load else second
+
+
+policies = {
+    settings.LoadBalancingPolicy.ROUND_ROBIN: RoundRobin,
+    settings.LoadBalancingPolicy.LEAST_OUTSTANDING: LeastOutstanding,
+    settings.LoadBalancingPolicy.POWER_OF_TWO_CHOICES: PowerOfTwoChoices,
+}
+
+
+def create_policy(service_name: str) -> Policy:
+    policy = settings.load_balancing_policies.get(service_name, settings.load_balancing_policy)
+    if isinstance(policy, str):
+        policy = settings.LoadBalancingPolicy(policy.upper())
+    if isinstance(policy, settings.LoadBalancingPolicy):
+        policy = policies[policy]
+    return policy()
+
+
+class ServiceEndpoints:
+    """
+    Every known instance of a service, and how busy and healthy each of them is.
+    """
+
+    def __init__(self, service_name: str, uris: List[str], policy: Policy=None):
+        self.service_name = service_name
+        self.policy = policy if policy is not None else create_policy(service_name)
+        self.endpoints = []  # type: List[Endpoint]
+        self.refreshed_at = None  # type: float
+        self._lock = threading.Lock()
+        self.update(uris)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def update(self, uris: List[str]):
+        """
+        Set the uris of the instances of the service. Instances that were already known keep their stats.
+        """
+        with self._lock:
+            known = {endpoint.uri: endpoint for endpoint in self.endpoints}
+            self.endpoints = [known.get(uri) or Endpoint(uri) for uri in uris]
+            self.refreshed_at = time.monotonic()
+        if set(uris) != set(known):
+            logger.info("Instances of {service_name} are: {uris}",
+                        extra={'service_name': self.service_name, 'uris': uris})
+
+    def choose(self, exclude: tuple=()) -> Endpoint:
+        """
+        :param exclude: Endpoints not to choose, unless there are no others.
+        """
+        now = time.monotonic()
+        with self._lock:
+            endpoints = self.endpoints
+        if not endpoints:
+            raise LookupError("No instances of {} found.".format(self.service_name))
+        candidates = [endpoint for endpoint in endpoints if endpoint.is_healthy(now) and endpoint not in exclude]
+        if not candidates:
+            candidates = [endpoint for endpoint in endpoints if endpoint not in exclude] or endpoints
+        return self.policy.choose(candidates)
+
+    @contextmanager
+    def request(self, exclude: tuple=()) -> Iterator[Endpoint]:
+        """
+        Choose an endpoint to send a request to, and count the request as outstanding until the context is exited.
+        Connection errors raised within the context count against the health of the endpoint.
+        """
+        endpoint = self.choose(exclude)
+        with self._lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        try:
+            yield endpoint
+        except CONNECTION_ERRORS:
+            self.record_failure(endpoint)
+            raise
+        else:
+            endpoint.consecutive_failures = 0
+        finally:
+            with self._lock:
+                endpoint.outstanding -= 1
+
+    def record_failure(self, endpoint: Endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= settings.endpoint_max_failures:
+                endpoint.unhealthy_until = time.monotonic() + settings.endpoint_unhealthy_period
+                logger.warning("Instance of {service_name} at {uri} is unhealthy",
+                               extra={'service_name': self.service_name, 'uri': endpoint.uri})
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {endpoint.uri: endpoint.metrics() for endpoint in self.endpoints}
+
+
+class EndpointRegistry:
+    """
+    The instances of every service this process has sent requests to, keyed by service name.
+    """
+
+    def __init__(self):
+        self._services = {}  # type: Dict[str, ServiceEndpoints]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._services)
+
+    def get(self, service_name: str, discover) -> ServiceEndpoints:
+        """
+        :param str service_name: Service to get the instances of.
+        :param discover: Function that returns the list of uris of the instances of a service, given its name. Only
+            called if the service hasn't been discovered in the last `settings.endpoint_refresh_interval` seconds.
+        """
+        service = self._services.get(service_name)
+        if service is None:
+            with self._lock:
+                service = self._services.get(service_name)
+                if service is None:
+                    service = ServiceEndpoints(service_name, discover(service_name))
+                    self._services[service_name] = service
+        elif time.monotonic() - service.refreshed_at > settings.endpoint_refresh_interval:
+            # Don't hold up other requests to this service while discovering it.
+            service.refreshed_at = time.monotonic()
+            try:
+                service.update(discover(service_name))
+            except Exception as err:
+                logger.warning("Failed to refresh instances of {service_name}: {err}",
+                               extra={'service_name': service_name, 'err': err})
+        return service
+
+    def needs_discovery(self, service_name: str) -> bool:
+        """
+        :return: Whether getting `service_name` would call its discovery function, which may block on I/O.
+        """
+        service = self._services.get(service_name)
+        return service is None or time.monotonic() - service.refreshed_at > settings.endpoint_refresh_interval
+
+    def update(self, service_name: str, uris: List[str]):
+        """
+        Set the uris of the instances of `service_name`, if it has been discovered. For discovery that is told about
+        changes, rather than polled for them.
+        """
+        service = self._services.get(service_name)
+        if service is not None:
+            service.update(uris)
+
+    def clear(self):
+        with self._lock:
+            self._services.clear()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            services = dict(self._services)
+        return {service_name: service.metrics() for service_name, service in services.items()}
+
+
+registry = EndpointRegistry()
@@ -63,18 +63,42 @@ class MicroserviceCluster:
     def uri_for_service(self, service_name):
         pass
 
+    def uris_for_service(self, service_name) -> List[str]:
+        """
+        :return: The uri of every instance of `service_name`.
+        """
+        return [self.uri_for_service(service_name)]
+
+    def scale(self, service_name, replicas: int) -> List[str]:
+        """
+        Change the number of instances of `service_name` while the deployment is running.
+
+        :return: The uri of every instance of `service_name` once scaled.
+        """
+        raise NotImplementedError("{} can't be scaled.".format(self.__class__.__name__))
+
     def send_request_to_all_services(self, uri_route, data=None, method=requests.get):
+        """
+        Send a request to every instance of every service.
+
+        :return dict: Response from each instance, keyed by its uri.
+        """
+        uris = [uri for service_name in self.services.keys() for uri in self.uris_for_service(service_name)]
+        return self.send_request_to_uris(uris, uri_route, data=data, method=method)
+
+    @staticmethod
+    def send_request_to_uris(uris, uri_route, data=None, method=requests.get):
         results = dict()
 
-        def make_request(_service_nane):
+        def make_request(_uri):
             response = method(
-                self.uri_for_service(_service_nane) + uri_route,
+                _uri + uri_route,
                 data=data,
             )
-            results[_service_nane] = response
+            results[_uri] = response
 
         with ThreadPoolExecutor() as executor:
-            executor.map(make_request, self.services.keys())
+            executor.map(make_request, uris)
 
         return results
 
@@ -27,10 +27,14 @@ def overflow_handler(pendings):
 class RequestIDLogFilter(logging.Filter):
     """
     Log filter to inject the current request id of the request under `log_record.request_id`
+
+    A request id given explicitly with `extra={'request_id': ...}` takes precedence, which allows logging about
+    requests that aren't the one currently being handled (e.g. the responses received by an interface).
     """
 
     def filter(self, log_record):
-        log_record.request_id = settings.current_request_id()
+        if getattr(log_record, 'request_id', None) is None:
+            log_record.request_id = settings.current_request_id()
         return log_record
 
 
@@ -0,0 +1,162 @@
+"""
+Memoization of the results of pure microservices, enabled with `@microservice(cache=...)`.
+
+Results are cached in memory by each instance, keyed by result key (i.e. the canonicalised service name, args and
+kwargs), and evicted least-recently-used first once `max_size` results are cached, or once they are older than `ttl`.
+
+Caches can optionally share results between instances, using `microservice.core.memcached_wrapper`. Looking up a
+shared result is itself a call to a microservice, so the shared tier is only used where that call can be made
+without blocking the actor model - i.e. in ZERO and SYN modes, and from interfaces in ACTOR mode. Within a service in
+ACTOR mode, only the in-memory tier is used.
+"""
+import inspect
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Dict
+
+from microservice.core import settings
+
+logger = logging.getLogger(__name__)
+
+# Every cache in this process, keyed by service name.
+caches = {}  # type: Dict[str, ResultCache]
+
+
+class ResultCache:
+    def __init__(self, max_size: int=None, ttl: float=None, shared: bool=False):
+        """
+        :param int max_size: Maximum number of results cached in memory. Defaults to `settings.cache_max_size`.
+        :param float ttl: Number of seconds results are cached for. Defaults to `settings.cache_ttl`.
+            None means results don't expire.
+        :param bool shared: Whether to share results with the other instances of the service.
+        """
+        self.max_size = max_size if max_size is not None else settings.cache_max_size
+        self.ttl = ttl if ttl is not None else settings.cache_ttl
+        self.shared = shared
+        self.service_name = None  # type: str
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def _expiry(self, now: float):
+        return now + self.ttl if self.ttl is not None else None
+
+    def get(self, key) -> tuple:
+        """
+        :param key: Result key of the call.
+        :return: (True, result) if the result of the call is cached, otherwise (False, None).
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                expires_at, result = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._results.move_to_end(key)
+                    self.hits += 1
+                    return True, result
+                del self._results[key]
+                self.evictions += 1
+
+        if self.shared and shared_tier_available():
+            found, result = self._get_shared(key)
+            if found:
+                self._put_local(key, result)
+                with self._lock:
+                    self.shared_hits += 1
+                return True, result
+
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, key, result):
+        """
+        Cache the result of a call. Exceptions and generators (which can only be iterated over once) aren't cached.
+        """
+        if isinstance(result, Exception) or inspect.isgenerator(result):
+            return
+        self._put_local(key, result)
+        if self.shared and shared_tier_available():
+            self._put_shared(key, result)
+
+    def _put_local(self, key, result):
+        with self._lock:
+            self._results[key] = (self._expiry(time.monotonic()), result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+                self.evictions += 1
+
+    def _get_shared(self, key) -> tuple:
+        from microservice.core import memcached_wrapper
+
+        # Wall clock time is used, as the expiry is compared by other instances (possibly on other hosts).
+        entry = memcached_wrapper.get(key)
+        if entry is None:
+            return False, None
+        expires_at, result = entry
+        if expires_at is not None and expires_at <= time.time():
+            return False, None
+        return True, result
+
+    def _put_shared(self, key, result):
+        from microservice.core import memcached_wrapper
+
+        memcached_wrapper.put(key, (self._expiry(time.time()), result))
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._results),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def shared_tier_available() -> bool:
+    """
+    Whether a call to the shared tier can be made and waited for here.
+    """
+    return (settings.deployment_mode == settings.DeploymentMode.ZERO or
+            settings.communication_mode == settings.CommunicationMode.SYN or
+            settings.current_message() is None)
+
+
+def create_cache(service_name: str, cache) -> ResultCache:
+    """
+    :param str service_name: Service whose results are to be cached.
+    :param cache: The `cache` option given to `@microservice`: True for the defaults, a dict of kwargs for
+        `ResultCache`, or a `ResultCache`.
+    """
+    if cache is True:
+        cache = ResultCache()
+    elif isinstance(cache, dict):
+        cache = ResultCache(**cache)
+    elif not isinstance(cache, ResultCache):
+        raise ValueError("Invalid cache option for {}: {}".format(service_name, cache))
+    cache.service_name = service_name
+    caches[service_name] = cache
+    return cache
+
+
+def metrics() -> dict:
+    """
+    :return dict: Metrics of every cache in this process, keyed by service name.
+    """
+    return {service_name: cache.metrics() for service_name, cache in caches.items()}
@@ -0,0 +1,112 @@
+"""
+HTTP servers that a flask app can be hosted on. The backend is chosen by `settings.server_backend`.
+
+ - WERKZEUG: The werkzeug development server, run in a background thread. Single process, one thread per request.
+ - GUNICORN: Pre-fork gunicorn server with `workers` processes, each running `threads` threads. This blocks the
+    calling thread (which must be the main thread) until the server is shut down.
+
+All backends support graceful shutdown using `shutdown`, which can safely be called from a request handler.
+"""
+import logging
+import os
+import signal
+import threading
+
+from flask import Flask
+from werkzeug.serving import make_server
+
+from microservice.core import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Server:
+    blocking = False
+    # Whether each of the `workers` is a separate process, with its own copy of any state kept by the app.
+    multiprocess = False
+
+    def __init__(self, app: Flask, host: str, port: int, workers: int=None, threads: int=None):
+        self.app = app
+        self.host = host
+        self.port = int(port)
+        self.workers = workers if workers is not None else settings.server_workers
+        self.threads = threads if threads is not None else settings.server_threads
+
+    def start(self):
+        """
+        Start serving requests. Non-blocking servers return immediately, blocking servers return after shutdown.
+        """
+        raise NotImplementedError()
+
+    def shutdown(self):
+        """
+        Stop accepting new requests, and stop the server once in-flight requests are complete.
+        """
+        raise NotImplementedError()
+
+
+class WerkzeugServer(Server):
+    def __init__(self, *args, **kwargs):
+        super(WerkzeugServer, self).__init__(*args, **kwargs)
+        self._server = make_server(self.host, self.port, self.app, threaded=True)
+        self.thread = None  # type: threading.Thread
+
+    def start(self):
+        self.thread = threading.Thread(target=self._server.serve_forever)
+        self.thread.start()
+
+    def shutdown(self):
+        # `shutdown` waits for the serving thread to stop, so must not be called directly from a request handler.
+        threading.Thread(target=self._server.shutdown).start()
+
+
+class GunicornServer(Server):
+    blocking = True
+    multiprocess = True
+
+    def __init__(self, *args, **kwargs):
+        super(GunicornServer, self).__init__(*args, **kwargs)
+        self.arbiter_pid = None
+
+    def start(self):
+        from gunicorn.app.base import BaseApplication
+
+        server = self
+
+        class Application(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', "{}:{}".format(server.host, server.port))
+                self.cfg.set('workers', server.workers)
+                self.cfg.set('threads', server.threads)
+                self.cfg.set('worker_class', 'gthread')
+                self.cfg.set('graceful_timeout', settings.server_graceful_timeout)
+
+            def load(self):
+                return server.app
+
+        logger.info("Starting gunicorn with {workers} workers of {threads} threads",
+                    extra={'workers': self.workers, 'threads': self.threads})
+        self.arbiter_pid = os.getpid()
+        Application().run()
+
+    def shutdown(self):
+        # SIGTERM tells the gunicorn arbiter to shut down gracefully, waiting for workers to finish their requests.
+        os.kill(self.arbiter_pid, signal.SIGTERM)
+
+
+server_backends = {
+    settings.ServerBackend.WERKZEUG: WerkzeugServer,
+    settings.ServerBackend.GUNICORN: GunicornServer,
+}
+
+
+def create_server(app: Flask, host: str, port: int, backend: settings.ServerBackend=None, **kwargs) -> Server:
+    """
+    :param app: Flask app to serve.
+    :param host: Host to listen on.
+    :param port: Port to listen on.
+    :param backend: Which server to use. Defaults to `settings.server_backend`.
+    :param kwargs: Passed to the server, e.g. `workers` and `threads`.
+    """
+    backend = settings.ServerBackend(backend) if backend is not None else settings.server_backend
+    return server_backends[backend](app, host, port, **kwargs)
@@ -1,12 +1,18 @@
+import inspect
 import logging
-import pickle
+import queue
 import requests
+import socket
 import threading
 
-from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from typing import Iterator
 
-from microservice.core import settings, communication, utils
+from microservice.core import (codec, settings, communication, continuation, load_balancing, result_cache, side_store,
+                                utils)
+from microservice.core.executor import (BoundedExecutor, ExecutorFull, IN_FLIGHT_METRIC, QUEUED_METRIC,
+                                        shutdown_process_pool)
+from microservice.core.server import create_server
 
 logger = logging.getLogger(__name__)
 
@@ -26,23 +32,6 @@ class StoppableThread(threading.Thread):
         return self._stop_event.is_set()
 
 
-def configure_microservice():
-    """
-    Configure the flask app. If this is called a second time, it tears down the existing app and re-creates it.
-    """
-    global app, executor
-    app = Flask(__name__)
-    if settings.communication_mode == settings.CommunicationMode.ACTOR:
-        executor = ThreadPoolExecutor(max_workers=5)
-
-    logger.info("Microservice configured")
-
-
-app = None  # type: Flask
-executor = None  # type: ThreadPoolExecutor
-configure_microservice()
-
-
 class InvalidUsage(Exception):
     status_code = 400
 
@@ -59,21 +48,119 @@ class InvalidUsage(Exception):
         return rv
 
 
-@app.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
     return response
 
 
+def metrics():
+    """
+    Report how busy this service is.
+    """
+    return jsonify({
+        'service_name': settings.ServiceWaypost.local_service if settings.ServiceWaypost else None,
+        'communication_mode': settings.communication_mode.value,
+        'executor': executor.metrics() if executor is not None else None,
+        'caches': result_cache.metrics(),
+        'continuations': continuation.suspended_calls.metrics(),
+        'endpoints': load_balancing.registry.metrics(),
+    })
+
+
+def prometheus_metrics():
+    """
+    Report how busy the executor of this service is, in the Prometheus text format, so that it can be scraped and
+    autoscaled on. There's nothing to report unless this service has an executor (i.e. is in ACTOR mode).
+    """
+    lines = []
+    if executor is not None:
+        service_name = settings.ServiceWaypost.local_service if settings.ServiceWaypost else ""
+        labels = '{{service="{0}"}}'.format(str(service_name).replace('\\', '\\\\').replace('"', '\\"'))
+        executor_metrics = executor.metrics()
+        for metric, metric_type, description, value in [
+            (IN_FLIGHT_METRIC, 'gauge', "Requests being carried out.", executor_metrics['active_workers']),
+            (QUEUED_METRIC, 'gauge', "Requests waiting for a free worker.", executor_metrics['queue_depth']),
+            ("microservice_executor_workers", 'gauge', "Requests that can be carried out at once.",
+             executor_metrics['max_workers']),
+            ("microservice_requests_rejected_total", 'counter', "Requests refused because the queue was full.",
+             executor_metrics['rejected']),
+        ]:
+            lines.extend([
+                "# HELP {0} {1}".format(metric, description),
+                "# TYPE {0} {1}".format(metric, metric_type),
+                "{0}{1} {2}".format(metric, labels, value),
+            ])
+    return Response("".join(line + "\n" for line in lines), mimetype="text/plain; version=0.0.4")
+
+
+def report_load(response: Response) -> Response:
+    """
+    Tell the caller how much work this service has queued or in progress, so that it can choose the least loaded
+    instance to send its next request to. See `load_balancing.Endpoint.load`.
+    """
+    if executor is not None:
+        response.headers[settings.load_report_header] = str(executor.queue_depth + executor.active_workers)
+    return response
+
+
+def side_store_value(key):
+    """
+    Serve a value from this service's side store.
+    """
+    try:
+        return side_store.local_store.get(key)
+    except side_store.SideStoreExpired:
+        return Response("No such value", status=404)
+
+
+def configure_microservice(executor_workers: int=None, executor_queue_size: int=None):
+    """
+    Configure the flask app. If this is called a second time, it tears down the existing app and re-creates it.
+
+    :param executor_workers: Number of requests carried out at once in ACTOR mode.
+        Defaults to `settings.executor_workers`.
+    :param executor_queue_size: Number of requests allowed to wait for a free worker in ACTOR mode.
+        Defaults to `settings.executor_queue_size`.
+    """
+    global app, executor
+    app = Flask(__name__)
+    app.register_error_handler(InvalidUsage, handle_invalid_usage)
+    app.after_request(report_load)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    app.add_url_rule(settings.prometheus_metrics_path, 'prometheus_metrics', prometheus_metrics)
+    app.add_url_rule('/side_store/<key>', 'side_store', side_store_value)
+
+    if executor is not None:
+        executor.shutdown(wait=False)
+        executor = None
+    # Worker processes are set up for the service being hosted, so can't be re-used.
+    shutdown_process_pool(wait=False)
+    if settings.communication_mode == settings.CommunicationMode.ACTOR:
+        executor = BoundedExecutor(
+            max_workers=executor_workers if executor_workers is not None else settings.executor_workers,
+            max_queue_size=executor_queue_size if executor_queue_size is not None else settings.executor_queue_size,
+        )
+
+    logger.info("Microservice configured")
+
+
+app = None  # type: Flask
+executor = None  # type: BoundedExecutor
+configure_microservice()
+
+
 def carry_out_local_service(message: communication.Message):
     # Actually carry out the service.
     try:
         logger.debug("Calling local function")
         result = settings.ServiceWaypost.local_function(__message=message)
+        if inspect.isgenerator(result):
+            # Callers that aren't streaming the result get all of it at once.
+            result = list(result)
         logger.debug("Result is: {result}", extra={'result': result})
     except communication.ServiceCallPerformed as e:
-        logger.info("Nested service call complete: {nested_service}", extra={'nested_service', str(e)})
+        logger.info("Nested service call complete: {nested_service}", extra={'nested_service': str(e)})
         result = None
     except Exception as err:
         logger.exception("Unexpected exception: {err}", exc_info=True, stack_info=True,  extra={'err': err})
@@ -81,6 +168,108 @@ def carry_out_local_service(message: communication.Message):
     return result
 
 
+def carry_out_batch_message(message: communication.Message):
+    """
+    Carry out a message of a batch, and return its result.
+
+    As with `carry_out_local_service`, the result of a message that raised an exception is that exception.
+    """
+    settings.thread_locals.responding_directly = True
+    settings.set_current_message(message)
+    try:
+        return carry_out_local_service(message)
+    finally:
+        settings.set_current_message(None)
+        settings.thread_locals.responding_directly = False
+
+
+def carry_out_batch(messages: list) -> list:
+    """
+    Carry out each message of a batch in turn, and return all the results.
+    """
+    return [carry_out_batch_message(message) for message in messages]
+
+
+def stream_local_service(message: communication.Message) -> Iterator[bytes]:
+    """
+    Carry out the service, and stream each item it generates as a frame (see `codec.dumps_frame`).
+
+    The service generates each item as the previous one is sent, so at most one item is held in memory at a time.
+    An exception raised by the service is sent as the final frame.
+    """
+    settings.set_current_message(message)
+    settings.thread_locals.responding_directly = True
+    result = None
+    try:
+        result = settings.ServiceWaypost.local_function(__message=message)
+        items = result if inspect.isgenerator(result) else [result]
+        for item in items:
+            yield codec.dumps_frame(item)
+    except Exception as err:
+        logger.exception("Unexpected exception: {err}", exc_info=True, stack_info=True, extra={'err': err})
+        yield codec.dumps_frame(err, codec.FRAME_ERROR)
+    finally:
+        if inspect.isgenerator(result):
+            # Stop the service generating any more items if the caller has gone away.
+            result.close()
+        settings.set_current_message(None)
+        settings.thread_locals.responding_directly = False
+
+
+class ExecutorStream:
+    """
+    Equivalent of `stream_local_service` that generates the frames in the executor, so that a stream takes up a worker
+    (and is counted in its metrics) for as long as it is being generated, like any other request.
+
+    Each frame is generated once the previous one has been taken to be sent. Once closed (e.g. because the caller has
+    gone away), the service stops generating items.
+    """
+    # Marks the end of the frames.
+    END = object()
+
+    def __init__(self, message: communication.Message):
+        """
+        :raises ExecutorFull: If the queue is full.
+        """
+        self._frames = queue.Queue(maxsize=1)
+        self._closed = threading.Event()
+        executor.submit(self._generate, message)
+
+    def _generate(self, message: communication.Message):
+        frames = stream_local_service(message)
+        try:
+            for frame in frames:
+                self._frames.put(frame)
+                if self._closed.is_set():
+                    return
+        finally:
+            frames.close()
+            if not self._closed.is_set():
+                self._frames.put(self.END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        frame = self._frames.get()
+        if frame is self.END:
+            raise StopIteration()
+        return frame
+
+    def close(self):
+        self._closed.set()
+        # Make room for the frame being generated, so that it doesn't block once closed.
+        try:
+            self._frames.get_nowait()
+        except queue.Empty:
+            pass
+
+
+def busy_response() -> Response:
+    # Tell the caller to back off and try again, rather than queueing work without limit.
+    return Response("Service busy", status=503, headers={'Retry-After': str(settings.executor_retry_after)})
+
+
 def perform_service_async(message: communication.Message):
     if message.via:
         return_service = message.via[-1].service_name
@@ -104,7 +293,12 @@ def perform_service_async(message: communication.Message):
         # Send message back to calling party (which is the last via header)
         return_message = communication.construct_message_with_result(message, result)
         logger.debug("Return message is: {microservice_message}", extra={'microservice_message': message})
-        communication.send_object_to_service(return_service, return_message)
+        try:
+            communication.send_object_to_service(return_service, return_message)
+        except Exception as err:
+            # Nothing is waiting on this (executor) thread, so make sure the failure is seen.
+            logger.exception("Failed to return result to {return_service}: {err}",
+                             extra={'return_service': return_service, 'err': err})
     settings.set_current_message(None)
 
 
@@ -116,13 +310,18 @@ def handle_interface_callback(__message: communication.Message):
     :param __message:
     """
     logger.debug("Handling interface callback: {microservice_message}", extra={'microservice_message': __message})
-    if __message.request_id in settings.interface_requests.keys():
-        result_key = settings.interface_requests[__message.request_id]
-        del settings.interface_requests[__message.request_id]
-    else:
-        raise RuntimeError("Received unexpected message. No corresponding request was made first.")
+    result_key = settings.interface_requests.pop(__message.request_id, None)
+    if result_key is None:
+        # Either no corresponding request was made first, or the request has since timed out or been cancelled.
+        logger.warning("Discarding unexpected response to request_id: {request_id}",
+                       extra={'request_id': __message.request_id})
+        return None
     logger.debug("Interface callback is for result_key: {result_key}", extra={'result_key': result_key})
-    settings.set_interface_result(__message.request_id, __message.results[result_key])
+    try:
+        result = __message.resolved_result(result_key)
+    except side_store.SideStoreExpired as err:
+        result = err
+    settings.set_interface_result(__message.request_id, result)
 
 
 def add_local_service(service_name, no_local_function=False):
@@ -133,11 +332,13 @@ def add_local_service(service_name, no_local_function=False):
     def new_service():
         logger.info("Service {service_name} received request", extra={'service_name': service_name})
         if request.data:
-            msg = pickle.loads(request.data)
+            msg = codec.loads(request.data)
+            # The args are needed straight away (if only to look up results), so fetch them now if they were stored.
+            msg.resolve_args()
         else:
             msg = communication.Message()
 
-        logger.debug("Unpickled message is: {microservice_message}", extra={'microservice_message': msg})
+        logger.debug("Decoded message is: {microservice_message}", extra={'microservice_message': msg})
 
         if settings.communication_mode == settings.CommunicationMode.SYN:
             # Use flasks thread-safe globals for access to the current message.
@@ -149,20 +350,65 @@ def add_local_service(service_name, no_local_function=False):
             logger.debug("Return message is: {microservice_message}", extra={'microservice_message': return_message})
 
             settings.set_current_message(None)
-            return pickle.dumps(return_message)
+            return codec.dumps(return_message)
         elif settings.communication_mode == settings.CommunicationMode.ACTOR:
             # Kick off the process to do the work and send the response.
             logger.debug("Submitting work to executor")
 
             # Unlike the synchronous mode, we don't set the current_message variable here because we're
             # going to handle it using thread locals in the async call.
-            executor.submit(perform_service_async, msg)
+            try:
+                executor.submit(perform_service_async, msg)
+            except ExecutorFull:
+                return busy_response()
 
             logger.debug("Asynchronous request has been scheduled.")
             # Ack the request.
-            return pickle.dumps(True)
+            return codec.dumps(True)
         raise ValueError("Invalid deployment mode: {}".format(settings.communication_mode))
 
+    @app.route('/batch', methods=['GET', 'POST'])
+    def batch():
+        """
+        Carry out a list of messages, and respond with the list of their results (in the same order).
+
+        Unlike requests to the service itself, this always responds with the results, in both SYN and ACTOR mode.
+        """
+        messages = codec.loads(request.data)
+        logger.info("Service {service_name} received batch of {count} requests",
+                    extra={'service_name': service_name, 'count': len(messages)})
+        if executor is None:
+            results = carry_out_batch(messages)
+        else:
+            # Each message is carried out by the next free worker, so that a batch is carried out in parallel.
+            try:
+                futures = executor.submit_all(carry_out_batch_message, [(message,) for message in messages])
+            except ExecutorFull:
+                return busy_response()
+            results = [future.result() for future in futures]
+        return codec.dumps(results)
+
+    @app.route('/stream', methods=['GET', 'POST'])
+    def stream():
+        """
+        Carry out the service, streaming its result as it is generated rather than responding with it all at once.
+
+        Like `batch`, this always responds directly, in both SYN and ACTOR mode.
+        """
+        if request.data:
+            msg = codec.loads(request.data)
+        else:
+            msg = communication.Message()
+        logger.info("Service {service_name} received stream request", extra={'service_name': service_name})
+        if executor is None:
+            frames = stream_with_context(stream_local_service(msg))
+        else:
+            try:
+                frames = ExecutorStream(msg)
+            except ExecutorFull:
+                return busy_response()
+        return Response(frames, mimetype='application/octet-stream')
+
     # Now expose this function at the global scope so that it persists as a new flask route.
     new_service.name = service_name
     globals()[service_name] = new_service
@@ -178,16 +424,88 @@ def add_local_service(service_name, no_local_function=False):
         settings.ServiceWaypost.local_function = func
 
 
-def initialise_microservice(service_name, host=None, port=None, external_interface=False, **kwargs):
+def check_multiprocess_state(workers: int):
+    """
+    Check that the hosted service can be served by several server worker processes.
+
+    Requests that carry on from an earlier one (e.g. responses to nested calls) can arrive at any worker. Most state is
+    carried in the messages themselves, and gathered calls whose results arrive at another worker are simply sent
+    again (see `fan_out`), but values in the side store can only be fetched from the worker that stored them. Suspended
+    continuations could be replayed instead, but then every nested call repeats all the work before it.
+
+    :raises ValueError: If the service has a side store, or is a continuation microservice in ACTOR mode.
+    """
+    if settings.side_store_enabled:
+        raise ValueError("Services with a side store can only be hosted by a single server worker, not {}."
+                         .format(workers))
+    definition = getattr(settings.ServiceWaypost.local_function, 'definition', None)
+    if (definition is not None and definition.continuation and
+            settings.communication_mode == settings.CommunicationMode.ACTOR):
+        raise ValueError("Continuation microservices in ACTOR mode can only be hosted by a single server worker, not "
+                         "{}.".format(workers))
+
+
+def initialise_microservice(service_name, host=None, port=None, external_interface=False, server_backend=None,
+                            workers=None, threads=None, executor_workers=None, executor_queue_size=None,
+                            communication_mode=None, deployment_mode=None, deployment_manager_uri=None, **kwargs):
+    """
+    Start hosting `service_name`.
+
+    :param service_name: Name of the service to host.
+    :param host: Host to listen on.
+    :param port: Port to listen on.
+    :param external_interface: Whether this is an interface (i.e. it receives the responses to requests it makes)
+        rather than a microservice.
+    :param server_backend: `settings.ServerBackend` (or its value) to host the service with.
+        Defaults to `settings.server_backend`.
+    :param workers: Number of server worker processes. Defaults to `settings.server_workers`.
+    :param threads: Number of server threads per worker. Defaults to `settings.server_threads`.
+    :param executor_workers: Number of requests carried out at once in ACTOR mode.
+        Defaults to `settings.executor_workers`.
+    :param executor_queue_size: Number of requests allowed to wait for a free worker in ACTOR mode.
+        Defaults to `settings.executor_queue_size`.
+    :param communication_mode: `settings.CommunicationMode` (or its value) to host the service in.
+        Defaults to `settings.communication_mode`.
+    :param deployment_mode: `settings.DeploymentMode` (or its value) of the deployment this service is part of.
+    :param deployment_manager_uri: Uri of the deployment manager of the deployment this service is part of.
+        Unlike setting these with `/deployment_mode` and `/deployment_manager_uri` once the service has started,
+        these apply to every server worker process.
+    :raises ValueError: If the service keeps state that later requests rely on (i.e. it is a continuation microservice
+        in ACTOR mode, or has a side store) but would be hosted by several server worker processes.
+    """
     from microservice.core.service_waypost import init_service_waypost
 
     host = host if host is not None else "0.0.0.0"
     port = port if port is not None else 5000
     logger.info("Starting service on {host}:{port}", extra={'host': host, 'port': port})
 
-    configure_microservice()
+    if external_interface and server_backend is not None:
+        # Responses to requests made by an interface are received by its flask app, and must be handled in the same
+        # process that made the request.
+        logger.warning("Interfaces must be hosted in-process, ignoring server_backend: {server_backend}",
+                       extra={'server_backend': server_backend})
+        server_backend = settings.ServerBackend.WERKZEUG
+    elif external_interface:
+        server_backend = settings.ServerBackend.WERKZEUG
+
+    if communication_mode is not None:
+        settings.communication_mode = settings.CommunicationMode(communication_mode)
+    configure_microservice(executor_workers=executor_workers, executor_queue_size=executor_queue_size)
     init_service_waypost()
     add_local_service(service_name, no_local_function=external_interface)
+    if deployment_mode is not None:
+        settings.deployment_mode = settings.DeploymentMode(deployment_mode)
+    if deployment_manager_uri is not None:
+        settings.ServiceWaypost.deployment_manager_uri = deployment_manager_uri
+
+    # Other services fetch values from this service's side store using this uri.
+    advertised_host = host
+    if host == "0.0.0.0":
+        try:
+            advertised_host = socket.gethostbyname(socket.gethostname())
+        except OSError:
+            advertised_host = "127.0.0.1"
+    settings.side_store_uri = settings.local_uri or "http://{}:{}/".format(advertised_host, port)
 
     # Not sure why this doesn't work if you define it in the global scope. It's nasty, but it works for now.
     @app.route('/ping')
@@ -246,22 +564,21 @@ def initialise_microservice(service_name, host=None, port=None, external_interfa
         """
         Trigger this flask app to terminate.
         """
-        func = request.environ.get('werkzeug.server.shutdown')
-        if func is None:
-            raise RuntimeError('Not running with the Werkzeug Server')
-        func()
+        settings.flask_app_server.shutdown()
         return "Server shutting down..."
 
-    # Start up flask in a thread so that execution can continue without blocking on flask.
-    thrd = threading.Thread(
-        target=app.run,
-        kwargs={
-            'host': host,
-            'port': port,
-            'threaded': True,
-        })
-    thrd.start()
-    settings.flask_app_thread = thrd
+    server = create_server(app, host, port, backend=server_backend, workers=workers, threads=threads)
+    if server.multiprocess and server.workers > 1:
+        check_multiprocess_state(server.workers)
+    settings.flask_app_server = server
+    if server.blocking:
+        # Blocking servers take over this thread until they are shut down.
+        settings.flask_app_thread = None
+        server.start()
+    else:
+        # Start up flask in a thread so that execution can continue without blocking on flask.
+        server.start()
+        settings.flask_app_thread = server.thread
 
 
 def initialise_interface(service_name="interface", host=None, port=None):
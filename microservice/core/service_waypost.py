@@ -21,8 +21,6 @@ class _ServiceWaypost:
 
     deployment_manager_uri = None
 
-    service_uris = dict()
-
 
 def init_service_waypost():
     settings.ServiceWaypost = _ServiceWaypost()
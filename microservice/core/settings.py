@@ -4,6 +4,8 @@ import flask
 import logging
 import threading
 
+from concurrent.futures import Future
+
 
 class CommunicationMode(enum.Enum):
     ACTOR = "ACTOR"
@@ -24,16 +26,148 @@ class DeploymentMode(enum.Enum):
     ZERO = "ZERO"
 
 
+class WireCodec(enum.Enum):
+    PICKLE = "PICKLE"
+    MSGPACK = "MSGPACK"
+
+
+class ServerBackend(enum.Enum):
+    WERKZEUG = "WERKZEUG"
+    GUNICORN = "GUNICORN"
+
+
+class ExecutorType(enum.Enum):
+    THREAD = "THREAD"
+    PROCESS = "PROCESS"
+
+
+class LoadBalancingPolicy(enum.Enum):
+    ROUND_ROBIN = "ROUND_ROBIN"
+    LEAST_OUTSTANDING = "LEAST_OUTSTANDING"
+    POWER_OF_TWO_CHOICES = "POWER_OF_TWO_CHOICES"
+
+
+class KubeDiscoveryMode(enum.Enum):
+    DNS = "DNS"
+    ENDPOINTS = "ENDPOINTS"
+
+
+class DockerImageMode(enum.Enum):
+    PER_SERVICE = "PER_SERVICE"
+    SHARED = "SHARED"
+
+
 kube_namespace = "pycroservices"
+# Defaults for the kubernetes resources of each service. These can be overridden for each service with
+# `@microservice(...)`.
+kube_default_resources = {'requests': {'cpu': '100m'}}
+kube_default_min_replicas = 1
+kube_default_max_replicas = 100
+kube_default_target_cpu_utilization = 50
+# In ACTOR mode services are also autoscaled on the request gauges they expose at `prometheus_metrics_path`, which
+# must be made available to kubernetes as custom pod metrics (e.g. by the Prometheus adapter). Each pod aims for this
+# many queued requests,
+kube_target_queued_requests = 5
+# and for this fraction of its executor workers to be busy.
+kube_target_in_flight_utilisation = 0.7
+# How services find each other in kubernetes. See `microservice.core.kube_endpoints`.
+# DNS sends requests to the kubernetes Service of each service, through kube-proxy. ENDPOINTS watches the Endpoints of
+# every service and sends requests straight to their pods, which needs the service account of the pods to be allowed
+# to list and watch endpoints in `kube_namespace`.
+kube_discovery_mode = KubeDiscoveryMode.DNS
+# Number of seconds each watch of the Endpoints lasts for before it is started again.
+kube_endpoints_watch_timeout = 300
+# Number of seconds to wait before watching again after a watch fails.
+kube_endpoints_retry_interval = 1
+# Number of seconds to wait for the Endpoints to be listed for the first time, before falling back to DNS.
+kube_endpoints_sync_timeout = 5
+# Number of kubernetes resources created or patched at once. See `microservice.core.kube_reconciler`.
+kube_reconcile_workers = 8
+
+# Docker images for kubernetes deployments. See `microservice.core.dockr`.
+# Whether each service gets its own image, or every service runs from one shared image.
+docker_image_mode = DockerImageMode.PER_SERVICE
+# Tag of the image every service runs from in SHARED mode.
+docker_shared_image = "pycroservice:latest"
+# Number of images built at once.
+docker_build_workers = 4
 
 communication_mode = CommunicationMode.ACTOR
 deployment_mode = DeploymentMode.SUBPROCESS
+# Encoding used for requests and responses sent between microservices. See `microservice.core.codec`.
+wire_codec = WireCodec.PICKLE
 
 all_microservices = []
 
 ServiceWaypost = None  # type: _ServiceWaypost
 
 flask_app_thread = None
+flask_app_server = None  # type: microservice.core.server.Server
+
+# HTTP server used to host each microservice. See `microservice.core.server`.
+# These are the defaults - they can be overridden for each service when it is initialised.
+server_backend = ServerBackend.WERKZEUG
+# Number of worker processes (for backends that support multiple processes).
+server_workers = 1
+# Number of threads handling requests in each worker.
+server_threads = 8
+# Number of seconds in-flight requests are given to complete when the server is shut down.
+server_graceful_timeout = 30
+
+# Executor that carries out requests in ACTOR mode. See `microservice.core.executor`.
+# These are the defaults - they can be overridden for each service when it is initialised.
+# Number of requests each service carries out at once.
+executor_workers = 5
+# Number of requests allowed to wait for a free worker before new requests are refused. 0 means no limit.
+executor_queue_size = 100
+# Number of seconds a refused caller is told to wait before retrying (sent as the Retry-After header).
+executor_retry_after = 1
+# The latency of the requests that finished in the last this many seconds is reported in the executor metrics.
+executor_latency_window = 10
+# Maximum number of the latest requests whose latency is kept.
+executor_latency_samples = 10000
+# Path each service reports how busy its executor is at, in the Prometheus text format.
+prometheus_metrics_path = "/metrics/prometheus"
+
+# Side store for large args and results in ACTOR mode. See `microservice.core.side_store`.
+side_store_enabled = False
+# Values whose encoding is larger than this many bytes are kept in the side store rather than in messages.
+side_store_threshold = 4096
+# Number of seconds values are kept in the side store for.
+side_store_ttl = 60
+# Number of bytes of values each service keeps in its side store at most.
+side_store_max_size = 256 * 1024 * 1024
+# Uri other services fetch values from this service's side store with. Set when the service is initialised.
+side_store_uri = None  # type: str
+
+# Continuation microservices in ACTOR mode. See `microservice.core.continuation`.
+# Number of seconds a suspended microservice waits for the result of its nested call, before it is discarded (and
+# replayed from the top if the result does arrive).
+continuation_ttl = 60
+# Maximum number of suspended microservices kept by each service. The oldest are discarded first.
+continuation_max_suspended = 1000
+
+# Number of seconds the results of calls made with `gather` are kept waiting for the rest of the results to arrive.
+# See `microservice.core.fan_out`.
+gather_ttl = 60
+# Number of threads carrying out the calls made with `gather` (and the chunks sent by `map`) outside of ACTOR mode.
+gather_workers = 32
+# Number of threads carrying out the calls made with `.submit`, in modes where a call blocks until it completes.
+submit_workers = 32
+
+# Number of calls sent in each request by `map`.
+batch_chunk_size = 100
+
+# Defaults for `@microservice(cache=True)`. See `microservice.core.result_cache`.
+# Maximum number of results each service caches in memory.
+cache_max_size = 1024
+# Number of seconds results are cached for. None means results don't expire.
+cache_ttl = None
+
+# Number of times a request refused by a busy service (429 or 503) is retried before giving up.
+backpressure_retries = 5
+# Upper limit on the number of seconds to wait before each retry, whatever the service asks for.
+backpressure_max_retry_delay = 10
 
 thread_locals = threading.local()
 
@@ -41,31 +175,125 @@ event_loop = asyncio.get_event_loop()
 
 interface_results = dict()
 interface_requests = dict()
+interface_futures = dict()
+interface_lock = threading.RLock()
+# Default number of seconds an interface waits for the response to a call before giving up.
+interface_call_timeout = 60
 
 local_uri = None  # type: str
 
+# Connection pooling for inter-service requests.
+# Maximum number of keep-alive connections held open to a single service.
+connection_pool_size = 10
+# Per-service overrides of `connection_pool_size`, keyed by service name.
+connection_pool_sizes = dict()
+# Connections to a service that haven't been used for this many seconds are closed.
+connection_pool_idle_timeout = 60
+# Maximum number of simultaneous connections held by each event loop for `async_call`s. 0 means no limit.
+async_connection_limit = 1000
+
+# Client-side load balancing across the instances of each service. See `microservice.core.load_balancing`.
+load_balancing_policy = LoadBalancingPolicy.ROUND_ROBIN
+# Per-service overrides of `load_balancing_policy`, keyed by service name. Values can also be `Policy` subclasses.
+load_balancing_policies = dict()
+# Response header each service reports the number of requests it has queued or in progress in, in ACTOR mode.
+load_report_header = "X-Microservice-Load"
+# Number of seconds the load reported by an instance is used to choose instances for.
+load_report_ttl = 1
+# Number of seconds the instances of a service are used for before they are discovered again.
+endpoint_refresh_interval = 5
+# Number of requests in a row that must fail to connect to an instance before it is considered unhealthy.
+endpoint_max_failures = 3
+# Number of seconds an unhealthy instance is skipped for.
+endpoint_unhealthy_period = 10
+
+# Readiness probing of newly started subprocess services. See `subprocess_cluster.probe_until_ready`.
+# Number of seconds to wait for every service to respond to /ping before giving up.
+readiness_timeout = 30
+# Number of seconds between the first probes of a service. This doubles after each failed probe, up to the maximum.
+readiness_initial_backoff = 0.01
+readiness_max_backoff = 0.5
+# Draining of subprocess services being scaled down. See `SubprocessMicroserviceCluster.drain`.
+# Number of seconds a replica is given to finish the requests it has already accepted before it is killed.
+drain_timeout = 30
+# Number of seconds between checking whether a replica has finished its requests.
+drain_interval = 0.1
+
+# Autoscaling of the replicas of each service in ACTOR mode. See `microservice.core.autoscaler`.
+# Number of seconds between polling the metrics of every replica.
+autoscale_interval = 5
+autoscale_min_replicas = 1
+autoscale_max_replicas = 8
+# A service is scaled up when the mean queue depth of its replicas, or their p95 latency (in seconds), is above the
+# high watermark. It is scaled down when both are below the low watermarks.
+autoscale_queue_high_watermark = 5
+autoscale_queue_low_watermark = 0.5
+autoscale_latency_high_watermark = 5
+autoscale_latency_low_watermark = 1
+# A service is never scaled down to fewer replicas than would keep the fraction of their workers that are busy below
+# this.
+autoscale_utilisation_target = 0.7
+# Percentage of the current replicas added or removed each time a service is scaled (at least one replica).
+autoscale_step_percent = 50
+# Number of seconds after scaling a service before it can be scaled up, or down, again. The up cooldown should be at
+# least `executor_latency_window`, so that the latency since scaling is measured before scaling up again.
+autoscale_up_cooldown = 15
+autoscale_down_cooldown = 60
+# Number of services that can be scaled at once.
+autoscale_scale_workers = 4
+
 
 def set_interface_result(key, value):
-    interface_results[key] = value
+    """
+    Store the result of the interface request with request_id `key`, and wake up anything waiting for it.
+    :param key:
+    :param value:
+    """
+    with interface_lock:
+        interface_results[key] = value
+        future = interface_futures.get(key)
+        if future is not None and not future.done():
+            if isinstance(value, Exception):
+                future.set_exception(value)
+            else:
+                future.set_result(value)
 
 
-def set_interface_request(request_id, result_key: str):
+def set_interface_request(request_id, result_key: str) -> Future:
     """
     Set a flag to say that we're expecting a response to the request with the given request_id.
     :param request_id:
     :param result_key
+    :return: Future that is completed when the response is received.
+    """
+    future = Future()
+    with interface_lock:
+        interface_requests[request_id] = result_key
+        interface_futures[request_id] = future
+        if request_id in interface_results.keys():
+            # The response has already been received.
+            set_interface_result(request_id, interface_results[request_id])
+    return future
+
+
+def clear_interface_request(request_id, completed: bool=True):
+    """
+    Remove the state held for the request with the given request_id.
+    :param request_id:
+    :param completed: If False, the request is being abandoned, so stop expecting a response to it too.
     """
-    interface_requests[request_id] = result_key
+    with interface_lock:
+        interface_results.pop(request_id, None)
+        interface_futures.pop(request_id, None)
+        if not completed:
+            interface_requests.pop(request_id, None)
 
 
 def current_message():
-    if communication_mode == CommunicationMode.SYN:
-        if flask.has_app_context() and 'current_message' in flask.g:
-            return flask.g.current_message
-    elif communication_mode == CommunicationMode.ACTOR:
-        if hasattr(thread_locals, "current_message") and thread_locals.current_message is not None:
-            return thread_locals.current_message
-    return None
+    if communication_mode == CommunicationMode.SYN and flask.has_app_context():
+        return flask.g.get('current_message')
+    # Outside of a flask request in SYN mode, e.g. in threads carrying out gathered calls.
+    return getattr(thread_locals, "current_message", None)
 
 
 def current_request_id():
@@ -76,9 +304,9 @@ def current_request_id():
 
 
 def set_current_message(message):
-    if communication_mode == CommunicationMode.SYN:
+    if communication_mode == CommunicationMode.SYN and flask.has_app_context():
         flask.g.current_message = message
-    elif communication_mode == CommunicationMode.ACTOR:
+    else:
         thread_locals.current_message = message
 
 
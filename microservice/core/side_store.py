@@ -0,0 +1,139 @@
+"""
+Side store that keeps large args and results out of messages, enabled by `settings.side_store_enabled`.
+
+In ACTOR mode, every hop adds the args of the calling service to the via headers of the message, and every result is
+carried forward to each later hop. So without this, message size grows with both the depth and fan out of a call tree.
+
+When enabled, any via header args/kwargs or result whose encoding is larger than `settings.side_store_threshold` bytes
+is kept in the side store of the service that produced it, and only a `StoredRef` to it travels in the message. The
+value is only fetched (from that service's `/side_store/<key>` endpoint) by the service that actually uses it - which
+for via headers is usually the service that stored it, so no request is needed at all.
+
+Stored values expire after `settings.side_store_ttl` seconds, so references are only valid for the lifetime of a
+request. Values are keyed by their content, so a value stored again (e.g. the args of a message each time it is
+replayed) refers to the same entry. Once the store holds more than `settings.side_store_max_size` bytes, the values
+closest to expiring are removed early.
+"""
+import hashlib
+import logging
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+from typing import Dict, Tuple
+
+from microservice.core import codec, connection_pool, settings
+
+logger = logging.getLogger(__name__)
+
+# Reference to a value held in the side store of the service found at `uri`.
+StoredRef = namedtuple("StoredRef", ["uri", "key"])
+
+
+class SideStoreExpired(LookupError):
+    pass
+
+
+class LocalSideStore:
+    """
+    Encoded values stored by this service, each of which expires after a fixed time.
+    """
+
+    def __init__(self):
+        # Ordered by when each value expires.
+        self._values = OrderedDict()  # type: Dict[str, Tuple[float, bytes]]
+        self._size = 0
+        self._lock = threading.Lock()
+        self._last_cleanup = time.monotonic()
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def size(self) -> int:
+        """
+        :return int: Number of bytes of values stored.
+        """
+        return self._size
+
+    def put(self, encoded: bytes) -> str:
+        """
+        :param bytes encoded: Value encoded with `codec.dumps`.
+        :return str: Key to get the value with. Identical values are given the same key.
+        """
+        key = hashlib.sha1(encoded).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            self._remove(key)
+            self._values[key] = (now + settings.side_store_ttl, encoded)
+            self._size += len(encoded)
+            evicted = 0
+            # The latest value is always kept, so that its key can be used.
+            while self._size > settings.side_store_max_size and len(self._values) > 1:
+                self._remove(next(iter(self._values)))
+                evicted += 1
+        if evicted:
+            logger.warning("Side store is full, removed {count} values before they expired", extra={'count': evicted})
+        if now - self._last_cleanup > settings.side_store_ttl:
+            self.remove_expired()
+        return key
+
+    def get(self, key: str) -> bytes:
+        """
+        :return bytes: The encoded value.
+        :raises SideStoreExpired: If there is no such value, or it has expired.
+        """
+        entry = self._values.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            raise SideStoreExpired(key)
+        return entry[1]
+
+    def _remove(self, key: str):
+        entry = self._values.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def remove_expired(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            self._last_cleanup = now
+            expired = [key for key, (expires_at, _) in self._values.items() if expires_at < now]
+            for key in expired:
+                self._remove(key)
+        return len(expired)
+
+
+local_store = LocalSideStore()
+
+
+def store_if_large(value):
+    """
+    :return: A `StoredRef` to `value` if the side store is enabled and `value` is large, otherwise `value` itself.
+    """
+    if not settings.side_store_enabled or settings.side_store_uri is None or type(value) is StoredRef:
+        return value
+    encoded = codec.dumps(value)
+    if len(encoded) <= settings.side_store_threshold:
+        return value
+    ref = StoredRef(settings.side_store_uri, local_store.put(encoded))
+    logger.debug("Stored value of {size} bytes as {ref}", extra={'size': len(encoded), 'ref': ref})
+    return ref
+
+
+def resolve(value):
+    """
+    :return: The value referred to if `value` is a `StoredRef`, otherwise `value` itself.
+    :raises SideStoreExpired: If the referred to value has expired.
+    """
+    if type(value) is not StoredRef:
+        return value
+    if value.uri == settings.side_store_uri:
+        return codec.loads(local_store.get(value.key))
+
+    logger.debug("Fetching {ref} from side store", extra={'ref': value})
+    uri = value.uri + 'side_store/' + value.key
+    response = connection_pool.get_session(uri).get(uri)
+    if response.status_code == 404:
+        raise SideStoreExpired(value.key)
+    response.raise_for_status()
+    return codec.loads(response.content)
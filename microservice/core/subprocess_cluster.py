@@ -1,19 +1,28 @@
+import json
+import logging
 import os
 import platform
 import psutil
 import requests
 import subprocess
+import sys
 import threading
 import time
 
 from collections import namedtuple
-from flask import Flask, request
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, jsonify, request
+from requests.adapters import HTTPAdapter
 from setuptools import Distribution
 from setuptools.command.install import install
 from typing import List, Dict
 
-from microservice.core import settings
+from microservice.core import load_balancing, settings, utils
+from microservice.core.autoscaler import Autoscaler, fetch_executor_metrics
 from microservice.core.microservice_cluster import MicroserviceCluster
+from microservice.core.server import WerkzeugServer
+
+logger = logging.getLogger(__name__)
 
 DETACHED_PROCESS = 8
 
@@ -58,12 +67,29 @@ def get_microservice_main_entrypoint_path():
 
 SubprocessService = namedtuple("SubprocessService", ['process', 'host', 'port'])
 
+# Maximum number of services probed for readiness at once.
+MAX_CONCURRENT_PROBES = 32
+
+
+class ServiceNotReady(Exception):
+    pass
+
+
+def spawn_microservice(service_name, host, port, **other_kwargs):
+    """
+    Start a new process hosting `service_name`.
 
-def spawn_microservice(service_name, host, port):
-    cmd = [get_microservice_main_entrypoint_path(),
-           "--host", str(host),
+    :param other_kwargs: Additional keyword arguments for `service_host.initialise_microservice`, e.g. to set the
+        server backend. These must be JSON serializable.
+    """
+    entrypoint = get_microservice_main_entrypoint_path()
+    # Run the package directly if the entrypoint isn't installed, e.g. in a virtualenv or a source checkout.
+    cmd = [entrypoint] if os.path.exists(entrypoint) else [sys.executable, "-m", "microservice"]
+    cmd += ["--host", str(host),
            "--port", str(port),
            "--service", service_name]
+    if other_kwargs:
+        cmd.extend(["--other_kwargs", json.dumps(other_kwargs)])
     if is_windows():
         return subprocess.Popen(cmd, creationflags=DETACHED_PROCESS, close_fds=True)
     else:
@@ -75,6 +101,50 @@ def uri_from_subprocess_service(subprocess_service):
     return "http://{}:{}/".format(subprocess_service.host, subprocess_service.port)
 
 
+def create_readiness_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=MAX_CONCURRENT_PROBES, pool_maxsize=1)
+    session.mount('http://', adapter)
+    return session
+
+
+def probe_until_ready(subprocess_service, session: requests.Session, deadline: float, cancelled: threading.Event):
+    """
+    Poll `/ping` of `subprocess_service` until it responds, backing off exponentially between attempts (from
+    `settings.readiness_initial_backoff` up to `settings.readiness_max_backoff`).
+
+    :param deadline: Time (from `time.monotonic`) to give up at.
+    :param cancelled: Set to stop probing, e.g. because another service failed to start.
+    :raises ServiceNotReady: If the service exits, or doesn't respond by the deadline.
+    """
+    uri = uri_from_subprocess_service(subprocess_service) + 'ping'
+    backoff = settings.readiness_initial_backoff
+    while not cancelled.is_set():
+        exit_code = subprocess_service.process.poll()
+        if exit_code is not None:
+            raise ServiceNotReady("Service at {} exited with code {} before it was ready.".format(uri, exit_code))
+        try:
+            if session.get(uri, timeout=max(deadline - time.monotonic(), 0.01)).text == "pong":
+                return
+        except requests.RequestException:
+            pass
+        if time.monotonic() + backoff > deadline:
+            raise ServiceNotReady("Service at {} was not ready within {} seconds.".format(
+                uri, settings.readiness_timeout))
+        cancelled.wait(backoff)
+        backoff = min(backoff * 2, settings.readiness_max_backoff)
+
+
+def kill_subprocess_service(subprocess_service):
+    try:
+        process = psutil.Process(subprocess_service.process.pid)
+        for proc in process.children(recursive=True):
+            proc.kill()
+        process.kill()
+    except psutil.NoSuchProcess:
+        pass
+
+
 class SubprocessMicroserviceCluster(MicroserviceCluster):
     deployment_mode = settings.DeploymentMode.SUBPROCESS
     next_port = 10000
@@ -82,72 +152,241 @@ class SubprocessMicroserviceCluster(MicroserviceCluster):
     deployment_manager_host = '127.0.0.1'
     deployment_manager_port = 9999
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, service_kwargs: Dict[str, dict]=None, replicas: Dict[str, int]=None,
+                 autoscale: bool=False, **kwargs):
+        """
+        :param service_kwargs: Additional keyword arguments for `service_host.initialise_microservice` for each
+            service, keyed by service name. For example, to host a service using gunicorn:
+                {'my.service': {'server_backend': 'GUNICORN', 'workers': 4}}
+            These take precedence over the tuning of the service from its `MicroserviceDefinition`.
+        :param replicas: Number of processes to start for each service, keyed by service name. Services not included
+            start with the `min_replicas` of their definition, or a single process. This can be changed later with
+            `scale`.
+        :param autoscale: Whether to scale the replicas of each service with how congested they are. See
+            `microservice.core.autoscaler`.
+        """
         super(SubprocessMicroserviceCluster, self).__init__(*args, **kwargs)
         self.host = "127.0.0.1"
-        self.services = {}  # type: Dict[str, SubprocessService]
+        self.services = {}  # type: Dict[str, List[SubprocessService]]
+        self.service_kwargs = service_kwargs if service_kwargs is not None else {}
+        self.replicas = replicas if replicas is not None else {}
         self.deployment_manager_thread = None
+        self.deployment_manager_server = None  # type: WerkzeugServer
+        # Held while changing the replicas of any service.
+        self.scaling_lock = threading.Lock()
+        # Held for the whole of scaling a service (except draining), keyed by service name.
+        self.service_scaling_locks = {}  # type: Dict[str, threading.Lock]
+        # Replicas no longer given out, that are finishing their requests before being killed.
+        self.draining = []  # type: List[SubprocessService]
+        # Chooses which replica `uri_for_service` gives out.
+        self._round_robin = load_balancing.RoundRobin()
+        self.definitions = {definition.name: definition for definition in self.service_definitions}
+        self.autoscaler = None
+        if autoscale:
+            self.autoscaler = Autoscaler(self, replica_bounds={
+                definition.name: (definition.min_replicas, definition.max_replicas)
+                for definition in self.service_definitions
+            })
+        # Shared by every readiness probe, so that probing many services doesn't open a connection per probe.
+        self.readiness_session = create_readiness_session()
 
         self.deployment_manager_uri = 'http://{}:{}/'.format(self.deployment_manager_host, self.deployment_manager_port)
 
     def setup(self):
         super(SubprocessMicroserviceCluster, self).setup()
         self.create_deployment_manager()
-        self.set_deployment_manager_uri()
+        if self.autoscaler is not None:
+            self.autoscaler.start()
 
     def teardown(self):
+        if self.autoscaler is not None:
+            self.autoscaler.stop()
         super(SubprocessMicroserviceCluster, self).teardown()
+        self.readiness_session.close()
         requests.get(self.deployment_manager_uri + 'terminate')
         self.deployment_manager_thread.join()
 
-    def create_deployment_manager(self):
+    def create_deployment_manager_app(self) -> Flask:
         app = Flask(__name__)
 
         @app.route('/uri/<service_name>')
-        def uri_for_service(service_name):
-            return self.uri_for_service(service_name)
+        def uris_for_service(service_name):
+            """
+            The uri of every live replica of `service_name`.
+            """
+            return jsonify(self.uris_for_service(service_name))
+
+        @app.route('/scale/<service_name>', methods=['POST'])
+        def scale(service_name):
+            """
+            Change the number of replicas of `service_name` to the `replicas` form value.
+            """
+            return jsonify(self.scale(service_name, int(request.form['replicas'])))
 
         @app.route('/terminate')
         def terminate():
             """
             Trigger this flask app to terminate.
             """
-            func = request.environ.get('werkzeug.server.shutdown')
-            if func is None:
-                raise RuntimeError('Not running with the Werkzeug Server')
-            func()
+            self.deployment_manager_server.shutdown()
             return "Server shutting down..."
 
-        self.deployment_manager_thread = threading.Thread(
-            target=app.run,
-            kwargs={'host': self.deployment_manager_host, 'port': self.deployment_manager_port})
-        self.deployment_manager_thread.start()
+        return app
 
-    def set_deployment_manager_uri(self):
-        self.send_request_to_all_services('deployment_manager_uri',
-                                          data={'deployment_manager_uri': self.deployment_manager_uri},
-                                          method=requests.post)
+    def create_deployment_manager(self):
+        app = self.create_deployment_manager_app()
+        self.deployment_manager_server = WerkzeugServer(app, self.deployment_manager_host, self.deployment_manager_port)
+        self.deployment_manager_server.start()
+        self.deployment_manager_thread = self.deployment_manager_server.thread
+
+    def live_replicas(self, service_name) -> List[SubprocessService]:
+        return [service for service in self.services[service_name] if service.process.poll() is None]
 
     def uri_for_service(self, service_name):
-        return uri_from_subprocess_service(self.services[service_name])
+        """
+        :return: The uri of one of the live replicas of `service_name`, taking each in turn.
+        """
+        replicas = self.live_replicas(service_name)
+        return uri_from_subprocess_service(self._round_robin.choose(replicas))
+
+    def uris_for_service(self, service_name) -> List[str]:
+        return [uri_from_subprocess_service(service) for service in self.live_replicas(service_name)]
+
+    def spawn_replica(self, service_name) -> SubprocessService:
+        port = self.next_port
+        self.next_port += 1
+        # Set at startup rather than through `/deployment_mode`, so that every server worker process is configured.
+        kwargs = {
+            'deployment_mode': self.deployment_mode.value,
+            'deployment_manager_uri': self.deployment_manager_uri,
+        }
+        if service_name in self.definitions:
+            kwargs.update(utils.service_host_kwargs(self.definitions[service_name]))
+        kwargs.update(self.service_kwargs.get(service_name, {}))
+        process = spawn_microservice(service_name, self.host, port, **kwargs)
+        return SubprocessService(process, self.host, port)
+
+    def wait_until_ready(self, services: List[SubprocessService]):
+        """
+        Wait for every one of `services` to respond to `/ping`, probing them all at once - so this takes as long as
+        the slowest of them to start.
+
+        :raises ServiceNotReady: If any of them exits, or doesn't respond within `settings.readiness_timeout` seconds.
+        """
+        deadline = time.monotonic() + settings.readiness_timeout
+        cancelled = threading.Event()
+        with ThreadPoolExecutor(max_workers=max(min(len(services), MAX_CONCURRENT_PROBES), 1)) as executor:
+            futures = [executor.submit(probe_until_ready, service, self.readiness_session, deadline, cancelled)
+                       for service in services]
+            try:
+                for future in futures:
+                    future.result()
+            except ServiceNotReady:
+                cancelled.set()
+                raise
+        logger.info("{count} services ready", extra={'count': len(services)})
 
     def spawn_all_microservices(self):
         for service_definition in self.service_definitions:
-            port = self.next_port
-            self.next_port += 1
-            process = spawn_microservice(service_definition.name, self.host, port)
-            self.services[service_definition.name] = SubprocessService(process, self.host, port)
-
-        # Sleep to allow the microservices to initialise. Could be replaced with an active poller, but not worth the
-        # effort for the test-only subprocess deployment.
-        time.sleep(1)
+            self.services[service_definition.name] = [
+                self.spawn_replica(service_definition.name)
+                for _ in range(self.replicas.get(service_definition.name, service_definition.min_replicas or 1))
+            ]
+
+        try:
+            self.wait_until_ready([service for replicas in self.services.values() for service in replicas])
+        except ServiceNotReady:
+            # No deployment is returned to tear these down with.
+            self.close_all_microservices()
+            self.services = {}
+            raise
+
+    def scale(self, service_name, replicas: int) -> List[str]:
+        """
+        Start or stop replicas of `service_name` so that it has `replicas` processes.
+
+        New replicas are only given out by the deployment manager once they have started. Replicas are stopped newest
+        first: they stop being given out straight away, and are killed once they have finished the requests they have
+        already accepted (see `drain`), which this waits for.
+
+        :return: The uri of every replica of `service_name` once scaled.
+        """
+        if replicas < 1:
+            raise ValueError("A service needs at least one replica, not {}.".format(replicas))
+        with self.scaling_lock:
+            service_lock = self.service_scaling_locks.setdefault(service_name, threading.Lock())
+        added = []
+        removed = []
+        with service_lock:
+            with self.scaling_lock:
+                current = self.services[service_name]
+                if replicas > len(current):
+                    added = [self.spawn_replica(service_name) for _ in range(replicas - len(current))]
+                elif replicas < len(current):
+                    self.services[service_name] = current[:replicas]
+                    removed = current[replicas:]
+                    self.draining.extend(removed)
+            # Waiting for new replicas doesn't hold up changes to the replicas of other services.
+            if added:
+                try:
+                    self.wait_until_ready(added)
+                except ServiceNotReady:
+                    for service in added:
+                        kill_subprocess_service(service)
+                    raise
+            with self.scaling_lock:
+                self.services[service_name] = self.services[service_name] + added
+                self.replicas[service_name] = replicas
+        # Draining doesn't hold up other changes to the replicas.
+        if removed:
+            self.drain(removed)
+            for service in removed:
+                kill_subprocess_service(service)
+            with self.scaling_lock:
+                self.draining = [service for service in self.draining if service not in removed]
+        logger.info("Scaled {service_name} to {replicas} replicas",
+                    extra={'service_name': service_name, 'replicas': replicas})
+        return self.uris_for_service(service_name)
+
+    def is_drained(self, service: SubprocessService) -> bool:
+        """
+        :return: Whether `service` has no requests queued or being carried out (or has exited).
+        """
+        if service.process.poll() is not None:
+            return True
+        try:
+            metrics = fetch_executor_metrics(uri_from_subprocess_service(service))
+        except requests.RequestException:
+            return False
+        # Outside of ACTOR mode there's no executor, and requests are finished by the time they are responded to.
+        return metrics is None or (metrics['queue_depth'] == 0 and metrics['active_workers'] == 0)
+
+    def drain(self, services: List[SubprocessService]):
+        """
+        Wait for `services`, which are no longer given out, to finish the requests they have already accepted - for up
+        to `settings.drain_timeout` seconds.
+
+        Clients keep sending requests to the instances they discovered for up to `settings.endpoint_refresh_interval`
+        seconds, so services aren't considered drained before then.
+        """
+        start = time.monotonic()
+        deadline = start + settings.drain_timeout
+        remaining = list(services)
+        while time.monotonic() < deadline:
+            if time.monotonic() - start >= settings.endpoint_refresh_interval:
+                remaining = [service for service in remaining if not self.is_drained(service)]
+                if not remaining:
+                    return
+            time.sleep(settings.drain_interval)
+        logger.warning("{count} replicas didn't finish their requests within {timeout} seconds",
+                       extra={'count': len(remaining), 'timeout': settings.drain_timeout})
 
     def close_all_microservices(self):
-        for service in self.services.values():
-            process = psutil.Process(service.process.pid)
-            for proc in process.children(recursive=True):
-                proc.kill()
-            process.kill()
+        for replicas in self.services.values():
+            for service in replicas:
+                kill_subprocess_service(service)
+        for service in list(self.draining):
+            kill_subprocess_service(service)
 
     def all_microservices_are_alive(self):
         results = self.send_request_to_all_services('ping')
@@ -3,6 +3,8 @@ import sys
 import time
 from collections import namedtuple
 
+from microservice.core import settings
+
 logger = logging.getLogger(__name__)
 
 
@@ -43,4 +45,30 @@ def wait_for(condition: callable, interval: float=0.01, timeout: int=60):
             raise TimeoutError("Timeout waiting for condition %s" % condition)
 
 
-MicroserviceDefinition = namedtuple("MicroserviceDefinition", ["name", "exposed"])
+MicroserviceDefinition = namedtuple("MicroserviceDefinition", [
+    "name", "exposed", "executor", "workers",
+    # Tuning of how the service is deployed. None means the deployment's default.
+    # Kubernetes resource requirements of each instance, e.g. {'requests': {'cpu': '1'}, 'limits': {'memory': '1Gi'}}
+    "resources",
+    # Bounds on the number of instances when autoscaling.
+    "min_replicas", "max_replicas",
+    # Mean CPU utilisation (percent) the kubernetes autoscaler aims for.
+    "target_cpu_utilization",
+    # Number of requests each instance carries out at once in ACTOR mode.
+    "executor_workers",
+    # Whether the service is a continuation microservice. See `microservice.core.continuation`.
+    "continuation",
+])
+# Only `name` is required - by default services run in a thread of the host process.
+MicroserviceDefinition.__new__.__defaults__ = (False, settings.ExecutorType.THREAD, None, None, None, None, None, None,
+                                               False)
+
+
+def service_host_kwargs(definition: MicroserviceDefinition) -> dict:
+    """
+    :return: Keyword arguments for `service_host.initialise_microservice` to host the service of `definition` with.
+    """
+    kwargs = {}
+    if definition.executor_workers is not None:
+        kwargs['executor_workers'] = definition.executor_workers
+    return kwargs
@@ -16,12 +16,12 @@ def sum_random_list(size):
     return sum(li)
 
 
-@microservice
+@microservice(executor="process")
 def intensive_calculation_1():
     return sum_random_list(10000)
 
 
-@microservice
+@microservice(executor="process")
 def intensive_calculation_2(size):
     return sum_random_list(size)
 
@@ -0,0 +1,34 @@
+"""
+Asyncio equivalent of the fan out done by `intensive_calculators.intensive_calculator_fanout`.
+
+Rather than starting a thread per call, all 300 calls are in flight at once on a single event loop.
+"""
+import asyncio
+
+from microservice import initialise_interface, terminate_interface
+from microservice.core import connection_pool, deploy
+
+from microservice.examples.intensive_calculators import (intensive_calculation_1, intensive_calculation_2,
+                                                         intensive_calculation_3)
+
+
+async def fanout():
+    calls = []
+    for i in range(100):
+        calls.append(intensive_calculation_1.async_call())
+        calls.append(intensive_calculation_2.async_call(10000))
+        calls.append(intensive_calculation_3.async_call(10000))
+    results = await asyncio.gather(*calls)
+    await connection_pool.close_async_session()
+    return results
+
+
+if __name__ == "__main__":
+    initialise_interface()
+    deploy.create_deployment()
+
+    try:
+        print("Intensive calculations say:", asyncio.get_event_loop().run_until_complete(fanout()))
+    finally:
+        deploy.destroy_deployment()
+        terminate_interface()
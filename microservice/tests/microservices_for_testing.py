@@ -1,6 +1,9 @@
+import os
 import sys
+import threading
 
 from microservice.core.decorator import microservice
+from microservice.core.fan_out import gather
 
 
 echo_as_dict2_args = (5, 2, 5)
@@ -53,6 +56,92 @@ def exception_raiser(*args, **kwargs):
     raise RuntimeError("Called with: {}; {}".format(args, kwargs))
 
 
+@microservice(executor="process", workers=1)
+def process_id(*args, **kwargs):
+    return os.getpid()
+
+
+# Calls actually carried out by `coalesced_echo`, which waits for `coalesced_echo_release` before returning.
+coalesced_echo_calls = []
+coalesced_echo_release = threading.Event()
+
+
+@microservice(coalesce=True)
+def coalesced_echo(*args, **kwargs):
+    coalesced_echo_calls.append((args, kwargs))
+    coalesced_echo_release.wait(5)
+    return args
+
+
+# Calls actually carried out by `cached_echo`.
+cached_echo_calls = []
+
+
+@microservice(cache={'max_size': 2})
+def cached_echo(*args, **kwargs):
+    cached_echo_calls.append((args, kwargs))
+    return args
+
+
+@microservice
+def count_up_to(n, fail=False):
+    for i in range(n):
+        yield i
+    if fail:
+        raise RuntimeError("Failed after {}".format(n))
+
+
+@microservice(coalesce=True)
+def coalesced_count_up_to(n):
+    for i in range(n):
+        yield i
+
+
+# Args that `echo_in_turn` has been started (rather than resumed) with.
+echo_in_turn_starts = []
+
+
+@microservice(continuation=True)
+def echo_in_turn(*args):
+    echo_in_turn_starts.append(args)
+    results = []
+    for arg in args:
+        result = yield echo_as_dict.defer(arg)
+        results.append(result)
+    return results
+
+
+@microservice
+def echo_gathered(*args):
+    return gather(*[echo_as_dict.defer(arg) for arg in args])
+
+
+@microservice
+def echo_mapped(*args):
+    return echo_as_dict.map(args)
+
+
+# Waited at by each call to `wait_for_others`, so that they only return once they are all being carried out at once.
+wait_for_others_barrier = threading.Barrier(3)
+
+
+@microservice
+def wait_for_others():
+    wait_for_others_barrier.wait(5)
+    return True
+
+
+@microservice
+def echo_gathered_nested(count):
+    return gather(*[echo_gathered.defer(i, i, i) for i in range(count)])
+
+
+@microservice(continuation=True)
+def echo_gathered_in_turn(*args):
+    results = yield gather.defer(*[echo_as_dict.defer(arg) for arg in args])
+    return results
+
+
 all_test_microservices = [
     'microservice.tests.microservices_for_testing.echo_as_dict',
     'microservice.tests.microservices_for_testing.echo_as_dict2',
@@ -60,4 +149,15 @@ all_test_microservices = [
     'microservice.tests.microservices_for_testing.echo_as_dict4',
     'microservice.tests.microservices_for_testing.echo_as_dict5',
     'microservice.tests.microservices_for_testing.exception_raiser',
+    'microservice.tests.microservices_for_testing.process_id',
+    'microservice.tests.microservices_for_testing.coalesced_echo',
+    'microservice.tests.microservices_for_testing.cached_echo',
+    'microservice.tests.microservices_for_testing.count_up_to',
+    'microservice.tests.microservices_for_testing.coalesced_count_up_to',
+    'microservice.tests.microservices_for_testing.echo_in_turn',
+    'microservice.tests.microservices_for_testing.echo_gathered',
+    'microservice.tests.microservices_for_testing.echo_gathered_nested',
+    'microservice.tests.microservices_for_testing.echo_mapped',
+    'microservice.tests.microservices_for_testing.wait_for_others',
+    'microservice.tests.microservices_for_testing.echo_gathered_in_turn',
 ]
@@ -1,10 +1,13 @@
+import asyncio
+import os
 import pickle
 import time
 
 from microservice.tests.microservice_test_case import MicroserviceTestCase
-from unittest.mock import call
+from unittest.mock import call, patch
 
-from microservice.core import settings, communication
+from microservice.core import codec, settings, communication, service_host
+from microservice.core.executor import ExecutorFull
 
 from microservice.tests import microservices_for_testing
 
@@ -153,6 +156,261 @@ class TestAsynchronousLocalService(MicroserviceTestCase):
                  expected_message),
         ])
 
+    def test_request_to_process_executor(self):
+        """
+        Test that the function is carried out in a worker process, but the result is sent back from this process.
+        """
+        local_service_name = 'microservice.tests.microservices_for_testing.process_id'
+        self.mock_setup(local_service_name)
+
+        test_msg = communication.construct_message_add_via(communication.Message(), *self.args, **self.kwargs)
+        response = self.app.get('/', data=test_msg.pickle)
+        self.assertEqual(response.status_code, 200)
+        service_host.executor.shutdown(wait=True)
+
+        self.mocked_send_object_to_service.assert_called_once()
+        result = self.mocked_send_object_to_service.call_args[0][1].results[
+            communication.create_result_key(local_service_name, self.args, self.kwargs)]
+        self.assertIsInstance(result, int)
+        self.assertNotEqual(os.getpid(), result)
+
+    def test_identical_requests_are_coalesced(self):
+        """
+        Test that identical requests in flight at the same time share one execution, but each gets its own response.
+        """
+        local_service_name = 'microservice.tests.microservices_for_testing.coalesced_echo'
+        self.mock_setup(local_service_name)
+        microservices_for_testing.coalesced_echo_calls.clear()
+        microservices_for_testing.coalesced_echo_release.clear()
+
+        for return_service in ['service_1', 'service_2', 'service_3']:
+            msg = communication.Message(args=self.args, kwargs=self.kwargs,
+                                        via=[communication.ViaHeader(return_service, (), {})])
+            self.assertEqual(200, self.app.get('/', data=msg.pickle).status_code)
+        time.sleep(self.THREAD_TIMER)
+        microservices_for_testing.coalesced_echo_release.set()
+        service_host.executor.shutdown(wait=True)
+
+        self.assertEqual(1, len(microservices_for_testing.coalesced_echo_calls))
+        self.assertEqual(['service_1', 'service_2', 'service_3'],
+                         sorted(args[0] for args, _ in self.mocked_send_object_to_service.call_args_list))
+        for args, _ in self.mocked_send_object_to_service.call_args_list:
+            self.assertEqual(self.args, args[1].results[
+                communication.create_result_key(local_service_name, self.args, self.kwargs)])
+
+    def test_cached_request(self):
+        """
+        Test that a hosted service returns a cached result without carrying out the function again, and that
+        the cache is reported in the metrics.
+        """
+        local_service_name = 'microservice.tests.microservices_for_testing.cached_echo'
+        self.mock_setup(local_service_name)
+        microservices_for_testing.cached_echo.cache.clear()
+        microservices_for_testing.cached_echo_calls.clear()
+
+        test_msg = communication.construct_message_add_via(communication.Message(), *self.args, **self.kwargs)
+        for _ in range(2):
+            self.app.get('/', data=test_msg.pickle)
+            time.sleep(self.THREAD_TIMER)
+
+        self.assertEqual(1, len(microservices_for_testing.cached_echo_calls))
+        self.assertEqual(2, self.mocked_send_object_to_service.call_count)
+        cache_metrics = self.app.get('/metrics').json['caches'][local_service_name]
+        self.assertEqual(1, cache_metrics['hits'])
+
+    def test_batch_request(self):
+        """
+        Test that a batch responds with the results directly, rather than sending them back separately.
+        """
+        local_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+        self.mock_setup(local_service_name)
+
+        messages = [communication.Message(args=(i,)) for i in range(3)]
+        response = self.app.post('/batch', data=pickle.dumps(messages))
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'_args': (i,)} for i in range(3)], pickle.loads(response.data))
+        self.mocked_send_object_to_service.assert_not_called()
+
+    def test_batch_request_with_nested_call(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.echo_as_dict2')
+
+        response = self.app.post('/batch', data=pickle.dumps([communication.Message(args=(1,))]))
+
+        self.assertIsInstance(pickle.loads(response.data)[0], communication.NestedCallNotSupported)
+        self.mocked_send_object_to_service.assert_not_called()
+
+    def test_batch_request_is_carried_out_in_parallel(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.wait_for_others')
+        microservices_for_testing.wait_for_others_barrier.reset()
+
+        messages = [communication.Message() for _ in range(3)]
+        response = self.app.post('/batch', data=pickle.dumps(messages))
+
+        self.assertEqual([True] * 3, pickle.loads(response.data))
+
+    def test_map(self):
+        """
+        Test that `map` sends the calls in chunks, and returns the results in order.
+        """
+        self.mock_setup('microservice.tests.microservices_for_testing.echo_as_dict2')
+
+        def carry_out_batch(service_name, messages, path):
+            return [message.args[0] * 2 for message in messages]
+        self.mocked_send_object_to_service.side_effect = carry_out_batch
+
+        results = microservices_for_testing.echo_as_dict.map(range(250), chunk_size=100)
+
+        self.assertEqual([i * 2 for i in range(250)], results)
+        self.assertEqual(3, self.mocked_send_object_to_service.call_count)
+        for chunk_call in self.mocked_send_object_to_service.call_args_list:
+            self.assertEqual('microservice.tests.microservices_for_testing.echo_as_dict', chunk_call[0][0])
+            self.assertEqual('batch', chunk_call[1]['path'])
+
+    def test_map_with_kwargs(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.echo_as_dict2')
+        self.mocked_send_object_to_service.side_effect = lambda service_name, messages, path: [
+            (message.args, message.kwargs) for message in messages]
+
+        self.assertEqual([((1,), {'a': 2}), ((3,), {'a': 4})],
+                         microservices_for_testing.echo_as_dict.map([1, 3], kwargs_iterable=[{'a': 2}, {'a': 4}]))
+        self.assertEqual([((), {'a': 2})], microservices_for_testing.echo_as_dict.map(kwargs_iterable=[{'a': 2}]))
+
+    def test_map_with_nested_calls(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.echo_as_dict2')
+        self.mocked_send_object_to_service.side_effect = lambda service_name, messages, path: [
+            communication.NestedCallNotSupported() for _ in messages]
+
+        with self.assertRaises(communication.NestedCallNotSupported):
+            microservices_for_testing.echo_as_dict.map(range(3))
+
+    def test_request_when_busy(self):
+        """
+        Test that a request is refused with a 503 and a retry hint when the executor queue is full.
+        """
+        local_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+        self.mock_setup(local_service_name)
+
+        with patch.object(service_host.executor, 'submit', side_effect=ExecutorFull):
+            response = self.app.get('/', data=communication.Message().pickle)
+
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(str(settings.executor_retry_after), response.headers['Retry-After'])
+        self.mocked_send_object_to_service.assert_not_called()
+
+    def test_stream_request(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.count_up_to')
+
+        response = self.app.get('/stream', data=communication.Message(args=(3,)).pickle)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([(codec.FRAME_ITEM, i) for i in range(3)], list(codec.iter_frames([response.data])))
+
+    def test_stream_request_when_busy(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.count_up_to')
+
+        with patch.object(service_host.executor, 'submit', side_effect=ExecutorFull):
+            response = self.app.get('/stream', data=communication.Message(args=(3,)).pickle)
+
+        self.assertEqual(503, response.status_code)
+
+    def test_stream_closed_early(self):
+        """
+        Test that the stream stops being generated (and its worker is freed) once the caller goes away.
+        """
+        self.mock_setup('microservice.tests.microservices_for_testing.count_up_to')
+
+        response = self.app.get('/stream', data=communication.Message(args=(1000,)).pickle, buffered=False)
+        self.assertEqual((codec.FRAME_ITEM, 0), next(codec.iter_frames([next(response.response)])))
+        self.assertEqual(1, service_host.executor.active_workers)
+        response.close()
+
+        deadline = time.monotonic() + 5
+        while service_host.executor.active_workers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(0, service_host.executor.active_workers)
+
+    def test_metrics(self):
+        local_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+        self.mock_setup(local_service_name)
+
+        response = self.app.get('/metrics')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(local_service_name, response.json['service_name'])
+        self.assertEqual({
+            'queue_depth': 0,
+            'active_workers': 0,
+            'max_workers': settings.executor_workers,
+            'max_queue_size': settings.executor_queue_size,
+            'rejected': 0,
+            'p95_latency': None,
+        }, response.json['executor'])
+
+    def test_prometheus_metrics(self):
+        local_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+        self.mock_setup(local_service_name)
+
+        with patch.object(service_host.executor, '_queued', 3):
+            response = self.app.get(settings.prometheus_metrics_path)
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertIn('# TYPE microservice_requests_queued gauge', lines)
+        self.assertIn('microservice_requests_queued{{service="{}"}} 3'.format(local_service_name), lines)
+        self.assertIn('microservice_requests_in_flight{{service="{}"}} 0'.format(local_service_name), lines)
+
+    def test_load_is_reported(self):
+        local_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+        self.mock_setup(local_service_name)
+
+        with patch.object(service_host.executor, '_queued', 3), patch.object(service_host.executor, '_active', 2):
+            response = self.app.get('/metrics')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('5', response.headers[settings.load_report_header])
+
+    @patch.multiple(settings, deployment_mode=settings.DeploymentMode.KUBERNETES, side_store_uri=None,
+                    flask_app_server=None)
+    @patch('microservice.core.server.GunicornServer.start')
+    def test_initialise_with_deployment(self, mock_start):
+        service_host.initialise_microservice(
+            'microservice.tests.microservices_for_testing.echo_as_dict', port=10000, server_backend='GUNICORN',
+            deployment_mode='SUBPROCESS', deployment_manager_uri='http://127.0.0.1:9999/')
+
+        mock_start.assert_called_once_with()
+        self.assertEqual(settings.DeploymentMode.SUBPROCESS, settings.deployment_mode)
+        self.assertEqual('http://127.0.0.1:9999/', settings.ServiceWaypost.deployment_manager_uri)
+
+    @patch.multiple(settings, side_store_uri=None, flask_app_server=None)
+    @patch('microservice.core.server.GunicornServer.start')
+    def test_initialise_with_several_workers(self, mock_start):
+        # Replaying a message only relies on the message itself, so can be done by any worker.
+        service_host.initialise_microservice('microservice.tests.microservices_for_testing.echo_as_dict',
+                                             port=10000, server_backend='GUNICORN', workers=2)
+        mock_start.assert_called_once_with()
+
+        # Suspended continuations and stored values are only found by the worker that kept them.
+        with self.assertRaises(ValueError):
+            service_host.initialise_microservice('microservice.tests.microservices_for_testing.echo_in_turn',
+                                                 port=10000, server_backend='GUNICORN', workers=2)
+        with patch.object(settings, 'side_store_enabled', True), self.assertRaises(ValueError):
+            service_host.initialise_microservice('microservice.tests.microservices_for_testing.echo_as_dict',
+                                                 port=10000, server_backend='GUNICORN', workers=2)
+        self.assertEqual(1, mock_start.call_count)
+
+    @patch.multiple(settings, communication_mode=settings.CommunicationMode.ACTOR, side_store_uri=None,
+                    flask_app_server=None)
+    @patch('microservice.core.server.GunicornServer.start')
+    def test_initialise_with_communication_mode(self, mock_start):
+        service_host.initialise_microservice('microservice.tests.microservices_for_testing.echo_in_turn',
+                                             port=10000, server_backend='GUNICORN', workers=2,
+                                             communication_mode='SYN')
+        self.assertEqual(settings.CommunicationMode.SYN, settings.communication_mode)
+        self.assertIsNone(service_host.executor)
+        mock_start.assert_called_once_with()
+
     def test_nested_request(self):
         nested_service_name = "microservice.tests.microservices_for_testing.echo_as_dict"
         local_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict2'
@@ -267,6 +525,32 @@ class TestAsynchronousLocalService(MicroserviceTestCase):
                  expected_message),
         ])
 
+    def test_result_key_is_built_once_per_nested_call(self):
+        """
+        When replaying a function, the result key for each nested call should only be built once, even though it is
+        used to both check for and fetch the previous result.
+        """
+        local_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict2'
+        self.mock_setup(local_service_name)
+
+        msg = communication.Message(args=self.args, kwargs=self.kwargs)
+        msg.add_result('microservice.tests.microservices_for_testing.echo_as_dict',
+                       microservices_for_testing.echo_as_dict2_args,
+                       microservices_for_testing.echo_as_dict2_kwargs,
+                       "previous result")
+
+        settings.set_current_message(msg)
+        try:
+            with patch.object(communication, 'create_result_key', wraps=communication.create_result_key) as mock_key:
+                result = microservices_for_testing.echo_as_dict2(__message=msg)
+        finally:
+            settings.set_current_message(None)
+
+        self.assertEqual("previous result", result[1])
+        mock_key.assert_called_once_with('microservice.tests.microservices_for_testing.echo_as_dict',
+                                         microservices_for_testing.echo_as_dict2_args,
+                                         microservices_for_testing.echo_as_dict2_kwargs)
+
     def test_interface_request(self):
         """
         Test that calling into a decorated function with only args/kwargs results in a call to the relevant
@@ -397,3 +681,104 @@ class TestAsynchronousLocalService(MicroserviceTestCase):
         # Remove the hanging request id to tidy up for any other tests.
         # This is only required because we're doing this test in the reverse order (response, then request).
         del settings.interface_requests[self.request_id]
+
+    def test_interface_request_is_completed_by_response(self):
+        """
+        Test that a submitted interface call is completed as soon as the response is received, without polling.
+        """
+        self.mock_setup('my_app', interface=True)
+
+        args = (3, 4, 5)
+        kwargs = {'erty': 5, 'asdf': 'asddfg'}
+        expected_result = ("nonsense", 35)
+        target_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+
+        future = microservices_for_testing.echo_as_dict.submit(*args, **kwargs)
+        self.assertFalse(future.done())
+
+        response_message = communication.Message(request_id=self.request_id)
+        response_message.add_result(target_service_name, args, kwargs, expected_result)
+        self.app.get('/', data=response_message.pickle)
+
+        self.assertEqual(expected_result, future.result(timeout=1))
+        self.assertNotIn(self.request_id, settings.interface_requests.keys())
+        self.assertNotIn(self.request_id, settings.interface_results.keys())
+        self.assertNotIn(self.request_id, settings.interface_futures.keys())
+
+    @patch.object(settings, 'interface_call_timeout', 0.01)
+    def test_interface_request_timeout(self):
+        """
+        Test that an interface call times out if no response is received, and that no state is left behind.
+        """
+        self.mock_setup('my_app', interface=True)
+
+        with self.assertRaises(TimeoutError):
+            microservices_for_testing.echo_as_dict(1, 2, 3)
+
+        self.assertNotIn(self.request_id, settings.interface_requests.keys())
+        self.assertNotIn(self.request_id, settings.interface_results.keys())
+        self.assertNotIn(self.request_id, settings.interface_futures.keys())
+
+        with self.subTest(msg="Late responses are discarded"):
+            response_message = communication.Message(request_id=self.request_id)
+            response_message.add_result('microservice.tests.microservices_for_testing.echo_as_dict',
+                                        (1, 2, 3), {}, "late")
+            self.app.get('/', data=response_message.pickle)
+            time.sleep(self.THREAD_TIMER)
+            self.assertNotIn(self.request_id, settings.interface_results.keys())
+
+    def test_interface_request_cancel(self):
+        self.mock_setup('my_app', interface=True)
+
+        future = microservices_for_testing.echo_as_dict.submit(1, 2, 3)
+        self.assertIn(self.request_id, settings.interface_requests.keys())
+        self.assertTrue(future.cancel())
+
+        self.assertNotIn(self.request_id, settings.interface_requests.keys())
+        self.assertNotIn(self.request_id, settings.interface_futures.keys())
+
+    def test_interface_async_call(self):
+        """
+        Test that `async_call` sends the request without blocking, and is woken up by the response.
+        """
+        self.mock_setup('my_app', interface=True)
+
+        args = (3, 4, 5)
+        kwargs = {'erty': 5, 'asdf': 'asddfg'}
+        expected_result = ("nonsense", 35)
+        target_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+
+        response_message = communication.Message(request_id=self.request_id)
+        response_message.add_result(target_service_name, args, kwargs, expected_result)
+
+        async def make_call():
+            with patch.object(communication, 'send_object_to_service_async') as mock_send:
+                call_task = asyncio.ensure_future(microservices_for_testing.echo_as_dict.async_call(*args, **kwargs))
+                await asyncio.sleep(0)
+                self.assertFalse(call_task.done())
+                mock_send.assert_called_once_with(target_service_name, communication.Message.from_dict({
+                    'args': args,
+                    'kwargs': kwargs,
+                    'via': [('my_app', (), {})],
+                    'request_id': self.request_id,
+                }))
+
+                # Deliver the response from another thread, as flask would.
+                await asyncio.get_event_loop().run_in_executor(
+                    None, lambda: self.app.get('/', data=response_message.pickle))
+                return await asyncio.wait_for(call_task, 1)
+
+        self.assertEqual(expected_result, asyncio.new_event_loop().run_until_complete(make_call()))
+        self.assertNotIn(self.request_id, settings.interface_futures.keys())
+
+    def test_interface_async_call_cancelled(self):
+        self.mock_setup('my_app', interface=True)
+
+        async def make_call():
+            with patch.object(communication, 'send_object_to_service_async'):
+                await asyncio.wait_for(microservices_for_testing.echo_as_dict.async_call(1, 2, 3), 0.01)
+
+        with self.assertRaises(TimeoutError):
+            asyncio.new_event_loop().run_until_complete(make_call())
+        self.assertNotIn(self.request_id, settings.interface_requests.keys())
+        self.assertNotIn(self.request_id, settings.interface_futures.keys())
@@ -0,0 +1,149 @@
+import threading
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from microservice.core import settings
+from microservice.core.autoscaler import Autoscaler, ServiceLoad
+
+
+class FakeCluster:
+    def __init__(self, replicas: int):
+        self.services = {'my.service': ["http://127.0.0.1:{}/".format(10000 + i) for i in range(replicas)]}
+
+    def uris_for_service(self, service_name):
+        return self.services[service_name]
+
+    def scale(self, service_name, replicas):
+        self.services[service_name] = ["http://127.0.0.1:{}/".format(10000 + i) for i in range(replicas)]
+
+
+@patch.multiple(settings, autoscale_min_replicas=1, autoscale_max_replicas=4,
+                autoscale_queue_high_watermark=5, autoscale_queue_low_watermark=0.5,
+                autoscale_latency_high_watermark=5, autoscale_latency_low_watermark=1,
+                autoscale_step_percent=50, autoscale_up_cooldown=10, autoscale_down_cooldown=60)
+class TestAutoscaler(TestCase):
+    def setUp(self):
+        self.cluster = FakeCluster(2)
+        self.metrics = {}
+        self.autoscaler = Autoscaler(self.cluster, fetch_metrics=self.fetch_metrics)
+
+    def fetch_metrics(self, uri):
+        return self.metrics[uri]
+
+    def set_load(self, queue_depth, p95_latency, active_workers=0):
+        for uri in self.cluster.uris_for_service('my.service'):
+            self.metrics[uri] = {'queue_depth': queue_depth, 'p95_latency': p95_latency,
+                                 'active_workers': active_workers, 'max_workers': 5}
+
+    def replicas(self):
+        return len(self.cluster.uris_for_service('my.service'))
+
+    def step(self, now):
+        scaled = self.autoscaler.step(now=now)
+        self.autoscaler.wait()
+        return scaled
+
+    def test_load(self):
+        self.metrics = {
+            "http://127.0.0.1:10000/": {'queue_depth': 4, 'p95_latency': 2, 'active_workers': 5, 'max_workers': 5},
+            "http://127.0.0.1:10001/": {'queue_depth': 0, 'p95_latency': None, 'active_workers': 0, 'max_workers': 5},
+        }
+        self.assertEqual(ServiceLoad(2, 2, 2, 0.5), self.autoscaler.load('my.service'))
+
+        # Replicas that can't be reached are left out.
+        del self.metrics["http://127.0.0.1:10000/"]
+        self.assertEqual(ServiceLoad(2, 0, 0, 0), self.autoscaler.load('my.service'))
+
+    def test_scale_up_on_queue_depth_with_cooldown(self):
+        self.set_load(queue_depth=10, p95_latency=0)
+        self.assertEqual({'my.service': 3}, self.step(now=100))
+
+        self.set_load(queue_depth=10, p95_latency=0)
+        self.assertEqual({}, self.step(now=105))
+        self.assertEqual({'my.service': 4}, self.step(now=110))
+
+        # Never more than the maximum.
+        self.assertEqual({}, self.step(now=200))
+        self.assertEqual(4, self.replicas())
+
+    def test_scale_up_on_latency(self):
+        self.set_load(queue_depth=0, p95_latency=6)
+        self.assertEqual({'my.service': 3}, self.step(now=100))
+
+    def test_scale_down_when_both_below_low_watermarks(self):
+        self.set_load(queue_depth=0, p95_latency=2)
+        self.assertEqual({}, self.step(now=100))
+
+        self.set_load(queue_depth=0, p95_latency=0.1)
+        self.assertEqual({'my.service': 1}, self.step(now=100))
+
+        # Never fewer than the minimum.
+        self.set_load(queue_depth=0, p95_latency=0)
+        self.assertEqual({}, self.step(now=1000))
+
+    @patch.object(settings, 'autoscale_utilisation_target', 0.7)
+    def test_busy_service_not_scaled_down_too_far(self):
+        self.cluster.scale('my.service', 4)
+        # 12 busy workers need 4 replicas, to keep utilisation below 70%.
+        self.set_load(queue_depth=0, p95_latency=0, active_workers=3)
+        self.assertEqual({}, self.step(now=100))
+
+        # But only 3 replicas for 10 busy workers.
+        self.set_load(queue_depth=0, p95_latency=0, active_workers=2.5)
+        self.assertEqual({'my.service': 3}, self.step(now=100))
+
+    def test_per_service_bounds(self):
+        self.autoscaler.replica_bounds = {'my.service': (2, 3)}
+        self.set_load(queue_depth=10, p95_latency=0)
+        self.assertEqual({'my.service': 3}, self.step(now=100))
+        self.assertEqual({}, self.step(now=200))
+
+        self.set_load(queue_depth=0, p95_latency=0)
+        self.assertEqual({'my.service': 2}, self.step(now=300))
+        self.assertEqual({}, self.step(now=400))
+
+    def test_scale_down_cooldown(self):
+        self.set_load(queue_depth=10, p95_latency=0)
+        self.step(now=100)
+
+        self.set_load(queue_depth=0, p95_latency=0)
+        self.assertEqual({}, self.step(now=150))
+        self.assertEqual({'my.service': 1}, self.step(now=160))
+
+    def test_no_metrics_outside_actor_mode(self):
+        self.set_load(queue_depth=10, p95_latency=0)
+        self.metrics = {uri: None for uri in self.metrics}
+        self.assertEqual({}, self.step(now=100))
+
+    def test_services_are_scaled_in_the_background(self):
+        scaling_started = threading.Event()
+        finish_scaling = threading.Event()
+        scale = self.cluster.scale
+
+        def slow_scale(service_name, replicas):
+            if service_name == 'my.service':
+                scaling_started.set()
+                finish_scaling.wait(5)
+            scale(service_name, replicas)
+
+        self.cluster.services['other.service'] = ["http://127.0.0.1:11000/"]
+        self.cluster.scale = slow_scale
+        self.addCleanup(self.autoscaler.wait)
+        self.addCleanup(finish_scaling.set)
+        self.set_load(queue_depth=10, p95_latency=0)
+        self.metrics["http://127.0.0.1:11000/"] = {'queue_depth': 0, 'p95_latency': 0,
+                                                  'active_workers': 0, 'max_workers': 5}
+        self.assertEqual({'my.service': 3}, self.autoscaler.step(now=100))
+        self.assertTrue(scaling_started.wait(5))
+
+        # Other services are still scaled, and the service being scaled is left alone.
+        self.cluster.services['other.service'].append("http://127.0.0.1:11001/")
+        self.metrics["http://127.0.0.1:11001/"] = self.metrics["http://127.0.0.1:11000/"]
+        self.assertEqual({'other.service': 1}, self.autoscaler.step(now=200))
+        self.assertEqual(2, self.replicas())
+
+        finish_scaling.set()
+        self.autoscaler.wait()
+        self.assertEqual(3, self.replicas())
+        self.assertEqual(100, self.autoscaler.scaled_at['my.service'])
@@ -0,0 +1,66 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from microservice.core.coalescing import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+    # Time allowed for all the calls to be made before the in-flight call completes.
+    THREAD_TIMER = 0.1
+
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+
+    def call(self, result):
+        self.calls.append(result)
+        self.release.wait(5)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def do_concurrently(self, key, result, count=10):
+        with ThreadPoolExecutor(count) as executor:
+            futures = [executor.submit(self.single_flight.do, key, lambda: self.call(result)) for _ in range(count)]
+            time.sleep(self.THREAD_TIMER)
+            self.release.set()
+        return futures
+
+    def test_identical_calls_share_one_execution(self):
+        futures = self.do_concurrently('key', 'result')
+
+        self.assertEqual(['result'] * 10, [future.result() for future in futures])
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual(0, len(self.single_flight))
+
+    def test_different_calls_are_not_shared(self):
+        self.release.set()
+        self.assertEqual(1, self.single_flight.do('key1', lambda: self.call(1)))
+        self.assertEqual(2, self.single_flight.do('key2', lambda: self.call(2)))
+        self.assertEqual(1, self.single_flight.do('key1', lambda: self.call(1)))
+        self.assertEqual([1, 2, 1], self.calls)
+
+    def test_exception_is_shared(self):
+        error = RuntimeError("Shared")
+        futures = self.do_concurrently('key', error)
+
+        for future in futures:
+            self.assertIs(error, future.exception())
+        self.assertEqual(1, len(self.calls))
+
+    def test_not_shared_exception(self):
+        error = KeyError("Not shared")
+        with ThreadPoolExecutor(3) as executor:
+            futures = [executor.submit(self.single_flight.do, 'key', lambda: self.call(error), (KeyError,))
+                       for _ in range(3)]
+            time.sleep(self.THREAD_TIMER)
+            self.release.set()
+
+        for future in futures:
+            self.assertIs(error, future.exception())
+        # Everyone waiting made the call themselves after the in-flight call raised.
+        self.assertEqual(3, len(self.calls))
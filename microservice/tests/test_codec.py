@@ -0,0 +1,99 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from microservice.core import codec, communication, settings, side_store
+
+
+class CustomPayload:
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, CustomPayload) and self.value == other.value
+
+
+class TestCodec(TestCase):
+    def setUp(self):
+        self.message = communication.Message(
+            args=(1, 'two', (3, 4.0)),
+            kwargs={'a': 'asdf', 'b': [1, 2, {'c': b'bytes'}]},
+            via=[
+                ("service_name", (4, 5, 6), {'gfd': 123, 'ert': 908}),
+                ("http://127.0.0.1:5000/", (), {}),
+            ],
+            request_id=123456,
+        )
+        self.message.add_result('service_name2', (1, 2), {'x': None}, ('asdf', 345, 'yes'))
+        self.message.add_result('service_name3', (), {}, {1: 'int key', (2, 3): 'tuple key'})
+
+    def check_round_trip(self, codec_instance):
+        for obj in [self.message, True, None, {}, [1, (2, 3)], (1, [2, 3]), CustomPayload(5)]:
+            with self.subTest(obj=obj):
+                decoded = codec_instance.loads(codec_instance.dumps(obj))
+                self.assertEqual(obj, decoded)
+                self.assertEqual(type(obj), type(decoded))
+
+        decoded = codec_instance.loads(codec_instance.dumps(self.message))
+        self.assertEqual(communication.ViaHeader, type(decoded.via[0]))
+        self.assertEqual(tuple, type(decoded.args[2]))
+        self.assertEqual(self.message.get_result('service_name2', (1, 2), {'x': None}),
+                         decoded.get_result('service_name2', (1, 2), {'x': None}))
+
+    def test_pickle_round_trip(self):
+        self.check_round_trip(codec.codecs[settings.WireCodec.PICKLE])
+
+    def test_msgpack_round_trip(self):
+        self.check_round_trip(codec.codecs[settings.WireCodec.MSGPACK])
+
+    def test_msgpack_exception_result(self):
+        msgpack_codec = codec.codecs[settings.WireCodec.MSGPACK]
+        self.message.add_result('exception_raiser', (), {}, RuntimeError("Sample error"))
+
+        decoded = msgpack_codec.loads(msgpack_codec.dumps(self.message))
+        result = decoded.get_result('exception_raiser', (), {})
+        self.assertEqual(RuntimeError, type(result))
+        self.assertEqual(("Sample error",), result.args)
+
+    def test_msgpack_is_smaller_than_pickle(self):
+        pickled = codec.codecs[settings.WireCodec.PICKLE].dumps(self.message)
+        packed = codec.codecs[settings.WireCodec.MSGPACK].dumps(self.message)
+        self.assertLess(len(packed), len(pickled))
+
+    def test_loads_detects_codec(self):
+        for wire_codec in settings.WireCodec:
+            with self.subTest(wire_codec=wire_codec), patch.object(settings, 'wire_codec', wire_codec):
+                encoded = codec.dumps(self.message)
+                self.assertIs(codec.codecs[wire_codec], codec.codec_for_payload(encoded))
+                self.assertEqual(self.message, codec.loads(encoded))
+
+    def test_register_codec_requires_unique_marker(self):
+        with self.assertRaises(ValueError):
+            codec.register_codec('duplicate', codec.MsgpackCodec())
+        with self.assertRaises(ValueError):
+            codec.register_codec('no marker', codec.PickleCodec())
+
+    def test_frames(self):
+        stream = b''.join([codec.dumps_frame(self.message), codec.dumps_frame(None),
+                           codec.dumps_frame(RuntimeError("Error"), codec.FRAME_ERROR)])
+
+        for chunk_size in [1, 7, len(stream)]:
+            with self.subTest(chunk_size=chunk_size):
+                chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+                frames = list(codec.iter_frames(chunks))
+
+                self.assertEqual([(codec.FRAME_ITEM, self.message), (codec.FRAME_ITEM, None)], frames[:2])
+                self.assertEqual(codec.FRAME_ERROR, frames[2][0])
+                self.assertIsInstance(frames[2][1], RuntimeError)
+
+    def test_incomplete_frame(self):
+        with self.assertRaises(ValueError):
+            list(codec.iter_frames([codec.dumps_frame(self.message)[:-1]]))
+
+    def test_msgpack_stored_ref(self):
+        msgpack_codec = codec.codecs[settings.WireCodec.MSGPACK]
+        ref = side_store.StoredRef("http://127.0.0.1:10000/", "abc")
+        self.message.add_result('large_result', (), {}, ref)
+
+        decoded = msgpack_codec.loads(msgpack_codec.dumps(self.message))
+        self.assertEqual(side_store.StoredRef, type(decoded.get_result('large_result', (), {})))
+        self.assertEqual(ref, decoded.get_result('large_result', (), {}))
@@ -1,19 +1,25 @@
+import asyncio
+import multiprocessing
+import os
 import pickle
 import requests
+import threading
+import time
 
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 from unittest.mock import MagicMock, call, patch
 
-from microservice.core import communication
+from microservice.core import codec, communication, connection_pool, load_balancing, settings
 from microservice.tests.microservice_test_case import MockRequestResult
 
 
 class TestCommunication(TestCase):
     def setUp(self):
         self.mocked_request_result = MockRequestResult()
-        self.original_requests_get = requests.get
+        self.original_get_session = connection_pool.get_session
         self.mocked_requests_get = MagicMock(return_value=self.mocked_request_result)
-        requests.get = self.mocked_requests_get
+        self.mocked_session = MagicMock(get=self.mocked_requests_get)
+        connection_pool.get_session = MagicMock(return_value=self.mocked_session)
 
         self.sample_msg_dict = {
             'args': (1, 2, 3),
@@ -31,9 +37,10 @@ class TestCommunication(TestCase):
         self.sample_message = communication.Message(**self.sample_msg_dict)
 
     def tearDown(self):
-        requests.get = self.original_requests_get
+        connection_pool.get_session = self.original_get_session
+        load_balancing.registry.clear()
 
-    @patch('microservice.core.communication.uri_from_service_name', new=MagicMock(return_value="dummy_uri"))
+    @patch('microservice.core.communication.uris_from_service_name', new=MagicMock(return_value=["dummy_uri"]))
     def test_send_object_to_service(self):
         obj = self.sample_message
         service_name = "sample_service_name"
@@ -90,6 +97,20 @@ class TestCommunication(TestCase):
 
         self.mocked_requests_get.reset_mock()
 
+    @patch('microservice.core.communication.uris_from_service_name',
+           new=MagicMock(return_value=["http://127.0.0.1:10000/", "http://127.0.0.1:10001/"]))
+    def test_send_object_to_service_tries_another_instance(self):
+        self.mocked_requests_get.side_effect = [requests.ConnectionError(), self.mocked_request_result]
+
+        result = communication.send_object_to_service("sample_service_name", self.sample_message)
+
+        self.assertEqual(MockRequestResult.args, result)
+        first_uri, second_uri = [mock_call[1][0] for mock_call in self.mocked_requests_get.mock_calls]
+        self.assertNotEqual(first_uri, second_uri)
+        endpoint_metrics = load_balancing.registry.metrics()["sample_service_name"]
+        self.assertEqual(1, endpoint_metrics[first_uri]['failures'])
+        self.assertEqual(0, endpoint_metrics[second_uri]['failures'])
+
     def test_Message(self):
         msg_dict = self.sample_msg_dict
 
@@ -162,3 +183,204 @@ class TestCommunication(TestCase):
             mock_send_object_to_service.assert_called_once()
             self.assertEqual(mock_send_object_to_service.call_args[0][0], target_service)
             self.assertEqual(result_message2, expected_result)
+
+    def test_create_result_key_is_canonical(self):
+        self.assertEqual(
+            communication.create_result_key('service_name', (1, 2), {'a': 1, 'b': 2, 'c': 3}),
+            communication.create_result_key('service_name', (1, 2), {'c': 3, 'a': 1, 'b': 2}),
+        )
+        self.assertNotEqual(
+            communication.create_result_key('service_name', (1, 2), {'a': 1}),
+            communication.create_result_key('service_name', (1.0, 2), {'a': 1}),
+        )
+
+    @patch('microservice.core.communication.create_result_key', wraps=communication.create_result_key)
+    def test_message_result_key_is_only_calculated_once(self, mock_create_result_key: MagicMock):
+        msg = communication.Message(**self.sample_msg_dict)
+        key = msg.result_key('service_name')
+
+        self.assertEqual(key, communication.create_result_key('service_name', msg.args, msg.kwargs))
+        self.assertIs(key, msg.result_key('service_name'))
+        self.assertEqual(2, mock_create_result_key.call_count)
+
+        with self.subTest(msg="Cache is not sent on the wire"):
+            self.assertNotIn('_result_keys', communication.Message.unpickle(msg.pickle).__getstate__())
+
+    @patch('microservice.core.communication.time.sleep')
+    def test_send_object_to_service_retries_when_service_is_busy(self, mock_sleep: MagicMock):
+        busy = MagicMock(status_code=503, headers={'Retry-After': '2'})
+        self.mocked_requests_get.side_effect = [busy, busy, self.mocked_request_result]
+
+        result = communication.send_object_to_service('http://123.123.123.123:2345/', self.sample_message)
+
+        self.assertEqual(MockRequestResult.args, result)
+        self.assertEqual(3, self.mocked_requests_get.call_count)
+        mock_sleep.assert_has_calls([call(2.0), call(2.0)])
+
+    @patch('microservice.core.communication.time.sleep')
+    def test_send_object_to_service_gives_up_when_service_stays_busy(self, mock_sleep: MagicMock):
+        busy = MagicMock(status_code=429, headers={'Retry-After': '3600'}, __bool__=lambda _: False)
+        self.mocked_requests_get.return_value = busy
+
+        with patch.object(settings, 'backpressure_retries', 2):
+            with self.assertRaises(communication.ServiceRequestFailed) as context:
+                communication.send_object_to_service('http://123.123.123.123:2345/', self.sample_message)
+
+        self.assertEqual(429, context.exception.status_code)
+        self.assertEqual(3, self.mocked_requests_get.call_count)
+        # Services can't make us wait longer than the configured maximum.
+        mock_sleep.assert_has_calls([call(settings.backpressure_max_retry_delay)] * 2)
+
+    def test_send_object_to_service_raises_on_error(self):
+        self.mocked_requests_get.return_value = MagicMock(status_code=500, reason='INTERNAL SERVER ERROR',
+                                                          __bool__=lambda _: False)
+        with self.assertRaises(communication.ServiceRequestFailed) as context:
+            communication.send_object_to_service('http://123.123.123.123:2345/', self.sample_message)
+        self.assertEqual(500, context.exception.status_code)
+        self.assertEqual(1, self.mocked_requests_get.call_count)
+
+    def test_send_object_to_service_async_raises_when_service_stays_busy(self):
+        class FakeResponse:
+            status = 503
+            reason = 'SERVICE UNAVAILABLE'
+            headers = {'Retry-After': '0'}
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc_info):
+                pass
+
+            async def read(self):
+                return b''
+
+        session = MagicMock(get=MagicMock(side_effect=lambda *args, **kwargs: FakeResponse()))
+        with patch.object(connection_pool, 'get_async_session', return_value=session), \
+                patch.object(settings, 'backpressure_retries', 1):
+            with self.assertRaises(communication.ServiceRequestFailed) as context:
+                asyncio.new_event_loop().run_until_complete(
+                    communication.send_object_to_service_async('http://123.123.123.123:2345/', self.sample_message))
+        self.assertEqual(503, context.exception.status_code)
+        self.assertEqual(2, session.get.call_count)
+
+    def test_service_endpoints_async_discovers_off_the_event_loop(self):
+        discovered_in = []
+
+        def discover(service_name):
+            discovered_in.append(threading.current_thread())
+            return ["http://127.0.0.1:10000/"]
+
+        loop = asyncio.new_event_loop()
+        with patch.object(communication, 'uris_from_service_name', side_effect=discover), \
+                patch.object(load_balancing, 'registry', load_balancing.EndpointRegistry()):
+            try:
+                first = loop.run_until_complete(communication.service_endpoints_async("sample_service_name"))
+                second = loop.run_until_complete(communication.service_endpoints_async("sample_service_name"))
+            finally:
+                loop.close()
+
+        self.assertIs(first, second)
+        self.assertEqual(1, len(discovered_in))
+        self.assertIsNot(threading.main_thread(), discovered_in[0])
+
+    def test_stream_from_service(self):
+        stream = codec.dumps_frame(1) + codec.dumps_frame(2) + codec.dumps_frame(RuntimeError(), codec.FRAME_ERROR)
+        response = MagicMock(iter_content=MagicMock(return_value=[stream[:3], stream[3:]]))
+        self.mocked_requests_get.return_value = response
+
+        items = communication.stream_from_service('http://123.123.123.123:2345/', None, 5, fail=True)
+
+        self.assertEqual('http://123.123.123.123:2345/stream', self.mocked_requests_get.call_args[0][0])
+        self.assertTrue(self.mocked_requests_get.call_args[1]['stream'])
+        self.assertEqual(1, next(items))
+        self.assertEqual(2, next(items))
+        with self.assertRaises(RuntimeError):
+            next(items)
+        response.close.assert_called_once_with()
+
+    @patch('microservice.core.communication.uris_from_service_name',
+           new=MagicMock(return_value=["http://127.0.0.1:10000/", "http://127.0.0.1:10001/"]))
+    def test_stream_from_service_tries_another_instance(self):
+        response = MagicMock(iter_content=MagicMock(return_value=[codec.dumps_frame(1)]), headers={})
+        self.mocked_requests_get.side_effect = [requests.ConnectionError(), response]
+
+        items = communication.stream_from_service("sample_stream_service", None)
+
+        first_uri, second_uri = [mock_call[1][0] for mock_call in self.mocked_requests_get.mock_calls]
+        self.assertNotEqual(first_uri, second_uri)
+        self.assertTrue(second_uri.endswith('stream'))
+        endpoint_metrics = load_balancing.registry.metrics()["sample_stream_service"]
+        self.assertEqual(1, endpoint_metrics[first_uri[:-len('stream')]]['failures'])
+
+        # The stream is outstanding on its endpoint until it has been read.
+        second_metrics = endpoint_metrics[second_uri[:-len('stream')]]
+        self.assertEqual(1, second_metrics['outstanding'])
+        self.assertEqual([1], list(items))
+        second_metrics = load_balancing.registry.metrics()["sample_stream_service"][second_uri[:-len('stream')]]
+        self.assertEqual(0, second_metrics['outstanding'])
+
+    @patch('microservice.core.communication.time.sleep')
+    def test_stream_from_service_retries_when_busy(self, mock_sleep):
+        busy = MagicMock(status_code=503, headers={'Retry-After': '1'})
+        response = MagicMock(iter_content=MagicMock(return_value=[codec.dumps_frame(1)]))
+        self.mocked_requests_get.side_effect = [busy, response]
+
+        items = communication.stream_from_service('http://123.123.123.123:2345/', None)
+
+        self.assertEqual([1], list(items))
+        busy.close.assert_called_once_with()
+        mock_sleep.assert_called_once_with(1)
+        self.assertTrue(all(mock_call[2]['stream'] for mock_call in self.mocked_requests_get.mock_calls))
+
+    def test_stream_from_service_raises_on_error(self):
+        response = MagicMock(status_code=500, reason='INTERNAL SERVER ERROR', __bool__=lambda _: False)
+        self.mocked_requests_get.return_value = response
+
+        with self.assertRaises(communication.ServiceRequestFailed) as context:
+            communication.stream_from_service('http://123.123.123.123:2345/', None)
+        self.assertEqual(500, context.exception.status_code)
+        response.close.assert_called_once_with()
+
+    def test_request_ids_are_unique_under_concurrency(self):
+        """
+        Generate ids across many threads, and check that none collide and that at least 100k are made per second.
+
+        Ids take around a microsecond each to generate, so the minimum rate leaves plenty of room for slow machines.
+        """
+        threads = 16
+        ids_per_thread = 20000
+        generated = []
+        # The main thread waits too, so that only generating the ids is timed, not starting the threads.
+        start_barrier = threading.Barrier(threads + 1)
+
+        def generate():
+            start_barrier.wait()
+            generated.append([communication.generate_request_id() for _ in range(ids_per_thread)])
+
+        workers = [threading.Thread(target=generate) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        start_barrier.wait()
+        start = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        all_ids = [request_id for ids in generated for request_id in ids]
+        self.assertEqual(threads * ids_per_thread, len(all_ids))
+        self.assertEqual(len(all_ids), len(set(all_ids)))
+        self.assertGreater(len(all_ids) / elapsed, 100000)
+
+    @skipUnless(hasattr(os, 'fork'), "Requires fork")
+    def test_request_ids_are_unique_across_processes(self):
+        context = multiprocessing.get_context('fork')
+        with context.Pool(4) as pool:
+            child_ids = pool.map(generate_request_ids, [10000] * 4)
+
+        all_ids = generate_request_ids(10000) + [request_id for ids in child_ids for request_id in ids]
+        self.assertEqual(50000, len(set(all_ids)))
+        self.assertEqual(5, len({request_id.rsplit('-', 1)[0] for request_id in all_ids}))
+
+
+def generate_request_ids(count):
+    return [communication.generate_request_id() for _ in range(count)]
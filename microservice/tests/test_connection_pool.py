@@ -0,0 +1,75 @@
+import requests
+
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from microservice.core import connection_pool, settings
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.pool = connection_pool.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def test_origin_from_uri(self):
+        self.assertEqual("http://127.0.0.1:10000", connection_pool.origin_from_uri("http://127.0.0.1:10000/"))
+        self.assertEqual("http://127.0.0.1:10000", connection_pool.origin_from_uri("http://127.0.0.1:10000/uri/a.b"))
+        self.assertEqual("http://my-service.pycroservices",
+                         connection_pool.origin_from_uri("http://my-service.pycroservices/"))
+
+    def test_session_is_reused_per_origin(self):
+        session = self.pool.get_session("http://127.0.0.1:10000/")
+        self.assertIs(session, self.pool.get_session("http://127.0.0.1:10000/ping"))
+        self.assertIsNot(session, self.pool.get_session("http://127.0.0.1:10001/"))
+        self.assertEqual(2, len(self.pool))
+
+    @patch.object(settings, 'connection_pool_sizes', {'my.service': 3})
+    def test_pool_size_per_service(self):
+        session = self.pool.get_session("http://127.0.0.1:10000/", 'my.service')
+        self.assertEqual(3, session.get_adapter("http://127.0.0.1:10000/")._pool_maxsize)
+
+        session = self.pool.get_session("http://127.0.0.1:10001/", 'my.other.service')
+        self.assertEqual(settings.connection_pool_size,
+                         session.get_adapter("http://127.0.0.1:10001/")._pool_maxsize)
+
+    def test_idle_sessions_are_closed(self):
+        session = self.pool.get_session("http://127.0.0.1:10000/")
+
+        self.assertEqual(0, self.pool.close_idle_sessions(idle_timeout=60))
+        self.assertEqual(1, self.pool.close_idle_sessions(idle_timeout=-1))
+        self.assertEqual(0, len(self.pool))
+        self.assertIsNot(session, self.pool.get_session("http://127.0.0.1:10000/"))
+
+    @patch('requests.Session.request', side_effect=lambda *args, **kwargs: MagicMock())
+    def test_sessions_in_use_are_not_closed(self, mock_request):
+        session = self.pool.get_session("http://127.0.0.1:10000/")
+        session.get("http://127.0.0.1:10000/ping")
+        self.assertEqual(0, session.active_requests)
+
+        # Streamed responses are in use until they are closed.
+        response = session.get("http://127.0.0.1:10000/stream", stream=True)
+        self.assertEqual(1, session.active_requests)
+        self.assertEqual(0, self.pool.close_idle_sessions(idle_timeout=-1))
+        response.close()
+        response.close()
+        self.assertEqual(0, session.active_requests)
+        self.assertEqual(1, self.pool.close_idle_sessions(idle_timeout=-1))
+
+        mock_request.side_effect = requests.ConnectionError()
+        session = self.pool.get_session("http://127.0.0.1:10000/")
+        with self.assertRaises(requests.ConnectionError):
+            session.get("http://127.0.0.1:10000/stream", stream=True)
+        self.assertEqual(0, session.active_requests)
+
+    def test_close_all_closes_sessions_in_use(self):
+        session = self.pool.get_session("http://127.0.0.1:10000/")
+        session.active_requests = 1
+        self.pool.close_all()
+        self.assertEqual(0, len(self.pool))
+
+    def test_sessions_are_not_shared_with_forked_processes(self):
+        session = self.pool.get_session("http://127.0.0.1:10000/")
+        with patch('os.getpid', return_value=self.pool._pid + 1):
+            self.assertIsNot(session, self.pool.get_session("http://127.0.0.1:10000/"))
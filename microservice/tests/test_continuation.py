@@ -0,0 +1,113 @@
+from unittest.mock import patch
+
+from microservice.tests.microservice_test_case import MicroserviceTestCase
+
+from microservice.core import communication, continuation, settings
+from microservice.tests import microservices_for_testing
+
+
+class TestContinuation(MicroserviceTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(TestContinuation, cls).setUpClass()
+        settings.communication_mode = settings.CommunicationMode.ACTOR
+        settings.deployment_mode = settings.DeploymentMode.KUBERNETES
+        settings.local_uri = None
+
+    def setUp(self):
+        super(TestContinuation, self).setUp()
+        self.local_service_name = 'microservice.tests.microservices_for_testing.echo_in_turn'
+        self.nested_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+        self.mock_setup(self.local_service_name)
+        patcher = patch.object(continuation, 'suspended_calls', continuation.SuspendedCalls())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        microservices_for_testing.echo_in_turn_starts.clear()
+
+    def tearDown(self):
+        settings.set_current_message(None)
+        super(TestContinuation, self).tearDown()
+
+    def handle(self, message: communication.Message):
+        settings.set_current_message(message)
+        return microservices_for_testing.echo_in_turn(__message=message)
+
+    def reply_to_nested_call(self, result) -> communication.Message:
+        """
+        :return: The message the nested service sends back, with `result`, in response to the last call sent.
+        """
+        sent = self.mocked_send_object_to_service.call_args[0][1]
+        reply = communication.Message(
+            args=sent.via[-1].args,
+            kwargs=sent.via[-1].kwargs,
+            via=sent.via[:-1],
+            results=dict(sent.results),
+            request_id=sent.request_id,
+        )
+        reply.add_result(self.nested_service_name, sent.args, sent.kwargs, result)
+        return reply
+
+    def test_resumed_when_result_arrives(self):
+        message = communication.Message(args=(1, 2), via=[('caller', (), {})])
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(message)
+        self.assertEqual(1, len(continuation.suspended_calls))
+        self.assertEqual(self.nested_service_name, self.mocked_send_object_to_service.call_args[0][0])
+        self.assertEqual((1,), self.mocked_send_object_to_service.call_args[0][1].args)
+
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(self.reply_to_nested_call('first'))
+        self.assertEqual((2,), self.mocked_send_object_to_service.call_args[0][1].args)
+
+        self.assertEqual(['first', 'second'], self.handle(self.reply_to_nested_call('second')))
+        self.assertEqual([(1, 2)], microservices_for_testing.echo_in_turn_starts)
+        self.assertEqual({'suspended': 0, 'resumed': 2, 'discarded': 0}, continuation.suspended_calls.metrics())
+
+    def test_replayed_if_not_suspended(self):
+        message = communication.Message(args=(1, 2), via=[('caller', (), {})])
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(message)
+        reply = self.reply_to_nested_call('first')
+
+        # E.g. the result arrived at a different instance of the service.
+        continuation.suspended_calls.clear()
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(reply)
+        self.assertEqual((2,), self.mocked_send_object_to_service.call_args[0][1].args)
+        self.assertEqual([(1, 2), (1, 2)], microservices_for_testing.echo_in_turn_starts)
+
+        # The replayed function is suspended in turn.
+        self.assertEqual(['first', 'second'], self.handle(self.reply_to_nested_call('second')))
+        self.assertEqual([(1, 2), (1, 2)], microservices_for_testing.echo_in_turn_starts)
+
+    @patch.object(settings, 'continuation_max_suspended', 1)
+    def test_oldest_discarded_when_full(self):
+        first = communication.Message(args=(1,), via=[('caller', (), {})])
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(first)
+        first_reply = self.reply_to_nested_call('first')
+
+        second = communication.Message(args=(2,), via=[('caller', (), {})])
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(second)
+
+        self.assertEqual(['first'], self.handle(first_reply))
+        self.assertEqual({'suspended': 1, 'resumed': 0, 'discarded': 1}, continuation.suspended_calls.metrics())
+
+    @patch.object(settings, 'continuation_ttl', -1)
+    def test_expired_calls_are_discarded(self):
+        message = communication.Message(args=(1,), via=[('caller', (), {})])
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(message)
+        self.assertEqual(1, continuation.suspended_calls.metrics()['discarded'])
+
+    def test_only_deferred_calls_can_be_yielded(self):
+        def not_deferred():
+            yield 1
+
+        with self.assertRaises(TypeError):
+            continuation.run('not_deferred', not_deferred, (), {})
+
+    def test_process_executor_not_allowed(self):
+        with self.assertRaises(ValueError):
+            microservices_for_testing.microservice(continuation=True, executor="process")
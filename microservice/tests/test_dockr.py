@@ -0,0 +1,98 @@
+import docker
+import threading
+import time
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from microservice.core import dockr, settings
+
+
+class FakeImage:
+    def __init__(self, image_id: str, labels: dict):
+        self.id = image_id
+        self.labels = labels
+
+
+class FakeDockerClient:
+    """
+    Docker client that "builds" images by recording them, taking `build_time` seconds for each.
+    """
+
+    def __init__(self, build_time: float=0.0, fail: str=None):
+        self.build_time = build_time
+        self.fail = fail
+        self.built = []
+        self.images = self
+        self.api = self
+        self._images = {dockr.base_image: FakeImage('base', {})}
+        self._lock = threading.Lock()
+        self._building = 0
+        self.max_concurrent_builds = 0
+
+    def get(self, tag):
+        try:
+            return self._images[tag]
+        except KeyError:
+            raise docker.errors.ImageNotFound(tag)
+
+    def build(self, tag, labels, fileobj, **kwargs):
+        with self._lock:
+            self._building += 1
+            self.max_concurrent_builds = max(self.max_concurrent_builds, self._building)
+        time.sleep(self.build_time)
+        with self._lock:
+            self._building -= 1
+            self.built.append((tag, fileobj.read().decode('utf-8')))
+        if tag == self.fail:
+            yield {'error': 'The command returned a non-zero code: 1'}
+            return
+        self._images[tag] = FakeImage(tag, labels)
+        yield {'stream': 'Step 1/2'}
+        yield {'stream': 'Successfully tagged {}\n'.format(tag)}
+
+
+@patch.multiple(settings, docker_image_mode=settings.DockerImageMode.PER_SERVICE, docker_build_workers=4)
+class TestBuildAllImages(TestCase):
+    def setUp(self):
+        self.service_names = ['service.{}'.format(i) for i in range(8)]
+
+    def test_built_concurrently(self):
+        client = FakeDockerClient(build_time=0.05)
+        images = dockr.build_all_images(self.service_names, client=client)
+
+        self.assertEqual({name: "{}:latest".format(name) for name in self.service_names}, images)
+        self.assertEqual(8, len(client.built))
+        self.assertEqual(4, client.max_concurrent_builds)
+        self.assertIn('CMD ["service.0"]', dict(client.built)["service.0:latest"])
+
+    def test_unchanged_images_are_skipped(self):
+        client = FakeDockerClient()
+        dockr.build_all_images(self.service_names, client=client)
+        dockr.build_all_images(self.service_names + ['service.new'], client=client)
+        self.assertEqual(9, len(client.built))
+
+        # Changing the base image changes the content of every image.
+        client._images[dockr.base_image] = FakeImage('new base', {})
+        dockr.build_all_images(self.service_names[:2], client=client)
+        self.assertEqual(11, len(client.built))
+
+        dockr.build_all_images(self.service_names[:2], client=client, force=True)
+        self.assertEqual(13, len(client.built))
+
+    def test_failed_builds_are_reported(self):
+        client = FakeDockerClient(fail='service.3:latest')
+        with self.assertRaises(RuntimeError) as context:
+            dockr.build_all_images(self.service_names, client=client)
+        self.assertIn('service.3', str(context.exception))
+        # The other images are still built.
+        self.assertEqual(8, len(client.built))
+
+    def test_shared_image(self):
+        client = FakeDockerClient()
+        with patch.object(settings, 'docker_image_mode', settings.DockerImageMode.SHARED):
+            images = dockr.build_all_images(self.service_names, client=client)
+
+        self.assertEqual({settings.docker_shared_image}, set(images.values()))
+        self.assertEqual([settings.docker_shared_image], [tag for tag, _ in client.built])
+        self.assertNotIn('CMD', client.built[0][1])
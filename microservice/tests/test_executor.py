@@ -0,0 +1,101 @@
+import threading
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from microservice.core import executor, settings
+from microservice.core.executor import BoundedExecutor, ExecutorFull, percentile
+
+
+class TestBoundedExecutor(TestCase):
+    def setUp(self):
+        self.executor = BoundedExecutor(max_workers=1, max_queue_size=2)
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+
+    def block(self):
+        self.started.set()
+        self.release.wait(5)
+
+    def test_queue_is_bounded(self):
+        running = self.executor.submit(self.block)
+        self.started.wait(5)
+        queued = [self.executor.submit(self.block) for _ in range(2)]
+
+        with self.assertRaises(ExecutorFull):
+            self.executor.submit(self.block)
+
+        self.release.set()
+        for future in [running] + queued:
+            future.result(5)
+        self.executor.submit(self.block).result(5)
+
+    def test_submit_all(self):
+        self.assertEqual([1, 2, 3], [future.result(5) for future in self.executor.submit_all(abs, [(-1,), (2,), (-3,)])])
+
+        # Batches larger than the queue are only refused while other requests are waiting.
+        running = self.executor.submit(self.block)
+        self.started.wait(5)
+        queued = self.executor.submit(self.block)
+        with self.assertRaises(ExecutorFull):
+            self.executor.submit_all(self.block, [(), ()])
+        self.assertEqual(1, self.executor.queue_depth)
+        self.release.set()
+        for future in [running, queued]:
+            future.result(5)
+
+    def test_metrics(self):
+        self.executor.submit(self.block)
+        self.started.wait(5)
+        self.executor.submit(self.block)
+        self.executor.submit(self.block)
+        with self.assertRaises(ExecutorFull):
+            self.executor.submit(self.block)
+
+        self.assertEqual({
+            'queue_depth': 2,
+            'active_workers': 1,
+            'max_workers': 1,
+            'max_queue_size': 2,
+            'rejected': 1,
+            'p95_latency': None,
+        }, self.executor.metrics())
+
+    def test_p95_latency(self):
+        self.release.set()
+        for future in [self.executor.submit(self.block) for _ in range(3)]:
+            future.result(5)
+        self.assertLess(self.executor.p95_latency(), 5)
+
+        with patch.object(settings, 'executor_latency_window', -1):
+            self.assertIsNone(self.executor.p95_latency())
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(95, percentile(values, 95))
+        self.assertEqual(100, percentile(values, 100))
+        self.assertEqual(3, percentile([3], 95))
+
+    def test_unbounded_queue(self):
+        executor = BoundedExecutor(max_workers=1, max_queue_size=0)
+        futures = [executor.submit(lambda: None) for _ in range(200)]
+        for future in futures:
+            future.result(5)
+        self.assertEqual(0, executor.queue_depth)
+        executor.shutdown()
+
+
+class TestProcessPoolContext(TestCase):
+    def test_forkserver_where_available(self):
+        with patch.object(executor.multiprocessing, 'get_all_start_methods', return_value=['fork', 'forkserver']):
+            self.assertEqual('forkserver', executor.process_pool_context()['mp_context'].get_start_method())
+
+    def test_default_start_method_otherwise(self):
+        with patch.object(executor.multiprocessing, 'get_all_start_methods', return_value=['spawn']):
+            self.assertEqual({}, executor.process_pool_context())
+        with patch.object(executor.sys, 'version_info', (3, 6, 4)):
+            self.assertEqual({}, executor.process_pool_context())
@@ -0,0 +1,124 @@
+from flask import Flask
+from unittest import TestCase
+from unittest.mock import patch
+
+from microservice.tests.microservice_test_case import MicroserviceTestCase
+
+from microservice.core import communication, continuation, fan_out, settings
+from microservice.tests import microservices_for_testing
+
+
+class TestGather(MicroserviceTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(TestGather, cls).setUpClass()
+        settings.communication_mode = settings.CommunicationMode.ACTOR
+        settings.deployment_mode = settings.DeploymentMode.KUBERNETES
+        settings.local_uri = None
+
+    def setUp(self):
+        super(TestGather, self).setUp()
+        self.nested_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+        for module, name, value in [(fan_out, 'pending_joins', fan_out.PendingJoins()),
+                                    (continuation, 'suspended_calls', continuation.SuspendedCalls())]:
+            patcher = patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        settings.set_current_message(None)
+        super(TestGather, self).tearDown()
+
+    def handle(self, service, message: communication.Message):
+        settings.set_current_message(message)
+        return service(__message=message)
+
+    def sent_calls(self) -> list:
+        return [mock_call[0][1] for mock_call in self.mocked_send_object_to_service.call_args_list]
+
+    def reply_to(self, sent: communication.Message) -> communication.Message:
+        """
+        :return: The message the nested service sends back in response to `sent`.
+        """
+        reply = communication.Message(
+            args=sent.via[-1].args,
+            kwargs=sent.via[-1].kwargs,
+            via=sent.via[:-1],
+            results=dict(sent.results),
+            request_id=sent.request_id,
+        )
+        reply.add_result(self.nested_service_name, sent.args, sent.kwargs, "result of {}".format(sent.args[0]))
+        return reply
+
+    def test_calls_are_sent_at_once(self):
+        service = microservices_for_testing.echo_gathered
+        self.mock_setup('microservice.tests.microservices_for_testing.echo_gathered')
+
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(service, communication.Message(args=(1, 2), via=[('caller', (), {})]))
+        first, second = self.sent_calls()
+        self.assertEqual(((1,), (2,)), (first.args, second.args))
+        self.assertEqual(first.via, second.via)
+        self.assertEqual(2, len(first.via))
+
+        # The results can arrive in any order.
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(service, self.reply_to(second))
+        self.assertEqual(["result of 1", "result of 2"], self.handle(service, self.reply_to(first)))
+        self.assertEqual(2, len(self.sent_calls()))
+        self.assertEqual(0, len(fan_out.pending_joins))
+
+    def test_map_is_gathered(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.echo_mapped')
+
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(microservices_for_testing.echo_mapped,
+                        communication.Message(args=(1, 2), via=[('caller', (), {})]))
+        self.assertEqual([(1,), (2,)], [sent.args for sent in self.sent_calls()])
+        for call in self.mocked_send_object_to_service.call_args_list:
+            self.assertNotIn('path', call[1])
+
+    def test_missing_calls_are_sent_again_if_not_waiting(self):
+        service = microservices_for_testing.echo_gathered
+        self.mock_setup('microservice.tests.microservices_for_testing.echo_gathered')
+
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(service, communication.Message(args=(1, 2), via=[('caller', (), {})]))
+        first, second = self.sent_calls()
+
+        # E.g. the result arrived at a different instance of the service.
+        with patch.object(fan_out, 'pending_joins', fan_out.PendingJoins()):
+            with self.assertRaises(communication.ServiceCallPerformed):
+                self.handle(service, self.reply_to(first))
+        resent = self.sent_calls()[2]
+        self.assertEqual((2,), resent.args)
+        self.assertEqual(["result of 1", "result of 2"], self.handle(service, self.reply_to(resent)))
+
+    def test_continuation(self):
+        service = microservices_for_testing.echo_gathered_in_turn
+        self.mock_setup('microservice.tests.microservices_for_testing.echo_gathered_in_turn')
+
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(service, communication.Message(args=(1, 2), via=[('caller', (), {})]))
+        first, second = self.sent_calls()
+
+        with self.assertRaises(communication.ServiceCallPerformed):
+            self.handle(service, self.reply_to(first))
+        self.assertEqual(["result of 1", "result of 2"], self.handle(service, self.reply_to(second)))
+        self.assertEqual(2, continuation.suspended_calls.metrics()['resumed'])
+
+
+class TestGatherInThreads(TestCase):
+    @patch.object(settings, 'communication_mode', settings.CommunicationMode.SYN)
+    def test_calls_are_made_as_part_of_the_message(self):
+        message = communication.Message(request_id='1234')
+        calls = [continuation.DeferredCall(settings.current_message, (), {}) for _ in range(10)]
+        with Flask(__name__).app_context():
+            settings.set_current_message(message)
+            self.assertEqual([message] * 10, fan_out.gather_in_threads(calls, message))
+        self.assertIsNone(settings.current_message())
+
+    def test_errors_are_raised(self):
+        calls = [continuation.DeferredCall(int, ('1',), {}), continuation.DeferredCall(int, ('x',), {})]
+        with self.assertRaises(ValueError):
+            fan_out.gather_in_threads(calls, None)
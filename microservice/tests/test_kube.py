@@ -0,0 +1,74 @@
+import json
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from microservice.core import kube, settings
+from microservice.core.decorator import microservice
+from microservice.core.executor import IN_FLIGHT_METRIC, QUEUED_METRIC
+from microservice.core.utils import MicroserviceDefinition
+
+
+class TestKubeMicroservice(TestCase):
+    def test_defaults(self):
+        service = kube.KubeMicroservice('my.service')
+        container = service.pod_spec.containers[0]
+        self.assertEqual(settings.kube_default_resources['requests'], container.resources.requests)
+        self.assertIsNone(container.resources.limits)
+        self.assertEqual(['my.service'], container.args)
+
+        hpa = service.hpa_definition.spec
+        self.assertEqual((settings.kube_default_min_replicas, settings.kube_default_max_replicas),
+                         (hpa.min_replicas, hpa.max_replicas))
+        self.assertEqual(settings.kube_default_target_cpu_utilization,
+                         hpa.metrics[0].resource.target.average_utilization)
+
+    def test_tuning_from_definition(self):
+        definition = MicroserviceDefinition(
+            'my.service',
+            resources={'requests': {'cpu': '2'}, 'limits': {'memory': '1Gi'}},
+            min_replicas=2,
+            max_replicas=8,
+            target_cpu_utilization=80,
+            executor_workers=1,
+        )
+        service = kube.KubeMicroservice.from_definition(definition, image='shared:latest')
+
+        container = service.pod_spec.containers[0]
+        self.assertEqual('shared:latest', container.image)
+        self.assertEqual({'cpu': '2'}, container.resources.requests)
+        self.assertEqual({'memory': '1Gi'}, container.resources.limits)
+        self.assertEqual('my.service', container.args[0])
+        other_kwargs = container.args[container.args.index('--other_kwargs') + 1]
+        self.assertEqual({'executor_workers': 1}, json.loads(other_kwargs))
+
+        hpa = service.hpa_definition.spec
+        self.assertEqual((2, 8), (hpa.min_replicas, hpa.max_replicas))
+        self.assertEqual(80, hpa.metrics[0].resource.target.average_utilization)
+        self.assertEqual(2, service.deployment_definition.spec.replicas)
+
+    @patch.multiple(settings, communication_mode=settings.CommunicationMode.ACTOR, kube_target_queued_requests=4,
+                    kube_target_in_flight_utilisation=0.5)
+    def test_autoscaled_on_requests(self):
+        service = kube.KubeMicroservice('my.service', service_kwargs={'executor_workers': 3})
+        targets = {metric.pods.metric.name: metric.pods.target.average_value
+                   for metric in service.hpa_definition.spec.metrics if metric.type == "Pods"}
+        self.assertEqual({IN_FLIGHT_METRIC: '1.5', QUEUED_METRIC: '4'}, targets)
+
+        annotations = service.deployment_definition.spec.template.metadata.annotations
+        self.assertEqual(settings.prometheus_metrics_path, annotations['prometheus.io/path'])
+
+        with patch.object(settings, 'communication_mode', settings.CommunicationMode.SYN):
+            self.assertEqual(["Resource"], [metric.type for metric in service.hpa_definition.spec.metrics])
+
+    def test_decorator_records_tuning(self):
+        def tuned():
+            pass
+
+        microservice(min_replicas=2, max_replicas=4, executor_workers=1)(tuned)
+        self.addCleanup(settings.all_microservices.pop)
+        definition = settings.all_microservices[-1]
+        self.assertEqual((2, 4, 1), (definition.min_replicas, definition.max_replicas, definition.executor_workers))
+
+        with self.assertRaises(ValueError):
+            microservice(min_replicas=4, max_replicas=2)
@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+
+from flask import Flask, Response, jsonify, request
+from kubernetes import client
+from unittest import TestCase
+from unittest.mock import patch
+from werkzeug.serving import make_server
+
+from microservice.core import communication, kube, kube_endpoints, load_balancing, settings
+
+
+def endpoints(kube_name: str, resource_version: int, ready: list, not_ready: list=()) -> dict:
+    """
+    :return: Endpoints as sent by the kubernetes API, with pods at the given ips.
+    """
+    subsets = []
+    if ready or not_ready:
+        subsets.append({
+            'addresses': [{'ip': ip} for ip in ready] or None,
+            'notReadyAddresses': [{'ip': ip} for ip in not_ready] or None,
+            'ports': [{'name': kube_name, 'port': 5000, 'protocol': 'TCP'}],
+        })
+    return {
+        'kind': 'Endpoints',
+        'apiVersion': 'v1',
+        'metadata': {'name': kube_name, 'namespace': settings.kube_namespace,
+                     'resourceVersion': str(resource_version)},
+        'subsets': subsets,
+    }
+
+
+class FakeEndpointsServer:
+    """
+    Kubernetes API server for Endpoints, which replays the events given to it to watches.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.events = []  # (resource version, event)
+        self.resource_version = 1
+        # Watches from before this resource version have expired.
+        self.oldest_resource_version = 0
+        self.lists = 0
+        # Whether requests are refused, as they are when the service account isn't allowed to make them.
+        self.forbidden = False
+        self._condition = threading.Condition()
+        app = Flask(__name__)
+
+        @app.route('/api/v1/namespaces/<namespace>/endpoints')
+        def endpoints_collection(namespace):
+            if request.args.get('watch', '').lower() != 'true':
+                self.lists += 1
+                if self.forbidden:
+                    return jsonify({'kind': 'Status', 'code': 403, 'reason': 'Forbidden'}), 403
+                return jsonify({'kind': 'EndpointsList', 'apiVersion': 'v1',
+                                'metadata': {'resourceVersion': str(self.resource_version)},
+                                'items': list(self.endpoints.values())})
+            since = int(request.args['resourceVersion'])
+            timeout = float(request.args.get('timeoutSeconds', 1))
+            return Response(self.stream(since, timeout), mimetype='application/json')
+
+        self._server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.uri = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+
+    def stream(self, since: int, timeout: float):
+        if since < self.oldest_resource_version:
+            yield json.dumps({'type': 'ERROR', 'object': {
+                'kind': 'Status', 'code': 410, 'reason': 'Expired', 'message': 'too old resource version'}}) + '\n'
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._condition:
+                events = [event for version, event in self.events if version > since]
+                if not events:
+                    self._condition.wait(deadline - time.monotonic())
+                    continue
+            for event in events:
+                yield json.dumps(event) + '\n'
+            since = int(events[-1]['object']['metadata']['resourceVersion'])
+
+    def record(self, event_type: str, kube_name: str, ready: list=(), not_ready: list=()):
+        with self._condition:
+            self.resource_version += 1
+            body = endpoints(kube_name, self.resource_version, list(ready), list(not_ready))
+            if event_type == 'DELETED':
+                self.endpoints.pop(kube_name, None)
+            else:
+                self.endpoints[kube_name] = body
+            self.events.append((self.resource_version, {'type': event_type, 'object': body}))
+            self._condition.notify_all()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._thread.join()
+
+
+def wait_for(condition, timeout: float=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for condition")
+        time.sleep(0.01)
+
+
+class TestEndpointsWatcher(TestCase):
+    def setUp(self):
+        # Patched here rather than on the class, so that the watcher is stopped (in tearDown) with them too.
+        settings_patch = patch.multiple(settings, kube_endpoints_watch_timeout=1, kube_endpoints_retry_interval=0.01)
+        settings_patch.start()
+        self.addCleanup(settings_patch.stop)
+        self.server = FakeEndpointsServer()
+        self.server.record('ADDED', 'my-service', ready=['10.0.0.2', '10.0.0.1'], not_ready=['10.0.0.9'])
+        self.api_client = client.ApiClient(client.Configuration(host=self.server.uri))
+        self.registry = load_balancing.EndpointRegistry()
+        self.watcher = kube_endpoints.EndpointsWatcher(kube.KubeApis(self.api_client), registry=self.registry)
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.server.shutdown()
+        self.api_client.close()
+
+    def uris(self) -> list:
+        return list(self.registry.get('my.service', self.watcher.uris_for_service).metrics())
+
+    def test_ready_pods_are_discovered(self):
+        self.assertEqual(['http://10.0.0.1:5000/', 'http://10.0.0.2:5000/'],
+                         self.watcher.uris_for_service('my.service'))
+        self.assertEqual([], self.watcher.uris_for_service('other.service'))
+
+    def test_changes_are_pushed(self):
+        self.assertEqual(2, len(self.uris()))
+
+        self.server.record('MODIFIED', 'my-service', ready=['10.0.0.1', '10.0.0.3'])
+        wait_for(lambda: set(self.uris()) == {'http://10.0.0.1:5000/', 'http://10.0.0.3:5000/'})
+
+        self.server.record('DELETED', 'my-service')
+        wait_for(lambda: len(self.uris()) == 0)
+        self.server.record('ADDED', 'my-service', ready=['10.0.0.4'])
+        wait_for(lambda: self.uris() == ['http://10.0.0.4:5000/'])
+        # The watch is resumed, rather than the endpoints being listed again.
+        self.assertEqual(1, self.server.lists)
+
+    def test_expired_watch_lists_again(self):
+        self.watcher.resource_version = '1'
+        self.server.oldest_resource_version = self.server.resource_version
+        self.assertEqual(2, len(self.watcher.uris_for_service('my.service')))
+        self.assertEqual(1, self.server.lists)
+
+        self.server.record('MODIFIED', 'my-service', ready=['10.0.0.5'])
+        wait_for(lambda: self.watcher.uris_for_service('my.service') == ['http://10.0.0.5:5000/'])
+
+    @patch.multiple(settings, deployment_mode=settings.DeploymentMode.KUBERNETES,
+                    kube_discovery_mode=settings.KubeDiscoveryMode.ENDPOINTS)
+    def test_discovery(self):
+        with patch.object(kube_endpoints, 'watcher', self.watcher):
+            self.assertEqual(2, len(communication.uris_from_service_name('my.service')))
+
+        # Without the endpoints, requests go to the service instead.
+        self.server.shutdown()
+        watcher = kube_endpoints.EndpointsWatcher(kube.KubeApis(self.api_client), registry=self.registry)
+        self.addCleanup(watcher.stop)
+        with patch.object(kube_endpoints, 'watcher', watcher), \
+                patch.object(settings, 'kube_endpoints_sync_timeout', 0.1):
+            self.assertEqual([kube.uri_for_service('my.service')], communication.uris_from_service_name('my.service'))
+
+    def test_forbidden_falls_back_without_waiting_again(self):
+        self.server.forbidden = True
+        service_uri = kube.uri_for_service('my.service')
+        with patch.object(settings, 'kube_endpoints_sync_timeout', 0.2), \
+                self.assertLogs(kube_endpoints.logger, 'WARNING') as logs:
+            self.assertEqual([service_uri], self.uris())
+            wait_for(lambda: self.server.lists > 3)
+
+            start = time.monotonic()
+            self.assertEqual([service_uri], self.watcher.uris_for_service('my.service'))
+            self.assertLess(time.monotonic() - start, 0.1)
+        forbidden_logs = [line for line in logs.output if 'Not allowed' in line]
+        self.assertEqual(1, len(forbidden_logs))
+
+        # Once allowed, the pods replace the service.
+        self.server.forbidden = False
+        wait_for(lambda: len(self.uris()) == 2)
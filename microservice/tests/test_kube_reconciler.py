@@ -0,0 +1,127 @@
+import threading
+
+from flask import Flask, jsonify, request
+from kubernetes import client
+from unittest import TestCase
+from werkzeug.serving import make_server
+
+from microservice.core import kube, settings
+from microservice.core.kube_reconciler import Reconciler
+
+
+class FakeKubeApiServer:
+    """
+    Kubernetes API server that keeps resources in memory, and records the requests made to it.
+    """
+
+    def __init__(self):
+        self.resources = {}  # Keyed by collection path, then name.
+        self.requests = []
+        self.failing = set()
+        self._lock = threading.Lock()
+        app = Flask(__name__)
+
+        @app.route('/<path:collection>', methods=['GET', 'POST'])
+        def resource_collection(collection):
+            self.record(collection)
+            resources = self.resources.setdefault(collection, {})
+            if request.method == 'GET':
+                return jsonify({'kind': 'List', 'apiVersion': 'v1', 'metadata': {},
+                                'items': list(resources.values())})
+            body = request.get_json(force=True)
+            name = body['metadata']['name']
+            if name in self.failing:
+                return jsonify({'kind': 'Status', 'code': 500, 'message': 'failed'}), 500
+            if name in resources:
+                return jsonify({'kind': 'Status', 'code': 409, 'reason': 'AlreadyExists'}), 409
+            resources[name] = body
+            return jsonify(body), 201
+
+        @app.route('/<path:collection>/<name>', methods=['PATCH'])
+        def resource(collection, name):
+            self.record(collection)
+            resources = self.resources.setdefault(collection, {})
+            if name not in resources:
+                return jsonify({'kind': 'Status', 'code': 404, 'reason': 'NotFound'}), 404
+            resources[name] = request.get_json(force=True)
+            return jsonify(resources[name])
+
+        self._server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.uri = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+
+    def record(self, collection):
+        with self._lock:
+            self.requests.append((request.method, collection.rsplit('/', 1)[-1]))
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._thread.join()
+
+
+class TestReconciler(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeKubeApiServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.server.resources.clear()
+        self.server.failing.clear()
+        configuration = client.Configuration(host=self.server.uri)
+        self.api_client = client.ApiClient(configuration)
+        self.reconciler = Reconciler(kube.KubeApis(self.api_client))
+        self.services = [kube.KubeMicroservice('my.service.{}'.format(i), exposed=(i == 0)) for i in range(3)]
+
+    def tearDown(self):
+        self.api_client.close()
+
+    def reconcile(self) -> list:
+        self.server.requests.clear()
+        changes = self.reconciler.reconcile(self.services)
+        return sorted((change.kind, change.action) for change in changes)
+
+    def writes(self) -> list:
+        return [req for req in self.server.requests if req[0] != 'GET']
+
+    def test_resources_are_created(self):
+        changes = self.reconcile()
+        self.assertEqual(10, len(changes))
+        self.assertEqual({'create'}, {action for _, action in changes})
+        self.assertEqual([('ingress', 'create')], [change for change in changes if change[0] == 'ingress'])
+        # Each kind is listed once.
+        self.assertEqual(4, len([req for req in self.server.requests if req[0] == 'GET']))
+
+        deployment = self.server.resources['apis/apps/v1/namespaces/{}/deployments'.format(settings.kube_namespace)]
+        container = deployment['my-service-1']['spec']['template']['spec']['containers'][0]
+        self.assertEqual(['my.service.1'], container['args'])
+
+    def test_unchanged_resources_are_left_alone(self):
+        self.reconcile()
+        self.assertEqual([], self.reconcile())
+        self.assertEqual([], self.writes())
+
+    def test_only_changed_resources_are_patched(self):
+        self.reconcile()
+        self.services[1].image = 'new-image:latest'
+        self.assertEqual([('deployment', 'patch')], self.reconcile())
+        self.assertEqual([('PATCH', 'deployments')], self.writes())
+
+    def test_resources_without_hash_are_patched(self):
+        self.reconcile()
+        services = self.server.resources['api/v1/namespaces/{}/services'.format(settings.kube_namespace)]
+        del services['my-service-2']['metadata']['annotations']
+        self.assertEqual([('service', 'patch')], self.reconcile())
+
+    def test_failures_are_reported(self):
+        self.server.failing.add('my-service-1')
+        with self.assertRaises(RuntimeError):
+            self.reconcile()
+        # Everything else is still created.
+        self.assertEqual(7, sum(len(resources) for resources in self.server.resources.values()))
+        self.server.failing.clear()
+        self.assertEqual(3, len(self.reconcile()))
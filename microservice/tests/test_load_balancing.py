@@ -0,0 +1,106 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from microservice.core import load_balancing, settings
+
+
+class TestLoadBalancing(TestCase):
+    def setUp(self):
+        self.uris = ["http://127.0.0.1:10000/", "http://127.0.0.1:10001/", "http://127.0.0.1:10002/"]
+
+    def create_endpoints(self, policy) -> load_balancing.ServiceEndpoints:
+        return load_balancing.ServiceEndpoints('my.service', self.uris, policy)
+
+    def test_round_robin(self):
+        endpoints = self.create_endpoints(load_balancing.RoundRobin())
+        self.assertEqual(self.uris * 2, [endpoints.choose().uri for _ in range(6)])
+
+    def test_least_outstanding(self):
+        endpoints = self.create_endpoints(load_balancing.LeastOutstanding())
+        with endpoints.request() as first, endpoints.request() as second, endpoints.request() as third:
+            self.assertEqual(3, len({first, second, third}))
+            with endpoints.request() as fourth:
+                self.assertEqual(2, fourth.outstanding)
+        self.assertEqual({0}, {endpoint.outstanding for endpoint in endpoints.endpoints})
+
+    def test_power_of_two_choices(self):
+        self.uris = self.uris[:2]
+        endpoints = self.create_endpoints(load_balancing.PowerOfTwoChoices())
+        endpoints.endpoints[0].outstanding = 5
+        self.assertEqual(self.uris[1], endpoints.choose().uri)
+
+    @patch('microservice.core.load_balancing.time.monotonic', return_value=100)
+    def test_reported_load(self, mock_monotonic):
+        endpoints = self.create_endpoints(load_balancing.LeastOutstanding())
+        # Requests are acknowledged as soon as they are queued, so they are never outstanding for long.
+        endpoints.endpoints[0].report_load('5')
+        endpoints.endpoints[1].report_load('2')
+        self.assertEqual(self.uris[2], endpoints.choose().uri)
+        endpoints.endpoints[2].report_load('3')
+        self.assertEqual(self.uris[1], endpoints.choose().uri)
+
+        endpoints.endpoints[1].report_load(None)
+        endpoints.endpoints[1].report_load('not a number')
+        self.assertEqual(2, endpoints.endpoints[1].load)
+
+        # Old reports are ignored.
+        mock_monotonic.return_value = 100 + settings.load_report_ttl + 1
+        self.assertEqual([0, 0, 0], [endpoint.load for endpoint in endpoints.endpoints])
+
+    @patch.object(settings, 'endpoint_max_failures', 2)
+    def test_unhealthy_endpoints_are_skipped(self):
+        endpoints = self.create_endpoints(load_balancing.RoundRobin())
+        failing = endpoints.endpoints[0]
+        for _ in range(2):
+            endpoints.record_failure(failing)
+
+        self.assertNotIn(failing, [endpoints.choose() for _ in range(6)])
+        self.assertEqual({'outstanding': 0, 'load': 0, 'requests': 0, 'failures': 2, 'healthy': False},
+                         endpoints.metrics()[failing.uri])
+
+        # If every instance is unhealthy, they are all still tried.
+        for endpoint in endpoints.endpoints[1:]:
+            for _ in range(2):
+                endpoints.record_failure(endpoint)
+        self.assertEqual(set(endpoints.endpoints), {endpoints.choose() for _ in range(6)})
+
+    def test_connection_errors_count_as_failures(self):
+        endpoints = self.create_endpoints(load_balancing.RoundRobin())
+        with self.assertRaises(requests.ConnectionError):
+            with endpoints.request() as endpoint:
+                raise requests.ConnectionError()
+        self.assertEqual(1, endpoint.failures)
+        self.assertEqual(0, endpoint.outstanding)
+
+    def test_update_keeps_known_endpoints(self):
+        endpoints = self.create_endpoints(load_balancing.RoundRobin())
+        known = endpoints.endpoints[1]
+        endpoints.update(self.uris[1:] + ["http://127.0.0.1:10003/"])
+        self.assertIs(known, endpoints.endpoints[0])
+        self.assertEqual(3, len(endpoints))
+
+    def test_custom_policy(self):
+        class First(load_balancing.Policy):
+            def choose(self, endpoints):
+                return endpoints[0]
+
+        with patch.object(settings, 'load_balancing_policies', {'my.service': First}):
+            endpoints = load_balancing.ServiceEndpoints('my.service', self.uris)
+        self.assertEqual([self.uris[0]] * 3, [endpoints.choose().uri for _ in range(3)])
+
+    def test_registry_refreshes_endpoints(self):
+        registry = load_balancing.EndpointRegistry()
+        discover = MagicMock(return_value=self.uris)
+        self.assertTrue(registry.needs_discovery('my.service'))
+        endpoints = registry.get('my.service', discover)
+        self.assertFalse(registry.needs_discovery('my.service'))
+        self.assertIs(endpoints, registry.get('my.service', discover))
+        discover.assert_called_once_with('my.service')
+
+        discover.return_value = self.uris[:1]
+        with patch.object(settings, 'endpoint_refresh_interval', -1):
+            self.assertTrue(registry.needs_discovery('my.service'))
+            registry.get('my.service', discover)
+        self.assertEqual(1, len(endpoints))
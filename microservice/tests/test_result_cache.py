@@ -0,0 +1,66 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from microservice.core import memcached_wrapper, result_cache, settings
+
+
+class TestResultCache(TestCase):
+    def test_lru_eviction(self):
+        cache = result_cache.ResultCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual((True, 1), cache.get('a'))
+        cache.put('c', 3)
+
+        self.assertEqual((False, None), cache.get('b'))
+        self.assertEqual((True, 1), cache.get('a'))
+        self.assertEqual((True, 3), cache.get('c'))
+        self.assertEqual({
+            'size': 2,
+            'max_size': 2,
+            'hits': 3,
+            'shared_hits': 0,
+            'misses': 1,
+            'evictions': 1,
+        }, cache.metrics())
+
+    @patch('microservice.core.result_cache.time.monotonic')
+    def test_ttl_expiry(self, mock_monotonic):
+        cache = result_cache.ResultCache(ttl=10)
+        mock_monotonic.return_value = 100
+        cache.put('a', 1)
+
+        mock_monotonic.return_value = 109
+        self.assertEqual((True, 1), cache.get('a'))
+        mock_monotonic.return_value = 110
+        self.assertEqual((False, None), cache.get('a'))
+        self.assertEqual(1, cache.evictions)
+
+    def test_falsy_results_are_cached(self):
+        cache = result_cache.ResultCache()
+        cache.put('a', None)
+        self.assertEqual((True, None), cache.get('a'))
+
+    def test_exceptions_are_not_cached(self):
+        cache = result_cache.ResultCache()
+        cache.put('a', RuntimeError())
+        self.assertEqual((False, None), cache.get('a'))
+
+    @patch.object(settings, 'deployment_mode', settings.DeploymentMode.ZERO)
+    def test_shared_tier(self):
+        instance_1 = result_cache.ResultCache(shared=True)
+        instance_2 = result_cache.ResultCache(shared=True)
+        instance_1.put(('shared', 'key'), 'result')
+
+        self.assertEqual((True, 'result'), instance_2.get(('shared', 'key')))
+        self.assertEqual(1, instance_2.shared_hits)
+        # The result is now cached in memory too.
+        memcached_wrapper.FakeMemcachedDatabase.clear()
+        self.assertEqual((True, 'result'), instance_2.get(('shared', 'key')))
+
+    def test_create_cache(self):
+        self.assertEqual(settings.cache_max_size, result_cache.create_cache('service.a', True).max_size)
+        self.assertEqual(5, result_cache.create_cache('service.b', {'max_size': 5}).max_size)
+        self.assertIn('service.b', result_cache.metrics())
+        with self.assertRaises(ValueError):
+            result_cache.create_cache('service.c', "invalid")
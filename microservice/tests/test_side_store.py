@@ -0,0 +1,101 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from microservice.core import codec, communication, connection_pool, service_host, settings, side_store
+from microservice.core.service_waypost import init_service_waypost
+
+LOCAL_URI = "http://127.0.0.1:10000/"
+REMOTE_URI = "http://127.0.0.1:10001/"
+
+
+@patch.object(settings, 'side_store_enabled', True)
+@patch.object(settings, 'side_store_threshold', 100)
+@patch.object(settings, 'side_store_uri', LOCAL_URI)
+class TestSideStore(TestCase):
+    def setUp(self):
+        self.large = list(range(1000))
+        self.small = [1, 2, 3]
+
+    def test_only_large_values_are_stored(self):
+        self.assertIs(self.small, side_store.store_if_large(self.small))
+
+        ref = side_store.store_if_large(self.large)
+        self.assertEqual(side_store.StoredRef(LOCAL_URI, ref.key), ref)
+        self.assertEqual(self.large, side_store.resolve(ref))
+        self.assertIs(ref, side_store.store_if_large(ref))
+
+        with patch.object(settings, 'side_store_enabled', False):
+            self.assertIs(self.large, side_store.store_if_large(self.large))
+
+    @patch('microservice.core.side_store.time.monotonic')
+    def test_values_expire(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        ref = side_store.store_if_large(self.large)
+
+        mock_monotonic.return_value = 100 + settings.side_store_ttl + 1
+        with self.assertRaises(side_store.SideStoreExpired):
+            side_store.resolve(ref)
+        self.assertEqual(1, side_store.local_store.remove_expired())
+
+    def test_identical_values_share_a_key(self):
+        first = side_store.store_if_large(self.large)
+        self.assertEqual(first, side_store.store_if_large(list(self.large)))
+        self.assertNotEqual(first, side_store.store_if_large(self.large + [1]))
+
+    def test_size_is_bounded(self):
+        store = side_store.LocalSideStore()
+        values = [codec.dumps(list(range(i, i + 100))) for i in range(3)]
+        with patch.object(settings, 'side_store_max_size', len(values[0]) * 2):
+            keys = [store.put(value) for value in values]
+        # The oldest value is removed to make room.
+        with self.assertRaises(side_store.SideStoreExpired):
+            store.get(keys[0])
+        self.assertEqual(values[1:], [store.get(key) for key in keys[1:]])
+        self.assertEqual(len(values[1]) + len(values[2]), store.size)
+
+    def test_resolve_from_other_service(self):
+        response = MagicMock(status_code=200, content=codec.dumps(self.large))
+        session = MagicMock(get=MagicMock(return_value=response))
+        with patch.object(connection_pool, 'get_session', return_value=session):
+            self.assertEqual(self.large, side_store.resolve(side_store.StoredRef(REMOTE_URI, 'abc')))
+        session.get.assert_called_once_with(REMOTE_URI + 'side_store/abc')
+
+    def test_side_store_endpoint(self):
+        service_host.configure_microservice()
+        client = service_host.app.test_client()
+        ref = side_store.store_if_large(self.large)
+
+        self.assertEqual(self.large, codec.loads(client.get('/side_store/' + ref.key).data))
+        self.assertEqual(404, client.get('/side_store/unknown').status_code)
+
+    @patch('microservice.core.communication.get_local_uri', new=MagicMock(return_value='local-service'))
+    def test_messages_only_carry_references(self):
+        init_service_waypost()
+        settings.ServiceWaypost.local_service = 'local-service'
+        inbound = communication.Message(args=(self.large,), kwargs={'a': 1})
+
+        outbound = communication.construct_message_add_via(inbound, 1, 2)
+        self.assertIsInstance(outbound.via[0].args, side_store.StoredRef)
+        self.assertEqual({'a': 1}, outbound.via[0].kwargs)
+
+        response = communication.construct_message_with_result(outbound, self.large)
+        result = response.results[outbound.result_key('local-service')]
+        self.assertIsInstance(result, side_store.StoredRef)
+        self.assertLess(len(codec.dumps(response)), len(codec.dumps(self.large)))
+
+        # The calling service gets its args back when it receives the response.
+        response.resolve_args()
+        self.assertEqual((self.large,), response.args)
+        self.assertEqual(self.large, side_store.resolve(result))
+
+    def test_results_are_only_fetched_once(self):
+        result_key = communication.create_result_key('other-service', (), {})
+        ref = side_store.StoredRef(REMOTE_URI, 'abc')
+        message = communication.Message(results={result_key: ref})
+        with patch.object(side_store, 'resolve', return_value=self.large) as mock_resolve:
+            self.assertEqual(self.large, message.resolved_result(result_key))
+            self.assertEqual(self.large, message.resolved_result(result_key))
+        mock_resolve.assert_called_once_with(ref)
+        # Only the reference is sent on.
+        self.assertIs(ref, message.results[result_key])
+        self.assertIs(ref, communication.construct_message_add_via(message).results[result_key])
@@ -0,0 +1,197 @@
+import json
+import requests
+import threading
+import time
+
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from microservice.core import settings, subprocess_cluster
+from microservice.core.utils import MicroserviceDefinition
+
+
+class FakeProcess(MagicMock):
+    """
+    A process that is running until it is killed.
+    """
+    exit_code = None
+
+    def poll(self):
+        return self.exit_code
+
+
+class TestSubprocessMicroserviceCluster(TestCase):
+    def setUp(self):
+        self.service_name = 'my.service'
+        self.processes = []
+
+        def spawn_microservice(service_name, host, port, **other_kwargs):
+            process = FakeProcess(pid=port, kwargs=other_kwargs)
+            self.processes.append(process)
+            return process
+
+        def kill(service):
+            service.process.exit_code = -9
+
+        for name, value in [('spawn_microservice', spawn_microservice),
+                            ('kill_subprocess_service', kill)]:
+            patcher = patch.object(subprocess_cluster, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(subprocess_cluster.SubprocessMicroserviceCluster, 'wait_until_ready')
+        self.wait_until_ready = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.executor_metrics = {'queue_depth': 0, 'active_workers': 0}
+        patcher = patch.object(subprocess_cluster, 'fetch_executor_metrics', lambda uri: dict(self.executor_metrics))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.multiple(settings, drain_timeout=5, drain_interval=0.001, endpoint_refresh_interval=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cluster = subprocess_cluster.SubprocessMicroserviceCluster(
+            [MicroserviceDefinition(self.service_name), MicroserviceDefinition('other.service')],
+            replicas={self.service_name: 2},
+        )
+        self.cluster.next_port = 10000
+        self.cluster.send_request_to_uris = MagicMock()
+        self.cluster.spawn_all_microservices()
+
+    def test_waits_for_every_replica(self):
+        self.assertEqual(3, len(self.wait_until_ready.call_args[0][0]))
+
+    def test_replicas(self):
+        self.assertEqual(["http://127.0.0.1:10000/", "http://127.0.0.1:10001/"],
+                         self.cluster.uris_for_service(self.service_name))
+        self.assertEqual(["http://127.0.0.1:10002/"], self.cluster.uris_for_service('other.service'))
+        self.assertEqual({"http://127.0.0.1:10000/", "http://127.0.0.1:10001/"},
+                         {self.cluster.uri_for_service(self.service_name) for _ in range(4)})
+
+    def test_tuning_from_definition(self):
+        definition = MicroserviceDefinition('tuned.service', min_replicas=3, executor_workers=1)
+        cluster = subprocess_cluster.SubprocessMicroserviceCluster(
+            [definition], service_kwargs={'tuned.service': {'server_backend': 'GUNICORN'}}, autoscale=True)
+        cluster.spawn_all_microservices()
+
+        self.assertEqual(3, len(cluster.uris_for_service('tuned.service')))
+        self.assertEqual({'executor_workers': 1, 'server_backend': 'GUNICORN'},
+                         {key: self.processes[-1].kwargs[key] for key in ('executor_workers', 'server_backend')})
+        self.assertEqual({'tuned.service': (3, None)}, cluster.autoscaler.replica_bounds)
+
+    def test_startup_failure(self):
+        self.wait_until_ready.side_effect = subprocess_cluster.ServiceNotReady()
+        cluster = subprocess_cluster.SubprocessMicroserviceCluster([MicroserviceDefinition('failing.service')],
+                                                                   replicas={'failing.service': 2})
+        with self.assertRaises(subprocess_cluster.ServiceNotReady):
+            cluster.spawn_all_microservices()
+        self.assertTrue(all(process.poll() is not None for process in self.processes[-2:]))
+
+    def test_scale_up(self):
+        uris = self.cluster.scale(self.service_name, 4)
+        self.assertEqual(["http://127.0.0.1:10000/", "http://127.0.0.1:10001/",
+                          "http://127.0.0.1:10003/", "http://127.0.0.1:10004/"], uris)
+
+        # Only the new replicas are waited for, and they are configured when they are spawned.
+        self.assertEqual([10003, 10004], [service.port for service in self.wait_until_ready.call_args[0][0]])
+        self.assertEqual({'deployment_mode': settings.DeploymentMode.SUBPROCESS.value,
+                          'deployment_manager_uri': self.cluster.deployment_manager_uri},
+                         self.processes[-1].kwargs)
+        self.cluster.send_request_to_uris.assert_not_called()
+
+    def test_scale_up_failure(self):
+        self.wait_until_ready.side_effect = subprocess_cluster.ServiceNotReady()
+        with self.assertRaises(subprocess_cluster.ServiceNotReady):
+            self.cluster.scale(self.service_name, 3)
+        self.assertEqual(2, len(self.cluster.uris_for_service(self.service_name)))
+        self.assertIsNotNone(self.processes[-1].poll())
+
+    def test_scale_down(self):
+        newest = self.cluster.services[self.service_name][1]
+        self.assertEqual(["http://127.0.0.1:10000/"], self.cluster.scale(self.service_name, 1))
+        self.assertIsNotNone(newest.process.poll())
+        self.assertEqual([], self.cluster.draining)
+
+        with self.assertRaises(ValueError):
+            self.cluster.scale(self.service_name, 0)
+
+    def test_scale_down_drains_replicas(self):
+        newest = self.cluster.services[self.service_name][1]
+        self.executor_metrics = {'queue_depth': 1, 'active_workers': 1}
+        scaling = threading.Thread(target=self.cluster.scale, args=(self.service_name, 1))
+        scaling.start()
+
+        # The replica stops being given out straight away, but isn't killed while it has accepted requests.
+        time.sleep(0.05)
+        self.assertEqual(["http://127.0.0.1:10000/"], self.cluster.uris_for_service(self.service_name))
+        self.assertEqual([newest], self.cluster.draining)
+        self.assertIsNone(newest.process.poll())
+
+        self.executor_metrics = {'queue_depth': 0, 'active_workers': 0}
+        scaling.join(5)
+        self.assertIsNotNone(newest.process.poll())
+
+    def test_drain_timeout(self):
+        self.executor_metrics = {'queue_depth': 1, 'active_workers': 0}
+        with patch.object(settings, 'drain_timeout', 0.05):
+            self.cluster.scale(self.service_name, 1)
+        self.assertIsNotNone(self.processes[1].poll())
+
+    def test_dead_replicas_are_not_given_out(self):
+        self.processes[0].exit_code = 1
+        self.assertEqual(["http://127.0.0.1:10001/"], self.cluster.uris_for_service(self.service_name))
+
+    def test_deployment_manager_routes(self):
+        client = self.cluster.create_deployment_manager_app().test_client()
+        self.assertEqual(["http://127.0.0.1:10000/", "http://127.0.0.1:10001/"],
+                         json.loads(client.get('/uri/' + self.service_name).data))
+
+        response = client.post('/scale/' + self.service_name, data={'replicas': 3})
+        self.assertEqual(3, len(json.loads(response.data)))
+        self.assertEqual(3, len(json.loads(client.get('/uri/' + self.service_name).data)))
+
+
+@patch.multiple(settings, readiness_timeout=5, readiness_initial_backoff=0.001, readiness_max_backoff=0.004)
+class TestReadinessProbing(TestCase):
+    def setUp(self):
+        self.service = subprocess_cluster.SubprocessService(FakeProcess(), '127.0.0.1', 10000)
+        self.session = MagicMock()
+        self.cancelled = threading.Event()
+
+    def probe(self, timeout=5):
+        subprocess_cluster.probe_until_ready(self.service, self.session, time.monotonic() + timeout, self.cancelled)
+
+    def test_ready_once_pinged(self):
+        self.session.get.side_effect = [requests.ConnectionError(), requests.ConnectionError(), MagicMock(text="pong")]
+        self.probe()
+        self.assertEqual(3, self.session.get.call_count)
+        self.assertEqual("http://127.0.0.1:10000/ping", self.session.get.call_args[0][0])
+
+    def test_exited_service(self):
+        self.session.get.side_effect = requests.ConnectionError()
+        self.service.process.exit_code = 1
+        with self.assertRaises(subprocess_cluster.ServiceNotReady):
+            self.probe()
+
+    def test_deadline(self):
+        self.session.get.side_effect = requests.ConnectionError()
+        with self.assertRaises(subprocess_cluster.ServiceNotReady):
+            self.probe(timeout=0.05)
+        # Backing off, rather than probing as fast as possible.
+        self.assertLess(self.session.get.call_count, 20)
+
+    def test_every_service_probed_at_once(self):
+        cluster = subprocess_cluster.SubprocessMicroserviceCluster([])
+        cluster.readiness_session = self.session
+        probed = []
+
+        def get(uri, timeout):
+            probed.append(uri)
+            if len(probed) < 4:
+                raise requests.ConnectionError()
+            return MagicMock(text="pong")
+
+        self.session.get.side_effect = get
+        services = [subprocess_cluster.SubprocessService(FakeProcess(), '127.0.0.1', port)
+                    for port in range(10000, 10003)]
+        cluster.wait_until_ready(services)
+        self.assertEqual(3, len(set(probed)))
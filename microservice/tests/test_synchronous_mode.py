@@ -1,9 +1,12 @@
+import os
 import pickle
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import call
 
 from microservice.tests.microservice_test_case import MicroserviceTestCase, MockRequestResult
-from microservice.core import settings, communication
+from microservice.core import codec, settings, communication, service_host
 
 from microservice.tests import microservices_for_testing
 
@@ -84,6 +87,100 @@ class TestSynchronousLocalService(MicroserviceTestCase):
                  expected_call)
         ])
 
+    def test_request_to_process_executor(self):
+        local_service_name = 'microservice.tests.microservices_for_testing.process_id'
+        self.mock_setup(local_service_name)
+        self.assertEqual(settings.ExecutorType.PROCESS, microservices_for_testing.process_id.definition.executor)
+
+        response = self.app.get('/', data=self.sample_message.pickle)
+        result = pickle.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        # The function is carried out in a worker process rather than the process handling the request.
+        self.assertIsInstance(result.results[local_service_name], int)
+        self.assertNotEqual(os.getpid(), result.results[local_service_name])
+
+    def test_identical_requests_are_coalesced(self):
+        local_service_name = 'microservice.tests.microservices_for_testing.coalesced_echo'
+        self.mock_setup(local_service_name)
+        microservices_for_testing.coalesced_echo_calls.clear()
+        microservices_for_testing.coalesced_echo_release.clear()
+
+        def make_request():
+            response = service_host.app.test_client().get('/', data=self.sample_message.pickle)
+            return pickle.loads(response.data)
+
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(make_request) for _ in range(4)]
+            time.sleep(0.1)
+            microservices_for_testing.coalesced_echo_release.set()
+
+        expected_result = communication.Message(results={local_service_name: self.sample_message.args})
+        for future in futures:
+            self.assertEqual(expected_result, future.result())
+        self.assertEqual(1, len(microservices_for_testing.coalesced_echo_calls))
+
+    def test_remote_call_is_cached(self):
+        """
+        Test that a cached result is returned without making a request.
+        """
+        microservices_for_testing.cached_echo.cache.clear()
+        self.mock_setup('microservice.tests.microservices_for_testing.echo_as_dict')
+
+        for _ in range(3):
+            result = microservices_for_testing.cached_echo(*self.sample_message.args)
+            self.assertEqual(MockRequestResult.args, result)
+
+        self.mocked_send_object_to_service.assert_called_once()
+
+    def test_batch_request(self):
+        local_service_name = 'microservice.tests.microservices_for_testing.echo_as_dict'
+        self.mock_setup(local_service_name)
+
+        messages = [communication.Message(args=(i,), kwargs={'a': i}) for i in range(3)]
+        response = self.app.post('/batch', data=pickle.dumps(messages))
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'_args': (i,), 'a': i} for i in range(3)], pickle.loads(response.data))
+
+    def test_batch_request_resulting_in_exceptions(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.exception_raiser')
+
+        messages = [communication.Message(args=(i,)) for i in range(2)]
+        response = self.app.post('/batch', data=pickle.dumps(messages))
+        results = pickle.loads(response.data)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, len(results))
+        for result in results:
+            self.assertIsInstance(result, RuntimeError)
+
+    def test_stream_request(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.count_up_to')
+
+        response = self.app.get('/stream', data=communication.Message(args=(3,)).pickle)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([(codec.FRAME_ITEM, i) for i in range(3)], list(codec.iter_frames([response.data])))
+
+    def test_stream_request_resulting_in_exception(self):
+        self.mock_setup('microservice.tests.microservices_for_testing.count_up_to')
+
+        response = self.app.get('/stream', data=communication.Message(args=(2,), kwargs={'fail': True}).pickle)
+        frames = list(codec.iter_frames([response.data]))
+
+        self.assertEqual([(codec.FRAME_ITEM, 0), (codec.FRAME_ITEM, 1)], frames[:2])
+        self.assertEqual(codec.FRAME_ERROR, frames[2][0])
+        self.assertIsInstance(frames[2][1], RuntimeError)
+
+    def test_generator_request_without_streaming(self):
+        local_service_name = 'microservice.tests.microservices_for_testing.count_up_to'
+        self.mock_setup(local_service_name)
+
+        response = self.app.get('/', data=communication.Message(args=(3,)).pickle)
+
+        self.assertEqual([0, 1, 2], pickle.loads(response.data).results[local_service_name])
+
     def test_exception_raised(self):
         local_service_name = 'microservice.tests.microservices_for_testing.exception_raiser'
         self.mock_setup(local_service_name)
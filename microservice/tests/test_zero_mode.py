@@ -1,5 +1,10 @@
+import asyncio
+import threading
+
+from unittest.mock import patch
+
 from microservice.tests.microservice_test_case import MicroserviceTestCase
-from microservice.core import settings
+from microservice.core import decorator, settings
 
 from microservice.tests import microservices_for_testing
 
@@ -38,3 +43,70 @@ class TestZeroMode(MicroserviceTestCase):
     def test_exception_raised(self):
         with self.assertRaises(RuntimeError):
             microservices_for_testing.exception_raiser()
+
+    def test_async_call(self):
+        async def make_calls():
+            return await asyncio.gather(
+                microservices_for_testing.echo_as_dict.async_call(*self.args, **self.kwargs),
+                microservices_for_testing.echo_as_dict.async_call(4, 5),
+            )
+
+        results = asyncio.new_event_loop().run_until_complete(make_calls())
+        self.assertEqual([{'_args': self.args, **self.kwargs}, {'_args': (4, 5)}], results)
+        self.mocked_send_object_to_service.assert_not_called()
+
+    def test_cached_request(self):
+        microservices_for_testing.cached_echo.cache.clear()
+        microservices_for_testing.cached_echo_calls.clear()
+
+        self.assertEqual(self.args, microservices_for_testing.cached_echo(*self.args, **self.kwargs))
+        self.assertEqual(self.args, microservices_for_testing.cached_echo(*self.args, **self.kwargs))
+        self.assertEqual((4, 5), microservices_for_testing.cached_echo(4, 5))
+
+        self.assertEqual([(self.args, self.kwargs), ((4, 5), {})], microservices_for_testing.cached_echo_calls)
+
+    def test_map(self):
+        results = microservices_for_testing.echo_as_dict.map([1, 2], [3, 4])
+        self.assertEqual([{'_args': (1, 3)}, {'_args': (2, 4)}], results)
+
+        results = microservices_for_testing.exception_raiser.map([1])
+        self.assertIsInstance(results[0], RuntimeError)
+
+    def test_stream(self):
+        self.assertEqual([0, 1, 2], list(microservices_for_testing.count_up_to.stream(3)))
+        self.assertEqual([self.args], list(microservices_for_testing.cached_echo.stream(*self.args)))
+
+    def test_generators_are_not_coalesced(self):
+        with patch.object(decorator.in_flight_calls, 'do') as mock_do:
+            first = microservices_for_testing.coalesced_count_up_to(3)
+            second = microservices_for_testing.coalesced_count_up_to(3)
+            self.assertEqual(0, next(first))
+            self.assertEqual([0, 1, 2], list(second))
+            self.assertEqual([1, 2], list(first))
+        mock_do.assert_not_called()
+
+    def test_generators_not_allowed_in_process_executor(self):
+        with self.assertRaises(ValueError):
+            microservices_for_testing.microservice(executor="process")(
+                microservices_for_testing.count_up_to.__wrapped__)
+
+    def test_continuation(self):
+        self.assertEqual([{'_args': (1,)}, {'_args': (2,)}], microservices_for_testing.echo_in_turn(1, 2))
+
+    def test_without_waypost(self):
+        # As in a plain script, where no service is being hosted.
+        with patch.object(settings, 'ServiceWaypost', None):
+            self.assertEqual([{'_args': (1,)}, {'_args': (2,)}], microservices_for_testing.echo_in_turn(1, 2))
+
+    def test_gather(self):
+        self.assertEqual([{'_args': (1,)}, {'_args': (2,)}], microservices_for_testing.echo_gathered(1, 2))
+
+    def test_nested_gather(self):
+        results = []
+        # Many more gathers than threads are waiting on the results of further gathers.
+        gathering = threading.Thread(target=lambda: results.append(microservices_for_testing.echo_gathered_nested(64)),
+                                     daemon=True)
+        gathering.start()
+        gathering.join(30)
+        self.assertFalse(gathering.is_alive(), "Nested gathers deadlocked")
+        self.assertEqual([[{'_args': (i,)}] * 3 for i in range(64)], results[0])
@@ -46,11 +46,14 @@ setup(
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
 
     install_requires=[
+        'aiohttp',
         'docker',
         'flask',
         'fluent-logger',
+        'gunicorn; platform_system != "Windows"',
         'kubernetes',
         'logstash_formatter',
+        'msgpack',
         'psutil',
         'python-logstash-async',
         'requests',